@@ -0,0 +1,367 @@
+"""
+Benchmarks for the Health Information System in main.py.
+
+Generates seeded synthetic patients files and times the public functions on
+them, each in a fresh process, for wall time, throughput and peak RSS. The
+results are written as JSON, and --compare prints the change from an earlier
+results file, so runs on different commits can be compared.
+
+    python benchmark.py --sizes 10k 1m --output after.json --compare before.json
+
+It also runs against the original main.py, whose statistics and follow-up
+checks fail on spoiled lines; use --invalid-share 0 to compare with it.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+import main
+
+
+#Row counts benchmarked by default
+DEFAULT_SIZES = ('10k', '1m', '10m')
+
+#Years visits are spread over, with more visits in later years
+FIRST_YEAR = 2015
+LAST_YEAR = 2024
+
+#Relative number of visits per month, busier in winter
+MONTH_WEIGHTS = (1.30, 1.25, 1.10, 1.00, 0.90, 0.85, 0.85, 0.90, 1.00, 1.05, 1.15, 1.30)
+
+#Lowest and highest value of each vital sign, as readPatientsFromFile accepts them, in file order
+VITAL_LIMITS = ((35, 42), (30, 180), (5, 40), (70, 200), (40, 120), (70, 100))
+
+#Mean, standard deviation and decimals of each vital sign, in file order
+VITAL_DISTRIBUTIONS = (
+    (37.0, 0.6, 1),
+    (78, 14, 0),
+    (16, 3, 0),
+    (124, 16, 0),
+    (80, 10, 0),
+    (97, 2, 0),
+)
+
+#Average visits per patient; visits per patient follow a Zipf distribution
+VISITS_PER_PATIENT = 20
+PATIENT_SKEW = 1.1
+
+#Lines written per write while generating
+GENERATE_BATCH = 100000
+
+
+def parseSize(text):
+    """
+    Parses a row count such as 10000, 10k or 1m.
+    """
+    text = text.strip().lower()
+    multiplier = {'k': 10 ** 3, 'm': 10 ** 6}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * multiplier)
+
+
+def invalidLine(rng, line):
+    """
+    Spoils a valid line in one of the ways real files go wrong.
+    """
+    fields = line.split(',')
+    kind = rng.randrange(5)
+    if kind == 0:
+        fields[1] = f"{rng.randint(2015, 2024)}-{rng.randint(13, 19)}-{rng.randint(32, 39)}"
+    elif kind == 1:
+        del fields[rng.randrange(2, 8)]
+    elif kind == 2:
+        fields[rng.randrange(2, 8)] = 'n/a'
+    elif kind == 3:
+        fields[3] = str(rng.randint(300, 999))
+    else:
+        return ''
+    return ','.join(fields)
+
+
+def generatePatientFile(path, rows, seed=0, invalidShare=0.01):
+    """
+    Writes a synthetic patients file with realistic vitals, dates and patient skew.
+
+    The same arguments always give the same file.
+    path: Where to write the file.
+    rows: The number of lines to write.
+    seed: The seed of the random numbers.
+    invalidShare: The share of lines that are spoiled, from 0 to 1.
+    """
+    rng = random.Random(seed)
+    patientCount = max(1, rows // VISITS_PER_PATIENT)
+    patientWeights = list(accumulate(1 / rank ** PATIENT_SKEW for rank in range(1, patientCount + 1)))
+    #Patient IDs are shuffled so the busiest patients are not simply the lowest IDs
+    patientIds = list(range(1, patientCount + 1))
+    rng.shuffle(patientIds)
+
+    months = [(year, month) for year in range(FIRST_YEAR, LAST_YEAR + 1) for month in range(1, 13)]
+    monthWeights = list(accumulate((1 + 0.1 * (year - FIRST_YEAR)) * MONTH_WEIGHTS[month - 1]
+                                   for year, month in months))
+    monthStarts = [datetime.date(year, month, 1).toordinal() for year, month in months]
+    monthLengths = [(datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.date(year, month, 1)).days
+                    for year, month in months]
+    monthIndexes = range(len(months))
+
+    written = 0
+    with open(path, 'w') as file:
+        while written < rows:
+            count = min(GENERATE_BATCH, rows - written)
+            ids = rng.choices(patientIds, cum_weights=patientWeights, k=count)
+            chosenMonths = rng.choices(monthIndexes, cum_weights=monthWeights, k=count)
+            lines = []
+            for patientId, month in zip(ids, chosenMonths):
+                day = datetime.date.fromordinal(monthStarts[month] + rng.randrange(monthLengths[month]))
+                vitals = []
+                for (low, high), (mean, deviation, decimals) in zip(VITAL_LIMITS, VITAL_DISTRIBUTIONS):
+                    value = min(high, max(low, round(rng.gauss(mean, deviation), decimals)))
+                    vitals.append(f"{value:.{decimals}f}")
+                line = f"{patientId},{day.isoformat()},{','.join(vitals)}"
+                if rng.random() < invalidShare:
+                    line = invalidLine(rng, line)
+                lines.append(line + '\n')
+            file.writelines(lines)
+            written += count
+
+
+def dataFileFor(directory, rows, seed, invalidShare):
+    """
+    Returns the generated patients file for these settings, generating it on first use.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"patients-{rows}-{seed}-{invalidShare}.txt")
+    if not os.path.exists(path):
+        temporary = path + '.tmp'
+        generatePatientFile(temporary, rows, seed, invalidShare)
+        os.replace(temporary, path)
+    return path
+
+
+def peakRssMb():
+    """
+    Returns the peak resident set size of this process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def setUpStore(dataFile, workDirectory):
+    """
+    Loads a private copy of the data file through its mutation log, as main() does.
+
+    Commits from before the mutation log read the file itself.
+    """
+    copy = os.path.join(workDirectory, 'patients.txt')
+    shutil.copyfile(dataFile, copy)
+    openPatients = getattr(main, 'openPatients', main.readPatientsFromFile)
+    return openPatients(copy), copy
+
+
+def benchRead(patients, dataFile, operations):
+    patients = main.readPatientsFromFile(dataFile)
+    report = getattr(patients, 'loadReport', None)
+    if report is not None:
+        return report.lineCount
+    #Commits from before the load report give back a plain dictionary
+    with open(dataFile, 'rb') as file:
+        return sum(1 for line in file)
+
+
+def benchStats(patients, dataFile, operations):
+    main.displayStats(patients, '0')
+    patientIds = list(patients)[:operations - 1]
+    for patientId in patientIds:
+        main.displayStats(patients, str(patientId))
+    return len(patientIds) + 1
+
+
+def benchFindByDate(patients, dataFile, operations):
+    count = 0
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        main.findVisitsByDate(patients, year)
+        main.findVisitsByDate(patients, year, 1)
+        main.findVisitsByDate(patients, None, year % 12 + 1)
+        count += 3
+    return count
+
+
+def benchFollowUp(patients, dataFile, operations):
+    main.findPatientsWhoNeedFollowUp(patients)
+    #Later calls only re-check patients changed in between
+    if hasattr(patients, 'append'):
+        patients.append(1, main.dateToOrdinal('2024-06-01'), 37.0, 190, 16, 120, 80, 97)
+    else:
+        patients[1].append(['2024-06-01', 37.0, 190, 16, 120, 80, 97])
+    main.findPatientsWhoNeedFollowUp(patients)
+    return 2
+
+
+def benchAdd(patients, dataFile, operations):
+    for i in range(operations):
+        main.addPatientData(patients, 10 ** 9 + i, '2024-06-01', 37.2, 75, 16, 120, 80, 97, dataFile)
+    return operations
+
+
+def benchDelete(patients, dataFile, operations):
+    patientIds = list(patients)[:operations]
+    for patientId in patientIds:
+        main.deleteAllVisitsOfPatient(patients, patientId, dataFile)
+    return len(patientIds)
+
+
+#name -> (function, operations per run, whether it needs a loaded store, unit of throughput)
+BENCHMARKS = {
+    'readPatientsFromFile': (benchRead, 1, False, 'rows/s'),
+    'displayStats': (benchStats, 100, True, 'calls/s'),
+    'findVisitsByDate': (benchFindByDate, None, True, 'calls/s'),
+    'findPatientsWhoNeedFollowUp': (benchFollowUp, None, True, 'calls/s'),
+    'addPatientData': (benchAdd, 1000, True, 'calls/s'),
+    'deleteAllVisitsOfPatient': (benchDelete, 100, True, 'calls/s'),
+}
+
+
+def runBenchmark(name, dataFile, rows):
+    """
+    Runs one benchmark on one data file in the current process, with stdout discarded.
+
+    return: A dictionary of the results.
+    """
+    function, operations, needsStore, unit = BENCHMARKS[name]
+    dataFile = os.path.abspath(dataFile)
+    workDirectory = tempfile.mkdtemp()
+    #Older commits read and write patients.txt in the working directory, so that is the private copy
+    previousDirectory = os.getcwd()
+    os.chdir(workDirectory)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if needsStore:
+                patients, copy = setUpStore(dataFile, workDirectory)
+            else:
+                patients, copy = None, dataFile
+            rssBefore = peakRssMb()
+            started = time.perf_counter()
+            done = function(patients, copy, operations)
+            elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(previousDirectory)
+        shutil.rmtree(workDirectory)
+    rssAfter = peakRssMb()
+    return {
+        'function': name,
+        'rows': rows,
+        'operations': done,
+        'wallSeconds': round(elapsed, 6),
+        'throughput': round(done / elapsed, 3) if elapsed else None,
+        'unit': unit,
+        'peakRssMb': round(rssAfter, 1),
+        'rssGrowthMb': round(rssAfter - rssBefore, 1),
+    }
+
+
+def currentCommit():
+    """
+    Returns the git commit of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(sizes, names, seed=0, invalidShare=0.01, dataDirectory=None):
+    """
+    Runs every named benchmark on a generated file of each size, each in a fresh process.
+
+    return: A dictionary of the settings and a list of results, ready to be saved as JSON.
+    """
+    dataDirectory = dataDirectory or os.path.join(tempfile.gettempdir(), 'patients-benchmark')
+    results = []
+    for rows in sizes:
+        started = time.perf_counter()
+        dataFile = dataFileFor(dataDirectory, rows, seed, invalidShare)
+        print(f"{rows} rows: data ready in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+        for name in names:
+            #A new process per benchmark, so peak RSS belongs to that benchmark alone
+            with ProcessPoolExecutor(1) as executor:
+                try:
+                    result = executor.submit(runBenchmark, name, dataFile, rows).result()
+                except Exception as error:
+                    #Older commits can fail on some files, so the other benchmarks still run
+                    print(f"  {name}: failed: {error!r}", file=sys.stderr)
+                    results.append({'function': name, 'rows': rows, 'error': repr(error)})
+                    continue
+            print(f"  {name}: {result['wallSeconds']:.3f} s, {result['throughput']} {result['unit']}, "
+                  f"peak {result['peakRssMb']} MB", file=sys.stderr)
+            results.append(result)
+    return {
+        'commit': currentCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'invalidShare': invalidShare,
+        'results': results,
+    }
+
+
+def compareResults(old, new):
+    """
+    Prints the change in wall time and peak RSS of every benchmark found in both result sets.
+    """
+    before = {(result['function'], result['rows']): result for result in old['results']}
+    print(f"{'function':<30}{'rows':>10}{'time':>12}{'change':>10}{'peak RSS':>12}{'change':>10}")
+    for result in new['results']:
+        previous = before.get((result['function'], result['rows']))
+        if previous is None or 'error' in previous or 'error' in result:
+            continue
+        timeChange = (result['wallSeconds'] / previous['wallSeconds'] - 1) * 100 if previous['wallSeconds'] else 0
+        rssChange = (result['peakRssMb'] / previous['peakRssMb'] - 1) * 100 if previous['peakRssMb'] else 0
+        print(f"{result['function']:<30}{result['rows']:>10}{result['wallSeconds']:>11.3f}s{timeChange:>+9.1f}%"
+              f"{result['peakRssMb']:>10.1f}MB{rssChange:>+9.1f}%")
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Health Information System")
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help="row counts to benchmark, such as 10k 1m 10m (default: %(default)s)")
+    parser.add_argument('--functions', nargs='+', choices=sorted(BENCHMARKS), default=list(BENCHMARKS),
+                        help="the functions to benchmark (default: all)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated data (default: 0)")
+    parser.add_argument('--invalid-share', type=float, default=0.01,
+                        help="share of spoiled lines in the generated data (default: 0.01)")
+    parser.add_argument('--data-dir', help="where generated files are cached (default: a temporary directory)")
+    parser.add_argument('--output', default='benchmark.json', help="the results file (default: benchmark.json)")
+    parser.add_argument('--compare', metavar='RESULTS', help="an earlier results file to compare with")
+    parser.add_argument('--generate', metavar='PATH', help="only write a generated file of the first size to PATH")
+    return parser.parse_args(argv)
+
+
+def benchmarkMain():
+    options = parseArguments()
+    sizes = [parseSize(size) for size in options.sizes]
+    if options.generate:
+        generatePatientFile(options.generate, sizes[0], options.seed, options.invalid_share)
+        return
+    results = runBenchmarks(sizes, options.functions, options.seed, options.invalid_share, options.data_dir)
+    with open(options.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {options.output}", file=sys.stderr)
+    if options.compare:
+        with open(options.compare) as file:
+            compareResults(json.load(file), results)
+
+
+if __name__ == '__main__':
+    benchmarkMain()
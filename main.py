@@ -1,434 +1,5342 @@
+import argparse
+import asyncio
+import contextlib
+import copy
+import cProfile
+import datetime
+import functools
+import gc
+import heapq
+import io
+import json
+import lzma
+import math
+import mmap
+import os
+import pstats
+import random
+import shutil
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import accumulate, chain, compress, groupby, islice, repeat
+from operator import add, floordiv, itemgetter, mul, ne, or_, sub
 from typing import List, Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
 
+try:
+    import fcntl
+except ImportError:
+    #No file locks on this platform: the mutation log then assumes a single process
+    fcntl = None
 
-def readPatientsFromFile(filename):
+
+def dateToOrdinal(dateString):
     """
-    Reads patient data from a plaintext file.
+    Converts a date in the format 'yyyy-mm-dd' into an integer day ordinal.
 
-    fileName: The name of the file to read patient data from.
-    Returns a dictionary of patient IDs, where each patient has a list of visits.
-    The dictionary has the following structure:
-    {
-        patientId (int): [
-            [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
-            [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
-            ...
-        ],
-        patientId (int): [
-            [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
-            ...
-        ],
-        ...
-    }
+    dateString: The date to convert.
+    Raises ValueError if the date is not a valid calendar date.
     """
-    #Importing data from txt file
-    patients = {}
-    try: 
-        file = open(filename, 'r')
-    except FileNotFoundError:
-        print("The file patients.txt could not be found.")
-        patients = {}
-    #Reading data from speficic lines
-    data = file.readlines()
-    for line_num, line in enumerate(data):
-        line_num += 1
-        sections = line.split(',')
-        if len(sections) != 8:
-            print(f"Invalid number of sections ({len(sections)}) in line: {line}")
-
-        #Trying each case, and raising errors if it triggers
+    return datetime.date.fromisoformat(dateString.strip()).toordinal()
+
+
+@functools.lru_cache(maxsize=65536)
+def ordinalToDate(ordinal):
+    """
+    Converts an integer day ordinal back into a 'yyyy-mm-dd' date string.
+    """
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+@functools.lru_cache(maxsize=65536)
+def ordinalToYearMonth(ordinal):
+    """
+    Returns the (year, month) of an integer day ordinal.
+    """
+    day = datetime.date.fromordinal(ordinal)
+    return day.year, day.month
+
+
+def ordinalToMonth(ordinal):
+    """
+    Returns the month of an integer day ordinal as a month number, year * 12 + month - 1.
+    """
+    year, month = ordinalToYearMonth(ordinal)
+    return year * 12 + month - 1
+
+
+def parseMonth(monthString):
+    """
+    Converts a month in the format 'yyyy-mm' into a month number, year * 12 + month - 1.
+
+    Raises ValueError if it is not a valid month.
+    """
+    year, _, month = monthString.strip().partition('-')
+    if not (len(year) == 4 and year.isdigit() and month.isdigit() and 1 <= int(month) <= 12):
+        raise ValueError(f"Expected a month in the format 'yyyy-mm', got {monthString!r}")
+    return int(year) * 12 + int(month) - 1
+
+
+def monthToText(month):
+    """
+    Returns a month number as 'yyyy-mm'.
+    """
+    return f"{month // 12:04d}-{month % 12 + 1:02d}"
+
+
+def monthBounds(year, month=None):
+    """
+    Returns the half-open range of day ordinals [first, last) covering a year or one month of it.
+
+    A year or month no date can have gives an empty range, so it matches nothing.
+    """
+    if not datetime.MINYEAR <= year <= datetime.MAXYEAR or month is not None and not 1 <= month <= 12:
+        return 0, 0
+    first = datetime.date(year, month or 1, 1).toordinal()
+    if month is None or month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    #The day after the last date there is
+    last = datetime.date.max.toordinal() + 1 if year > datetime.MAXYEAR else datetime.date(year, month, 1).toordinal()
+    return first, last
+
+
+class SamplingProfiler:
+    """
+    Runs cProfile over a random sample of the instrumented calls, switched on and off at runtime.
+
+    Only one call is profiled at a time; calls made meanwhile, on other threads or
+    nested inside the profiled one, run unprofiled.
+    """
+
+    def __init__(self):
+        self.rate = 0.0
+        self.profile = None
+        self.sampled = 0
+        self.lock = threading.Lock()
+        #Where to write the report asked for by reportTo() while a profiled call was running
+        self.pendingReport = None
+
+    def start(self, rate=0.01):
+        """
+        Starts profiling the given share of instrumented calls, from 0 to 1, with a fresh profile.
+        """
+        self.profile = cProfile.Profile()
+        self.sampled = 0
+        self.rate = rate
+
+    def stop(self):
+        """
+        Stops sampling; the profile gathered so far is kept for report() and save().
+        """
+        self.rate = 0.0
+
+    def run(self, function, args, kwargs):
+        if not self.lock.acquire(blocking=False):
+            return function(*args, **kwargs)
+        try:
+            self.sampled += 1
+            return self.profile.runcall(function, *args, **kwargs)
+        finally:
+            self.lock.release()
+            if self.pendingReport is not None:
+                self.reportTo(self.pendingReport)
+
+    def report(self, limit=20):
+        """
+        Returns the functions with the most cumulative time in the profile, as text.
+        """
+        with self.lock:
+            return self.formatReport(limit)
+
+    def formatReport(self, limit=20):
+        if self.profile is None:
+            return "Nothing has been profiled."
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(limit)
+        return f"{self.sampled} sampled calls\n" + out.getvalue()
+
+    def reportTo(self, out):
+        """
+        Writes the report to out now, or as soon as the profiled call running returns.
+
+        Never waits for the lock, so a signal handler can call it even when the
+        signal interrupted the profiled call itself.
+        """
+        #Set first, so a call that releases the lock after the attempt below sees it
+        self.pendingReport = out
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            out, self.pendingReport = self.pendingReport, None
+            if out is not None:
+                print(self.formatReport(), file=out)
+        finally:
+            self.lock.release()
+
+    def save(self, path):
+        """
+        Saves the profile for pstats or snakeviz.
+        """
+        with self.lock:
+            self.profile.dump_stats(path)
+
+
+class OperationStats:
+    """
+    Number of calls, failures and a latency histogram of one instrumented operation.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * len(Instrumentation.LATENCY_BUCKETS)
+
+
+class Instrumentation:
+    """
+    Opt-in counters and latency histograms for the loader, the queries and the changes.
+
+    Off by default. While it is off, instrumented functions cost one attribute
+    check and the counting sites are skipped. Once on, every instrumented call
+    records its latency in a histogram, and the code records rows scanned and
+    returned, bytes read and written, time per loader phase and rejected lines.
+    summary() gives a dump for people and prometheus() the Prometheus text format.
+    """
+
+    #Upper bounds of the latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, math.inf)
+
+    def __init__(self):
+        self.enabled = False
+        self.profiler = SamplingProfiler()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything recorded so far.
+        """
+        with self.lock:
+            #operation -> OperationStats
+            self.operations = {}
+            #(name, (label, value) pairs) -> total
+            self.counters = Counter()
+
+    def call(self, operation, function, args, kwargs):
+        """
+        Calls function, timing it as operation and profiling it if it is sampled.
+        """
+        started = time.perf_counter()
+        failed = False
         try:
-            patientId = int(sections[0])
-            visitData = [sections[1]]
-            value = float(sections[2])
-            if not 35 <= value <= 42:
-                raise ValueError(f"Invalid temperature value ({value}) in line: {line}")
-            visitData.append(value)
-
-            value = float(sections[3])
-            if not 30 <= value <= 180:
-                raise ValueError(f"Invalid heart rate value ({value}) in line: {line}")
-            visitData.append(value)
-
-            value = float(sections[4])
-            if not 5 <= value <= 40:
-                raise ValueError(f'Invalid respirator rate value ({value}) in line: {line}')
-            visitData.append(value)
-
-            value = float(sections[5])
-            if not 70 <= value <= 200:
-                raise ValueError(f'Invalid systolic blood pressure value ({value}) in line: {line}')
-            visitData.append(value)
-
-            value = float(sections[6])
-            if not 40 <= value <= 120:
-                raise ValueError(f'Invalid diastolic blood pressuree value ({value}) in line: {line}')
-            visitData.append(value)
-
-            value = float(sections[7])
-            if not 70 <= value <= 100:
-                raise ValueError(f'Invalid oxygen saturation value ({value}) in line: {line}')
-            visitData.append(value)
+            if self.profiler.rate and random.random() < self.profiler.rate:
+                return self.profiler.run(function, args, kwargs)
+            return function(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe(operation, time.perf_counter() - started, failed)
+
+    def observe(self, operation, seconds, failed=False):
+        """
+        Records one call of an operation that took the given time.
+        """
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = OperationStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.seconds += seconds
+            stats.maximum = max(stats.maximum, seconds)
+            stats.buckets[bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds value to the counter called name with the given labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def summary(self):
+        """
+        Returns everything recorded as printable text.
+        """
+        if not self.operations and not self.counters:
+            return "Nothing recorded yet." if self.enabled else "Instrumentation is off."
+        lines = [f"{'operation':<32}{'calls':>9}{'errors':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+        with self.lock:
+            for operation, stats in sorted(self.operations.items()):
+                lines.append(f"{operation:<32}{stats.calls:>9}{stats.errors:>8}{stats.seconds:>10.3f}"
+                             f"{stats.seconds / stats.calls * 1000:>10.3f}{stats.maximum * 1000:>10.3f}")
+            lines.append("")
+            for (name, labels), value in sorted(self.counters.items()):
+                where = ', '.join(f"{label}={text}" for label, text in labels)
+                lines.append(f"{name}{' (' + where + ')' if where else ''}: {round(value, 6)}")
+        return '\n'.join(lines)
+
+    def prometheus(self, prefix='patients'):
+        """
+        Returns everything recorded in the Prometheus text exposition format.
+        """
+        def labelText(pairs):
+            return '{' + ','.join(f'{label}="{text}"' for label, text in pairs) + '}' if pairs else ''
+
+        lines = []
+        with self.lock:
+            lines.append(f"# TYPE {prefix}_operation_seconds histogram")
+            for operation, stats in sorted(self.operations.items()):
+                cumulative = 0
+                for bound, count in zip(self.LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append(f'{prefix}_operation_seconds_bucket{{operation="{operation}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_operation_seconds_sum{{operation="{operation}"}} {stats.seconds!r}')
+                lines.append(f'{prefix}_operation_seconds_count{{operation="{operation}"}} {stats.calls}')
+            lines.append(f"# TYPE {prefix}_operation_errors_total counter")
+            for operation, stats in sorted(self.operations.items()):
+                lines.append(f'{prefix}_operation_errors_total{{operation="{operation}"}} {stats.errors}')
+            names = sorted({name for name, labels in self.counters})
+            for name in names:
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                for (counterName, labels), value in sorted(self.counters.items()):
+                    if counterName == name:
+                        lines.append(f"{prefix}_{name}_total{labelText(labels)} {value!r}")
+        return '\n'.join(lines) + '\n'
+
+
+#The one Instrumentation of the process; turned on by --instrument, PATIENTS_INSTRUMENT or the menu
+INSTRUMENTS = Instrumentation()
+
+
+def instrumented(operation=None):
+    """
+    Decorator recording the calls of a function in INSTRUMENTS while it is on.
+
+    operation: The name the calls are recorded under; the function's name by default.
+    """
+    def decorate(function):
+        name = operation or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTS.enabled:
+                return function(*args, **kwargs)
+            return INSTRUMENTS.call(name, function, args, kwargs)
+        return wrapper
+    return decorate
+
+
+#Return the one shared object for a day ordinal or a rounded temperature, so Visits on the same day share it
+internOrdinal = {}.setdefault
+internTemperature = {}.setdefault
+
+
+@functools.total_ordering
+class Visit:
+    """
+    One visit read out of a PatientStore, with the vitals as attributes.
+
+    The date is kept as its day ordinal; date gives it as a 'yyyy-mm-dd' string,
+    shared by every visit on that day through ordinalToDate's cache. Ordinals
+    and temperatures are interned too, so a visit costs little more than its
+    seven slots. For existing
+    callers a Visit also behaves like the old list:
+    [date (str), temperature, heart rate, respiratory rate, systolic blood pressure, diastolic blood pressure, oxygen saturation].
+    """
+
+    __slots__ = ('dateOrdinal', 'temperature', 'heartRate', 'respiratoryRate', 'systolicBloodPressure',
+                 'diastolicBloodPressure', 'oxygenSaturation')
+
+    def __init__(self, dateOrdinal, temperature, heartRate, respiratoryRate, systolicBloodPressure,
+                 diastolicBloodPressure, oxygenSaturation):
+        self.dateOrdinal = dateOrdinal
+        self.temperature = temperature
+        self.heartRate = heartRate
+        self.respiratoryRate = respiratoryRate
+        self.systolicBloodPressure = systolicBloodPressure
+        self.diastolicBloodPressure = diastolicBloodPressure
+        self.oxygenSaturation = oxygenSaturation
+
+    @property
+    def date(self):
+        return ordinalToDate(self.dateOrdinal)
+
+    def astuple(self):
+        """
+        Returns the visit in the old list order, as a tuple.
+        """
+        return (ordinalToDate(self.dateOrdinal), self.temperature, self.heartRate, self.respiratoryRate,
+                self.systolicBloodPressure, self.diastolicBloodPressure, self.oxygenSaturation)
+
+    #Sequence view kept for existing callers
+    def __getitem__(self, index):
+        return self.astuple()[index]
+
+    def __iter__(self):
+        return iter(self.astuple())
+
+    def __len__(self):
+        return 7
+
+    def __eq__(self, other):
+        if isinstance(other, (Visit, list, tuple)):
+            return self.astuple() == tuple(other)
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, (Visit, list, tuple)):
+            return self.astuple() < tuple(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return (f"Visit(date={self.date!r}, temperature={self.temperature!r}, heartRate={self.heartRate!r}, "
+                f"respiratoryRate={self.respiratoryRate!r}, systolicBloodPressure={self.systolicBloodPressure!r}, "
+                f"diastolicBloodPressure={self.diastolicBloodPressure!r}, oxygenSaturation={self.oxygenSaturation!r})")
+
+
+class CopyOnWrite:
+    """
+    Tracks what a frozen copy still shares with the structure it was taken from.
+
+    After freeze(), writable() copies the containers the frozen copy shares the
+    first time they are changed, and writableValue() then copies each value of a
+    dictionary the first time it is changed. Until the first freeze() nothing is
+    shared and nothing is copied.
+    """
+
+    def __init__(self):
+        #Whether a frozen copy shares the containers
+        self.shared = False
+        #Keys whose values were copied since the last freeze(), or None before the first one
+        self.owned = None
+
+    def freeze(self):
+        """
+        Marks the containers as shared with a new frozen copy; returns the CopyOnWrite for that copy.
+        """
+        self.shared = True
+        frozen = CopyOnWrite()
+        frozen.shared = True
+        return frozen
+
+    def reset(self):
+        """
+        Forgets every frozen copy, for when the containers are replaced by new ones.
+        """
+        self.shared = False
+        self.owned = None
+
+    def writable(self, *containers):
+        """
+        Returns the containers frozen together, each copied first if a frozen copy still shares it.
+
+        return: The one container, or a tuple of them when given more than one.
+        """
+        if self.shared:
+            containers = tuple(map(copy.copy, containers))
+            self.owned = set()
+            self.shared = False
+        return containers[0] if len(containers) == 1 else containers
+
+    def writableValue(self, data, key, copyValue):
+        """
+        Returns data[key], or None if it is missing, first copied with copyValue if a frozen copy may share it.
+
+        data: A dictionary already returned by writable().
+        """
+        value = data.get(key)
+        if self.owned is not None and key not in self.owned:
+            if value is not None:
+                value = data[key] = copyValue(value)
+            self.owned.add(key)
+        return value
+
+
+class PatientStore(Mapping):
+    """
+    Columnar in-memory store of patient visits.
+
+    Each vital sign is kept in its own typed array (temperature as float32, the
+    other vitals as int16) and visit dates are kept as integer day ordinals.
+    Every patient ID maps to the row ranges that hold its visits, so a single
+    patient can be read without scanning anybody else's visits.
+
+    For existing callers the store still behaves like the old dictionary:
+    store[patientId] returns that patient's visits, as Visit records that can
+    also be indexed like the old lists.
+    """
+
+    #Attribute name and array type code of every column
+    COLUMNS = (('patientIds', 'q'), ('dates', 'i'), ('temperature', 'f'), ('heartRate', 'h'),
+               ('respiratoryRate', 'h'), ('systolicBloodPressure', 'h'),
+               ('diastolicBloodPressure', 'h'), ('oxygenSaturation', 'h'))
+
+    def __init__(self):
+        self.patientIds = array('q')
+        self.dates = array('i')
+        self.temperature = array('f')
+        self.heartRate = array('h')
+        self.respiratoryRate = array('h')
+        self.systolicBloodPressure = array('h')
+        self.diastolicBloodPressure = array('h')
+        self.oxygenSaturation = array('h')
+        #1 for every row that still belongs to a patient, 0 once it has been deleted
+        self.alive = bytearray()
+        #patientId -> list of (start, stop) row ranges, in visit order
+        self.ranges = {}
+        self.visitCount = 0
+        #Set by readPatientsFromFile to notice changes made by other processes
+        self.watcher = None
+        #Set by PatientRepository.load to where changes are saved
+        self.repository = None
+        #Lines of the file that were rejected while loading
+        self.loadReport = LoadReport()
+        #The mmap of a snapshot while the columns are read-only views of it
+        self.mapped = None
+        #Built by getDateIndex the first time visits are searched by date
+        self.dateIndex = None
+        #Built by getAggregates the first time statistics are asked for
+        self.aggregates = None
+        #Built by getFollowUpEngine the first time follow-ups are looked for
+        self.followUp = None
+        #Built by getRollups the first time monthly statistics are asked for
+        self.rollups = None
+        #Built by getIdIndex the first time patients are looked for by ID range
+        self.idIndex = None
+        #Set by PatientRepository.load to the PatientArchive of the visits moved out of the store
+        self.archive = None
+        #Counts changes; every StoreSnapshot records the version it was taken at
+        self.version = 0
+        #The last StoreSnapshot taken, and what it still shares of the ranges and alive flags
+        self.published = None
+        self.rangesSharing = CopyOnWrite()
+        self.aliveSharing = CopyOnWrite()
+
+    @property
+    def vitals(self):
+        """
+        The six vital sign columns in file order.
+        """
+        return (self.temperature, self.heartRate, self.respiratoryRate,
+                self.systolicBloodPressure, self.diastolicBloodPressure, self.oxygenSaturation)
+
+    @property
+    def rowCount(self):
+        """
+        The number of rows held in the columns, including deleted ones.
+        """
+        return len(self.dates)
+
+    def append(self, patientId, dateOrdinal, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Appends one visit to the store and returns its row number.
+        """
+        self.ensureWritable()
+        row = len(self.dates)
+        self.patientIds.append(patientId)
+        self.dates.append(dateOrdinal)
+        self.temperature.append(temp)
+        self.heartRate.append(int(round(hr)))
+        self.respiratoryRate.append(int(round(rr)))
+        self.systolicBloodPressure.append(int(round(sbp)))
+        self.diastolicBloodPressure.append(int(round(dbp)))
+        self.oxygenSaturation.append(int(round(spo2)))
+        self.alive.append(1)
+        self.visitCount += 1
+        self.version += 1
+
+        self._addRange(patientId, row, row + 1)
+        if self.dateIndex is not None:
+            self.dateIndex.add((row,))
+        if self.aggregates is not None:
+            self.aggregates.addRuns(self, [(patientId, row, row + 1)])
+        if self.rollups is not None:
+            self.rollups.addRuns(self, [(patientId, row, row + 1)])
+        if self.followUp is not None:
+            self.followUp.touch(patientId)
+        return row
+
+    def extend(self, patientIds, dates, temperature, heartRate, respiratoryRate,
+               systolicBloodPressure, diastolicBloodPressure, oxygenSaturation):
+        """
+        Appends whole columns of visits at once, as produced by parsePatientLines.
+        """
+        self.ensureWritable()
+        start = len(self.dates)
+        count = len(patientIds)
+        self.patientIds.extend(patientIds)
+        self.dates.extend(dates)
+        self.temperature.extend(temperature)
+        self.heartRate.extend(heartRate)
+        self.respiratoryRate.extend(respiratoryRate)
+        self.systolicBloodPressure.extend(systolicBloodPressure)
+        self.diastolicBloodPressure.extend(diastolicBloodPressure)
+        self.oxygenSaturation.extend(oxygenSaturation)
+        self.alive.extend(b'\x01' * count)
+        self.visitCount += count
+        self.version += 1
+
+        #One range per run of consecutive visits of the same patient
+        runs = []
+        row = start
+        for patientId, run in groupby(patientIds):
+            length = sum(1 for _ in run)
+            self._addRange(patientId, row, row + length)
+            if self.followUp is not None:
+                self.followUp.touch(patientId)
+            runs.append((patientId, row, row + length))
+            row += length
+        #The statistics take the whole batch at once, a column at a time
+        if runs and self.aggregates is not None:
+            self.aggregates.addRuns(self, runs)
+        if runs and self.rollups is not None:
+            self.rollups.addRuns(self, runs)
+        if self.dateIndex is not None:
+            self.dateIndex.add(range(start, start + count))
+
+    def getDateIndex(self):
+        """
+        Returns the DateIndex of the store, building it the first time it is needed.
+        """
+        if self.dateIndex is None:
+            self.dateIndex = DateIndex(self)
+        return self.dateIndex
+
+    def getIdIndex(self):
+        """
+        Returns the PatientIdIndex of the store, building it the first time it is needed.
+        """
+        if self.idIndex is None:
+            self.idIndex = PatientIdIndex(self)
+        return self.idIndex
+
+    def getAggregates(self):
+        """
+        Returns the VitalAggregates of the store, building them the first time they are needed.
+        """
+        if self.aggregates is None:
+            self.aggregates = VitalAggregates(self)
+        return self.aggregates
+
+    def getRollups(self):
+        """
+        Returns the MonthlyRollups of the store, building them the first time they are needed.
+        """
+        if self.rollups is None:
+            self.rollups = MonthlyRollups(self)
+        return self.rollups
+
+    def getFollowUpEngine(self):
+        """
+        Returns the FollowUpEngine with the default rules, creating it the first time it is needed.
+        """
+        if self.followUp is None:
+            self.followUp = FollowUpEngine()
+        return self.followUp
+
+    def ensureWritable(self):
+        """
+        Copies columns mapped from a snapshot into arrays, before the first change to them.
+        """
+        if self.mapped is None:
+            return
+        for name, typecode in self.COLUMNS:
+            column = array(typecode)
+            column.frombytes(getattr(self, name).cast('B'))
+            setattr(self, name, column)
+        self.mapped = None
+
+    def snapshot(self):
+        """
+        Returns a StoreSnapshot of the store as it is now.
+
+        Taking one costs O(1); the store copies what the snapshot shares only when
+        it next changes it. Only the thread that changes the store may call this.
+        """
+        if self.published is None or self.published.version != self.version:
+            self.published = StoreSnapshot(self)
+            self.rangesSharing.freeze()
+            self.aliveSharing.freeze()
+        return self.published
+
+    def _writableRanges(self, patientId):
+        #Copies the ranges dictionary, and then the patient's list, if the last snapshot still shares them
+        self.ranges = self.rangesSharing.writable(self.ranges)
+        return self.rangesSharing.writableValue(self.ranges, patientId, list)
+
+    def _addRange(self, patientId, start, stop):
+        #Growing the patient's last range when the new rows sit right after it
+        patientRanges = self._writableRanges(patientId)
+        if patientRanges is None:
+            self.ranges[patientId] = [(start, stop)]
+            if self.idIndex is not None:
+                self.idIndex.add(patientId)
+        elif patientRanges[-1][1] == start:
+            patientRanges[-1] = (patientRanges[-1][0], stop)
+        else:
+            patientRanges.append((start, stop))
+
+    def rowsOf(self, patientId):
+        """
+        Yields the row numbers of every visit of a patient, in visit order.
+        """
+        for start, stop in self.ranges.get(patientId, ()):
+            yield from range(start, stop)
+
+    def rows(self):
+        """
+        Yields the row numbers of every live visit, grouped by patient.
+        """
+        for patientRanges in self.ranges.values():
+            for start, stop in patientRanges:
+                yield from range(start, stop)
+
+    def groupedRows(self):
+        """
+        Returns every live row grouped by patient, for gathering whole columns in that order.
+
+        return: The patient IDs, the rows of one patient after another, and the
+                (start, stop) of each patient's rows in that list.
+        """
+        rows = []
+        bounds = []
+        for patientRanges in self.ranges.values():
+            start = len(rows)
+            for first, stop in patientRanges:
+                rows.extend(range(first, stop))
+            bounds.append((start, len(rows)))
+        return list(self.ranges), rows, bounds
+
+    def visit(self, row):
+        """
+        Returns the visit stored at a row as a Visit.
+        """
+        temperature = round(self.temperature[row], 2)
+        return Visit(internOrdinal(self.dates[row], self.dates[row]), internTemperature(temperature, temperature),
+                     self.heartRate[row],
+                     self.respiratoryRate[row], self.systolicBloodPressure[row],
+                     self.diastolicBloodPressure[row], self.oxygenSaturation[row])
+
+    def deletePatient(self, patientId):
+        """
+        Removes every visit of a patient and returns how many were removed.
+
+        The rows stay in the columns until the next compact().
+        """
+        if self.aggregates is not None:
+            self.aggregates.removePatient(self, patientId)
+        if self.rollups is not None:
+            self.rollups.removePatient(patientId)
+        if self.followUp is not None:
+            self.followUp.touch(patientId)
+        self._writableRanges(patientId)
+        patientRanges = self.ranges.pop(patientId, ())
+        if patientRanges and self.idIndex is not None:
+            self.idIndex.remove(patientId)
+        self.alive = self.aliveSharing.writable(self.alive)
+        removed = 0
+        for start, stop in patientRanges:
+            self.alive[start:stop] = bytes(stop - start)
+            removed += stop - start
+        self.visitCount -= removed
+        self.version += 1
+        if self.dateIndex is not None:
+            self.dateIndex.removed(removed)
+        if self.rowCount > 1024 and self.visitCount < self.rowCount // 2:
+            self.compact()
+        return removed
+
+    def liveCopy(self):
+        """
+        Returns a new PatientStore of the live visits, with each patient's visits in one contiguous range.
+        """
+        compacted = PatientStore()
+        for patientId in self.ranges:
+            for row in self.rowsOf(patientId):
+                compacted.append(patientId, self.dates[row], self.temperature[row], self.heartRate[row],
+                                 self.respiratoryRate[row], self.systolicBloodPressure[row],
+                                 self.diastolicBloodPressure[row], self.oxygenSaturation[row])
+        return compacted
+
+    def compact(self):
+        """
+        Rewrites the columns without deleted rows, with each patient's visits in one contiguous range.
+        """
+        compacted = self.liveCopy()
+        #The statistics do not depend on row numbers, unlike the date index
+        compacted.aggregates = self.aggregates
+        compacted.rollups = self.rollups
+        compacted.idIndex = self.idIndex
+        self.adopt(compacted)
+
+    def adopt(self, other):
+        """
+        Takes over the visits of another store, so references to this store see them.
+
+        Snapshots taken before keep the columns they were taken from.
+        """
+        watcher, repository, archive, version = self.watcher, self.repository, self.archive, self.version
+        self.__dict__.update(other.__dict__)
+        self.watcher, self.repository, self.archive = watcher, repository, archive
+        self.version = max(version, other.version) + 1
+        self.published = None
+        self.rangesSharing = CopyOnWrite()
+        self.aliveSharing = CopyOnWrite()
+
+    #Dictionary view kept for existing callers
+    def __getitem__(self, patientId):
+        if patientId not in self.ranges:
+            raise KeyError(patientId)
+        return [self.visit(row) for row in self.rowsOf(patientId)]
+
+    def __delitem__(self, patientId):
+        if patientId not in self.ranges:
+            raise KeyError(patientId)
+        self.deletePatient(patientId)
+
+    def __contains__(self, patientId):
+        return patientId in self.ranges
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+
+class StoreSnapshot(PatientStore):
+    """
+    Read-only view of a PatientStore as it was at one version.
+
+    Shares the store's columns, which only ever grow, and its ranges, alive flags,
+    date index, ID index and statistics (running and monthly), which the store copies before changing them again
+    (per patient for ranges and statistics). A snapshot therefore never changes
+    and can be read from any thread, without locks, while the store keeps taking
+    writes. It is used like the store itself for every query.
+    """
+
+    def __init__(self, patients):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, getattr(patients, name))
+        self.alive = patients.alive
+        self.ranges = patients.ranges
+        self.visitCount = patients.visitCount
+        self.snapshotRows = patients.rowCount
+        self.version = patients.version
+        self.loadReport = patients.loadReport
+        self.mapped = patients.mapped
+        self.watcher = None
+        self.repository = None
+        self.archive = patients.archive
+        self.published = self
+        self.dateIndex = patients.dateIndex.freeze(self) if patients.dateIndex is not None else None
+        self.aggregates = patients.aggregates.freeze() if patients.aggregates is not None else None
+        self.rollups = patients.rollups.freeze() if patients.rollups is not None else None
+        self.idIndex = patients.idIndex.freeze() if patients.idIndex is not None else None
+        self.followUp = None
+        #Serializes building the date index, statistics and follow-ups on first use
+        self.lock = threading.Lock()
+
+    @property
+    def rowCount(self):
+        return self.snapshotRows
+
+    def snapshot(self):
+        return self
+
+    def getDateIndex(self):
+        with self.lock:
+            return super().getDateIndex()
+
+    def getAggregates(self):
+        with self.lock:
+            return super().getAggregates()
+
+    def getRollups(self):
+        with self.lock:
+            return super().getRollups()
+
+    def getIdIndex(self):
+        with self.lock:
+            return super().getIdIndex()
+
+    def getFollowUpEngine(self):
+        """
+        Returns a FollowUpEngine already evaluated over the snapshot, so callers only read it.
+        """
+        with self.lock:
+            if self.followUp is None:
+                engine = FollowUpEngine()
+                engine.evaluate(self)
+                self.followUp = engine
+            return self.followUp
+
+    def readOnly(self, *args):
+        raise TypeError("A StoreSnapshot cannot be changed; change the PatientStore it was taken from")
+
+    append = extend = deletePatient = compact = adopt = ensureWritable = __delitem__ = readOnly
+
+
+class DateIndex:
+    """
+    Sorted index of the visit dates of a PatientStore.
+
+    Keeps the date ordinals of all visits in ascending order with the row of each
+    visit alongside, so any date range is found with two binary searches and read
+    off in O(log n + k). Rows added to the store wait in a pending list and are
+    merged in when the index is next read, a few at a time by insertion and larger
+    batches by sorting only the new rows and splicing them in date by date.
+    Deleted rows are skipped when read and the index is rebuilt once they make up
+    half of it. compact() renumbers the rows, so it drops the index instead.
+    """
+
+    #Pending batches larger than this are spliced in rather than inserted one by one
+    INSERT_LIMIT = 64
+
+    def __init__(self, patients):
+        self.patients = patients
+        self.build()
+
+    def build(self):
+        """
+        Sorts every live row of the store by date.
+        """
+        dates = self.patients.dates
+        rows = sorted(self.patients.rows(), key=dates.__getitem__)
+        self.rows = array('q', rows)
+        self.ordinals = array('i', [dates[row] for row in rows])
+        self.pending = []
+        self.deadCount = 0
+        #What a frozen copy still shares of the arrays
+        self.sharing = CopyOnWrite()
+
+    def freeze(self, patients):
+        """
+        Returns a read-only copy for a StoreSnapshot, sharing the arrays until this index next changes them.
+        """
+        self.merge()
+        frozen = DateIndex.__new__(DateIndex)
+        frozen.patients = patients
+        frozen.rows = self.rows
+        frozen.ordinals = self.ordinals
+        frozen.pending = []
+        frozen.deadCount = self.deadCount
+        frozen.sharing = self.sharing.freeze()
+        return frozen
+
+    def add(self, rows):
+        """
+        Adds newly appended rows of the store to the index, to be merged in when it is next read.
+        """
+        self.pending.extend(rows)
+
+    def merge(self):
+        """
+        Merges the pending rows into the sorted arrays.
+        """
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = []
+        dates = self.patients.dates
+        if len(pending) <= self.INSERT_LIMIT:
+            self.rows, self.ordinals = self.sharing.writable(self.rows, self.ordinals)
+            for row in pending:
+                i = bisect_right(self.ordinals, dates[row])
+                self.ordinals.insert(i, dates[row])
+                self.rows.insert(i, row)
+            return
+        #Only the new rows are sorted; the old arrays are copied over in one slice per distinct new date
+        pending.sort(key=dates.__getitem__)
+        rows = array('q')
+        ordinals = array('i')
+        start = 0
+        for ordinal, group in groupby(pending, key=dates.__getitem__):
+            stop = bisect_right(self.ordinals, ordinal, start)
+            rows += self.rows[start:stop]
+            ordinals += self.ordinals[start:stop]
+            size = len(rows)
+            rows.extend(group)
+            ordinals.extend(repeat(ordinal, len(rows) - size))
+            start = stop
+        rows += self.rows[start:]
+        ordinals += self.ordinals[start:]
+        self.rows = rows
+        self.ordinals = ordinals
+        self.sharing.reset()
+
+    def removed(self, count):
+        """
+        Notes that count rows of the store were deleted, rebuilding once half of the index is stale.
+        """
+        self.deadCount += count
+        if self.deadCount * 2 > len(self.rows) + len(self.pending):
+            self.build()
+
+    def rowsBetween(self, low, high):
+        """
+        Yields the live rows whose date ordinal is in [low, high), in date order.
+        """
+        self.merge()
+        alive = self.patients.alive
+        rows = self.rows
+        first, last = bisect_left(self.ordinals, low), bisect_left(self.ordinals, high)
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('rows_scanned', last - first, operation='findVisitsByDate')
+        for k in range(first, last):
+            row = rows[k]
+            if alive[row]:
+                yield row
+
+    def yearRange(self):
+        """
+        Returns the first and last year with a visit, or None if the index is empty.
+        """
+        self.merge()
+        if not self.ordinals:
+            return None
+        return ordinalToYearMonth(self.ordinals[0])[0], ordinalToYearMonth(self.ordinals[-1])[0]
+
+
+class PatientIdIndex:
+    """
+    Sorted patient IDs of a PatientStore, so any range of IDs is found with two binary searches.
+
+    The store inserts a patient's ID when its first visit is added and removes it
+    when the patient is deleted.
+    """
+
+    def __init__(self, patients):
+        self.ids = array('q', sorted(patients.ranges))
+        #What a frozen copy still shares of the array
+        self.sharing = CopyOnWrite()
+
+    def freeze(self):
+        """
+        Returns a read-only copy for a StoreSnapshot, sharing the array until this index next changes it.
+        """
+        frozen = PatientIdIndex.__new__(PatientIdIndex)
+        frozen.ids = self.ids
+        frozen.sharing = self.sharing.freeze()
+        return frozen
+
+    def _writableIds(self):
+        self.ids = self.sharing.writable(self.ids)
+        return self.ids
+
+    def add(self, patientId):
+        ids = self._writableIds()
+        ids.insert(bisect_left(ids, patientId), patientId)
+
+    def remove(self, patientId):
+        ids = self._writableIds()
+        i = bisect_left(ids, patientId)
+        if i < len(ids) and ids[i] == patientId:
+            del ids[i]
+
+    def between(self, low=None, high=None):
+        """
+        Returns the IDs in [low, high] in ascending order; None leaves that end open.
+        """
+        first = 0 if low is None else bisect_left(self.ids, low)
+        last = len(self.ids) if high is None else bisect_right(self.ids, high)
+        return self.ids[first:last].tolist()
+
+
+class CollectorPaused:
+    """
+    Context manager that turns the cyclic garbage collector off while it is entered.
+
+    Building statistics creates hundreds of thousands of small lists, and every few
+    hundred of them would otherwise set off a collection that walks all the objects
+    already alive. Nothing made meanwhile is cyclic, so nothing is lost.
+    """
+
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            gc.enable()
+
+
+class RunningStats:
+    """
+    Count, sum, sum of squares, minimum and maximum of each vital sign over a group of visits.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sums = [0.0] * 6
+        self.squares = [0.0] * 6
+        self.minimums = [math.inf] * 6
+        self.maximums = [-math.inf] * 6
+
+    def addRows(self, patients, start, stop):
+        """
+        Adds the visits in rows [start, stop) of a PatientStore.
+        """
+        self.addValues([column[start:stop] for column in patients.vitals])
+
+    def addValues(self, vitals):
+        """
+        Adds visits given as one non-empty sequence of values per vital sign, in file order.
+        """
+        self.count += len(vitals[0])
+        for i, values in enumerate(vitals):
+            self.sums[i] += sum(values)
+            self.squares[i] += sum(map(mul, values, values))
+            self.minimums[i] = min(self.minimums[i], min(values))
+            self.maximums[i] = max(self.maximums[i], max(values))
+
+    @classmethod
+    def forGroups(cls, vitals, bounds):
+        """
+        Returns the statistics of consecutive groups of visits, computed a column at a time.
+
+        A group of one visit is read straight off each column. Larger groups are
+        cut out of each column once, and their sums, sums of squares, minimums and
+        maximums are taken with one map each.
+        vitals: One sequence per vital sign, holding the groups one after another.
+        bounds: The (start, stop) of every group in the sequences; no group is empty.
+        return: One statistics object per group, in the order of bounds.
+        """
+        starts = [start for start, stop in bounds]
+        larger = [k for k, (start, stop) in enumerate(bounds) if stop - start > 1]
+        slices = [slice(*bounds[k]) for k in larger]
+        columns = []
+        for values in vitals:
+            sums = list(map(values.__getitem__, starts))
+            squares = list(map(mul, sums, sums))
+            minimums, maximums = list(sums), list(sums)
+            if larger:
+                chunks = list(map(values.__getitem__, slices))
+                for k, total, square, low, high in zip(larger, map(sum, chunks), map(sum, map(map, repeat(mul), chunks, chunks)),
+                                                       map(min, chunks), map(max, chunks)):
+                    sums[k], squares[k], minimums[k], maximums[k] = total, square, low, high
+            columns.append((sums, squares, minimums, maximums))
+        groups = []
+        for (start, stop), sums, squares, minimums, maximums in zip(bounds, *(zip(*part) for part in zip(*columns))):
+            stats = cls.__new__(cls)
+            stats.count = stop - start
+            stats.sums, stats.squares = list(sums), list(squares)
+            stats.minimums, stats.maximums = list(minimums), list(maximums)
+            groups.append(stats)
+        return groups
+
+    def merge(self, other):
+        """
+        Adds the visits counted by another RunningStats.
+        """
+        self.count += other.count
+        for i in range(6):
+            self.sums[i] += other.sums[i]
+            self.squares[i] += other.squares[i]
+            self.minimums[i] = min(self.minimums[i], other.minimums[i])
+            self.maximums[i] = max(self.maximums[i], other.maximums[i])
+
+    def copy(self):
+        stats = RunningStats()
+        stats.count = self.count
+        stats.sums, stats.squares = list(self.sums), list(self.squares)
+        stats.minimums, stats.maximums = list(self.minimums), list(self.maximums)
+        return stats
+
+    def summary(self):
+        """
+        Returns a VitalStatistics for each vital sign, or None if there are no visits.
+
+        Temperatures are summed as 32-bit floats, so every value is rounded: the
+        minimum and maximum to the decimals of the file, the average and standard
+        deviation to EXTRA_DECIMALS more.
+        """
+        if self.count == 0:
+            return None
+        vitals = {}
+        for i, ((name, low, high), decimals) in enumerate(zip(VITAL_RULES, VITAL_DECIMALS)):
+            average = self.sums[i] / self.count
+            variance = max(0.0, self.squares[i] / self.count - average * average)
+            vitals[name] = VitalStatistics(round(average, decimals + EXTRA_DECIMALS),
+                                           round(math.sqrt(variance), decimals + EXTRA_DECIMALS),
+                                           round(self.minimums[i], decimals or None),
+                                           round(self.maximums[i], decimals or None))
+        return vitals
+
+
+class VitalAggregates:
+    """
+    Running statistics of the vital signs of a PatientStore, per patient and for everybody.
+
+    The store updates them on every add and delete, so getStats answers in constant
+    time. Sums and sums of squares are simply subtracted when a patient is deleted.
+    Overall minimums and maximums come from a count of each distinct value, which
+    stays small because vitals are whole numbers or tenths of a degree.
+    """
+
+    def __init__(self, patients):
+        self.overall = RunningStats()
+        self.byPatient = {}
+        self.histograms = [Counter() for _ in range(6)]
+        #What a frozen copy still shares of byPatient, as for PatientStore ranges
+        self.sharing = CopyOnWrite()
+        with CollectorPaused():
+            patientIds, rows, bounds = patients.groupedRows()
+            if rows:
+                #tolist() unboxes each column once, sequentially, instead of once per row picked
+                self.addGroups(patientIds, [list(map(column.tolist().__getitem__, rows)) for column in patients.vitals],
+                               bounds)
+
+    def freeze(self):
+        """
+        Returns a read-only copy for a StoreSnapshot, which only answers from overall and byPatient.
+        """
+        frozen = VitalAggregates.__new__(VitalAggregates)
+        frozen.overall = self.overall.copy()
+        frozen.byPatient = self.byPatient
+        frozen.histograms = None
+        frozen.sharing = self.sharing.freeze()
+        return frozen
+
+    def writableStats(self, patientId):
+        """
+        Returns a patient's RunningStats, first copying whatever a frozen copy still shares.
+        """
+        self.byPatient = self.sharing.writable(self.byPatient)
+        return self.sharing.writableValue(self.byPatient, patientId, RunningStats.copy)
+
+    def addRuns(self, patients, runs):
+        """
+        Adds a batch of visits just appended to the store.
+
+        runs: The (patientId, start, stop) of every run of one patient's rows, consecutive and in row order.
+        """
+        first, last = runs[0][1], runs[-1][2]
+        self.addGroups([run[0] for run in runs], [column[first:last] for column in patients.vitals],
+                       [(start - first, stop - first) for _, start, stop in runs])
+
+    def addGroups(self, patientIds, vitals, bounds):
+        """
+        Adds groups of visits, each of one patient.
+
+        patientIds: The patient of every group.
+        vitals: One sequence per vital sign, holding the groups one after another.
+        bounds: The (start, stop) of every group in the sequences.
+        """
+        with CollectorPaused():
+            for patientId, added in zip(patientIds, RunningStats.forGroups(vitals, bounds)):
+                stats = self.writableStats(patientId)
+                if stats is None:
+                    self.byPatient[patientId] = added
+                else:
+                    stats.merge(added)
+        self.overall.addValues(vitals)
+        for histogram, values in zip(self.histograms, vitals):
+            histogram.update(values)
+
+    def removePatient(self, patients, patientId):
+        """
+        Takes every visit of a patient out of the statistics; called before the store forgets them.
+        """
+        self.writableStats(patientId)
+        stats = self.byPatient.pop(patientId, None)
+        if stats is None:
+            return
+        overall = self.overall
+        overall.count -= stats.count
+        for i, (histogram, column) in enumerate(zip(self.histograms, patients.vitals)):
+            overall.sums[i] -= stats.sums[i]
+            overall.squares[i] -= stats.squares[i]
+            for start, stop in patients.ranges[patientId]:
+                histogram.subtract(column[start:stop])
+            for value in [value for value, count in histogram.items() if count <= 0]:
+                del histogram[value]
+            #Only a patient holding the overall extreme can move it
+            if stats.minimums[i] <= overall.minimums[i]:
+                overall.minimums[i] = min(histogram, default=math.inf)
+            if stats.maximums[i] >= overall.maximums[i]:
+                overall.maximums[i] = max(histogram, default=-math.inf)
+
+
+def changeBounds(keys):
+    """
+    Returns the (start, stop) of every run of equal values in a sorted list.
+    """
+    starts = [0, *compress(range(1, len(keys)), map(ne, keys[1:], keys))]
+    return list(zip(starts, starts[1:] + [len(keys)]))
+
+
+class MonthlyStats(RunningStats):
+    """
+    RunningStats of the visits in one month, with how many visits broke each of ABNORMAL_RULES.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.abnormal = [0] * len(ABNORMAL_RULES)
+        #Visits that broke at least one of the rules
+        self.abnormalVisits = 0
+
+    def addValues(self, vitals):
+        super().addValues(vitals)
+        anyFlags = 0
+        for i, rule in enumerate(ABNORMAL_RULES):
+            flags = rule.flags(vitals[rule.index])
+            self.abnormal[i] += flags.count(1)
+            anyFlags |= int.from_bytes(flags, 'little')
+        self.abnormalVisits += anyFlags.bit_count()
+
+    @classmethod
+    def forGroups(cls, vitals, bounds):
+        groups = super().forGroups(vitals, bounds)
+        #Counts of flags per group are differences of running totals of the flags
+        starts = [start for start, stop in bounds]
+        stops = [stop for start, stop in bounds]
+
+        def groupCounts(flags):
+            totals = list(accumulate(flags, initial=0))
+            return map(sub, map(totals.__getitem__, stops), map(totals.__getitem__, starts))
+
+        counts = []
+        anyFlags = 0
+        for rule in ABNORMAL_RULES:
+            flags = rule.flags(vitals[rule.index])
+            counts.append(groupCounts(flags))
+            anyFlags |= int.from_bytes(flags, 'little')
+        abnormalVisits = groupCounts(anyFlags.to_bytes(len(vitals[0]), 'little'))
+        for stats, abnormal, visits in zip(groups, zip(*counts) if counts else repeat(()), abnormalVisits):
+            stats.abnormal = list(abnormal)
+            stats.abnormalVisits = visits
+        return groups
+
+    def merge(self, other):
+        super().merge(other)
+        for i, count in enumerate(other.abnormal):
+            self.abnormal[i] += count
+        self.abnormalVisits += other.abnormalVisits
+
+    def subtract(self, other):
+        """
+        Takes out the counts and sums of another MonthlyStats; minimums and maximums are left to the caller.
+        """
+        self.count -= other.count
+        for i in range(6):
+            self.sums[i] -= other.sums[i]
+            self.squares[i] -= other.squares[i]
+        for i, count in enumerate(other.abnormal):
+            self.abnormal[i] -= count
+        self.abnormalVisits -= other.abnormalVisits
+
+    def copy(self):
+        stats = MonthlyStats()
+        stats.merge(self)
+        return stats
+
+
+class MonthlyRollups:
+    """
+    MonthlyStats of a PatientStore per month, for everybody and per patient.
+
+    Months are numbered year * 12 + month - 1, so a range of months is read off
+    in O(months) whatever the number of visits. The store updates the rollups on
+    every add and delete, a whole batch at a time: the visits are sorted by month
+    and patient, and the MonthlyStats of every patient's month and of every month
+    are computed a column at a time. The per-patient months are the source of truth for
+    minimums and maximums: deleting a patient recomputes the overall minimum or
+    maximum of a month from the other patients of that month, and only when the
+    deleted patient held it.
+    """
+
+    def __init__(self, patients):
+        #month -> MonthlyStats of everybody
+        self.byMonth = {}
+        #patientId -> {month -> MonthlyStats}
+        self.byPatient = {}
+        #month -> IDs of the patients with visits in it
+        self.patientsByMonth = {}
+        #What a frozen copy still shares of byMonth and of byPatient, as for VitalAggregates
+        self.monthSharing = CopyOnWrite()
+        self.patientSharing = CopyOnWrite()
+        with CollectorPaused():
+            patientIds, rows, bounds = patients.groupedRows()
+            if rows:
+                self.addGroups(patients, patientIds, rows, bounds)
+
+    def freeze(self):
+        """
+        Returns a read-only copy for a StoreSnapshot, sharing everything until these rollups next change it.
+        """
+        frozen = MonthlyRollups.__new__(MonthlyRollups)
+        frozen.byMonth = self.byMonth
+        frozen.byPatient = self.byPatient
+        frozen.patientsByMonth = None
+        frozen.monthSharing = self.monthSharing.freeze()
+        frozen.patientSharing = self.patientSharing.freeze()
+        return frozen
+
+    def _unshare(self):
+        self.byMonth = self.monthSharing.writable(self.byMonth)
+        self.byPatient = self.patientSharing.writable(self.byPatient)
+
+    def writableMonth(self, month):
+        """
+        Returns the overall MonthlyStats of a month, creating it or first copying it if a frozen copy shares it.
+        """
+        self._unshare()
+        stats = self.monthSharing.writableValue(self.byMonth, month, MonthlyStats.copy)
+        if stats is None:
+            stats = self.byMonth[month] = MonthlyStats()
+        return stats
+
+    def writableMonths(self, patientId):
+        """
+        Returns the months of a patient, creating them or first copying them if a frozen copy shares them.
+        """
+        self._unshare()
+        months = self.patientSharing.writableValue(
+            self.byPatient, patientId, lambda months: {month: stats.copy() for month, stats in months.items()})
+        if months is None:
+            months = self.byPatient[patientId] = {}
+        return months
+
+    def addRuns(self, patients, runs):
+        """
+        Adds a batch of visits just appended to the store.
+
+        runs: The (patientId, start, stop) of every run of one patient's rows, consecutive and in row order.
+        """
+        first, last = runs[0][1], runs[-1][2]
+        self.addGroups(patients, [run[0] for run in runs], range(first, last),
+                       [(start - first, stop - first) for _, start, stop in runs])
+
+    def addGroups(self, patients, patientIds, rows, bounds):
+        """
+        Adds groups of visits of the store, each of one patient.
+
+        patientIds: The patient of every group.
+        rows: The rows of the visits, holding the groups one after another.
+        bounds: The (start, stop) of every group in rows, consecutive from the start.
+        """
+        with CollectorPaused():
+            self._addGroups(patients, patientIds, rows, bounds)
+
+    def _addGroups(self, patients, patientIds, rows, bounds):
+        #A batch just appended is one slice of each column; otherwise each whole column is unboxed once with tolist()
+        if isinstance(rows, range):
+            columns = [column[rows.start:rows.stop].tolist() for column in (patients.dates, *patients.vitals)]
+            dates = columns[0]
+        else:
+            columns = [column.tolist() for column in (patients.dates, *patients.vitals)]
+            dates = list(map(columns[0].__getitem__, rows))
+        monthOf = {ordinal: ordinalToMonth(ordinal) for ordinal in set(dates)}
+        groupCount = len(bounds)
+        #Sorting on month * groupCount + group puts each month's visits together, patient by patient
+        groupOf = chain.from_iterable(map(repeat, range(groupCount), [stop - start for start, stop in bounds]))
+        keys = list(map(add, map(mul, map(monthOf.__getitem__, dates), repeat(groupCount)), groupOf))
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        keys = list(map(keys.__getitem__, order))
+        picked = order if isinstance(rows, range) else list(map(rows.__getitem__, order))
+        vitals = [list(map(values.__getitem__, picked)) for values in columns[1:]]
+
+        patientMonths = changeBounds(keys)
+        for (start, stop), added in zip(patientMonths, MonthlyStats.forGroups(vitals, patientMonths)):
+            month, group = divmod(keys[start], groupCount)
+            patientId = patientIds[group]
+            months = self.writableMonths(patientId)
+            stats = months.get(month)
+            if stats is None:
+                months[month] = added
+            else:
+                stats.merge(added)
+            self.patientsByMonth.setdefault(month, set()).add(patientId)
+
+        months = list(map(floordiv, keys, repeat(groupCount)))
+        monthBounds = changeBounds(months)
+        for (start, stop), added in zip(monthBounds, MonthlyStats.forGroups(vitals, monthBounds)):
+            self.writableMonth(months[start]).merge(added)
+
+    def removePatient(self, patientId):
+        """
+        Takes every visit of a patient out of the rollups.
+        """
+        self._unshare()
+        months = self.byPatient.pop(patientId, None)
+        if months is None:
+            return
+        for month, stats in months.items():
+            members = self.patientsByMonth[month]
+            members.discard(patientId)
+            if not members:
+                del self.patientsByMonth[month]
+                del self.byMonth[month]
+                continue
+            overall = self.writableMonth(month)
+            overall.subtract(stats)
+            for i in range(6):
+                if stats.minimums[i] <= overall.minimums[i]:
+                    overall.minimums[i] = min(self.byPatient[member][month].minimums[i] for member in members)
+                if stats.maximums[i] >= overall.maximums[i]:
+                    overall.maximums[i] = max(self.byPatient[member][month].maximums[i] for member in members)
+
+    def months(self, first=None, last=None, patientId=None):
+        """
+        Yields (month, MonthlyStats) for every month in [first, last] with visits, in order.
+
+        first: The first month number, or None to start at the earliest visit.
+        last: The last month number, or None to end at the latest visit.
+        patientId: The ID of the patient, or None for everybody.
+        """
+        stats = self.byMonth if patientId is None else self.byPatient.get(patientId, {})
+        if not stats:
+            return
+        first = min(stats) if first is None else first
+        last = max(stats) if last is None else last
+        if last - first + 1 > len(stats):
+            wanted = sorted(month for month in stats if first <= month <= last)
+        else:
+            wanted = (month for month in range(first, last + 1) if month in stats)
+        for month in wanted:
+            yield month, stats[month]
+
+
+class DataFileWatcher:
+    """
+    Notices when the patients file has been changed by another process.
+
+    It remembers the size and modification time of the file as of the last read
+    or write made by this program, along with the bytes just before that point.
+    A file that only grew can then be reloaded from where the last read stopped.
+    When given the MutationLog of the file, it watches the log's size and inode too.
+    """
+
+    TAIL_SIZE = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = 0
+        self.mtime = 0
+        self.inode = 0
+        self.tail = b''
+        self.log = None
+
+    def acknowledge(self, size=None):
+        """
+        Records the file as fully loaded, up to size bytes (the whole file by default).
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            self.size, self.mtime, self.inode, self.tail = 0, 0, 0, b''
+            return
+        self.size = stat.st_size if size is None else size
+        self.mtime = stat.st_mtime_ns
+        self.inode = stat.st_ino
+        self.tail = self.readTail()
+
+    def readTail(self):
+        """
+        Returns the bytes of the file just before the last loaded position.
+        """
+        start = max(0, self.size - self.TAIL_SIZE)
+        with open(self.filename, 'rb') as file:
+            file.seek(start)
+            return file.read(self.size - start)
+
+    def check(self):
+        """
+        Returns 'unchanged', 'appended', 'logged' or 'replaced' depending on what happened to the file.
+
+        'logged' means only the log grew; 'appended' says nothing about the log.
+        """
+        change = self.checkFile()
+        if change == 'replaced' or self.log is None:
+            return change
+        logChange = self.log.check()
+        if logChange == 'replaced':
+            return 'replaced'
+        return 'logged' if change == 'unchanged' and logChange == 'appended' else change
+
+    def checkFile(self):
+        """
+        Returns 'unchanged', 'appended' or 'replaced' depending on what happened to the file itself.
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return 'unchanged' if self.size == 0 else 'replaced'
+        if self.inode and stat.st_ino != self.inode:
+            return 'replaced'
+        if stat.st_size == self.size and stat.st_mtime_ns == self.mtime:
+            return 'unchanged'
+        if stat.st_size > self.size and self.readTail() == self.tail:
+            return 'appended'
+        return 'replaced'
+
+
+#Name, lowest and highest accepted value of each vital sign, in file order
+VITAL_RULES = (
+    ('temperature', 35, 42),
+    ('heart rate', 30, 180),
+    ('respiratory rate', 5, 40),
+    ('systolic blood pressure', 70, 200),
+    ('diastolic blood pressure', 40, 120),
+    ('oxygen saturation', 70, 100),
+)
+#Decimals each vital sign is kept with in the patients file, in file order
+VITAL_DECIMALS = (1, 0, 0, 0, 0, 0)
+#Averages and standard deviations keep this many decimals more, well short of where 32-bit floats go wrong
+EXTRA_DECIMALS = 3
+
+#Bytes read from the patients file at a time
+CHUNK_SIZE = 1 << 22
+
+#Stands in for lines with the wrong number of sections so the columns stay aligned
+PLACEHOLDER_LINE = '0,2000-01-01,37,60,12,120,80,98'
+#Patient IDs are stored in a 64-bit column
+PATIENT_ID_MIN = -2 ** 63
+PATIENT_ID_MAX = 2 ** 63 - 1
+
+VitalStatistics = namedtuple('VitalStatistics', ['average', 'stddev', 'minimum', 'maximum'])
+PatientStats = namedtuple('PatientStats', ['patientId', 'count', 'vitals'])
+PeriodStats = namedtuple('PeriodStats', ['first', 'last', 'count', 'vitals', 'abnormal', 'abnormalVisits'])
+
+RejectedRow = namedtuple('RejectedRow', ['lineNumber', 'line', 'reason', 'filename'], defaults=(None,))
+
+
+class LoadReport:
+    """
+    Structured report of the lines rejected while loading a patients file.
+
+    Every rejected line is kept as a RejectedRow of its line number, its text,
+    the first rule it broke (checked in the same order as the columns of the file)
+    and the file it came from.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lineCount = 0
+        self.acceptedCount = 0
+        self.rejected = []
+
+    def reasonCounts(self):
+        """
+        Returns how many lines were rejected for each kind of problem.
+        """
+        return Counter(row.reason.split(' (')[0] for row in self.rejected)
+
+    def summary(self, examples=5):
+        """
+        Returns a short printable description of the rejected lines.
+
+        examples: The number of rejected lines to show in full.
+        """
+        lines = [f"Loaded {self.acceptedCount} of {self.lineCount} lines, rejected {len(self.rejected)}."]
+        for reason, count in self.reasonCounts().most_common():
+            lines.append(f"  {reason}: {count}")
+        for row in self.rejected[:examples]:
+            where = f"{row.filename} line {row.lineNumber}" if row.filename else f"line {row.lineNumber}"
+            lines.append(f"  {where}: {row.reason} in line: {row.line}")
+        return '\n'.join(lines)
+
+
+@functools.lru_cache(maxsize=65536)
+def parseDateCached(dateString):
+    """
+    dateToOrdinal for the parser: the same few thousand dates repeat on every line.
+    """
+    return dateToOrdinal(dateString)
+
+
+def columnTable(texts, convert):
+    """
+    Converts every distinct string of a column once.
+
+    A column repeats the same few hundred values, so checking its distinct strings
+    costs far less than checking every line.
+    texts: The strings of the column.
+    convert: Returns the value of one string, or raises ValueError with the reason it is invalid.
+    return: The table of valid strings to values and the table of invalid strings to reasons.
+    """
+    table = {}
+    invalid = {}
+    for text in set(texts):
+        try:
+            table[text] = convert(text)
+        except ValueError as error:
+            invalid[text] = str(error)
+    return table, invalid
+
+
+def convertPatientId(text):
+    """
+    Converts a patient ID for columnTable. The ID must fit the 64-bit patient ID column.
+    """
+    try:
+        patientId = int(text)
+    except ValueError:
+        patientId = None
+    if patientId is None or not PATIENT_ID_MIN <= patientId <= PATIENT_ID_MAX:
+        raise ValueError(f"Invalid patient ID ({text.strip()})")
+    return patientId
+
+
+def convertDate(text):
+    """
+    Converts a visit date into its day ordinal for columnTable.
+    """
+    try:
+        return parseDateCached(text)
+    except ValueError:
+        raise ValueError(f"Invalid date value ({text.strip()})") from None
+
+
+def vitalConverter(name, low, high, whole):
+    """
+    Returns the conversion of one vital sign column for columnTable.
+
+    name, low, high: The vital sign rule from VITAL_RULES.
+    whole: Whether the vital sign is stored as a whole number.
+    """
+    def convert(text):
+        value = None
+        if whole:
+            try:
+                value = int(text)
+            except ValueError:
+                pass
+        if value is None:
+            try:
+                value = float(text)
+            except ValueError:
+                value = math.nan
+            #nan and inf would slip past the range check and inf cannot be rounded
+            if not math.isfinite(value):
+                raise ValueError(f"Invalid {name} value ({text.strip()})")
+            if whole:
+                value = round(value)
+        if not low <= value <= high:
+            raise ValueError(f"Invalid {name} value ({value})")
+        return value
+
+    return convert
+
+
+def noneIndexes(values):
+    """
+    Yields the indexes of the None entries of a list, searching with list.index.
+    """
+    i = -1
+    while True:
+        try:
+            i = values.index(None, i + 1)
+        except ValueError:
+            return
+        yield i
+
+
+def parsePatientLines(lines, firstLineNumber, report):
+    """
+    Parses a block of lines of the patients file into typed columns.
+
+    The block is split into fields with one split of the joined text. Each column
+    is converted with one map through a table of its distinct strings, so every
+    distinct string is checked once, and the lines that broke a rule are dropped
+    and added to the report.
+    The valid visits come back grouped by patient, each patient's in file order.
+    lines: The lines to parse, without line endings.
+    firstLineNumber: The line number of the first line, for the report.
+    report: The LoadReport collecting rejected lines.
+    return: The patient ID, date and six vital sign columns of the valid lines.
+    """
+    count = len(lines)
+    report.lineCount += count
+    if count == 0:
+        return (array('q'), array('i'), array('f'), *(array('h') for _ in range(5)))
+
+    #Every valid line has exactly 7 commas, so the fields of the block line up in columns of 8
+    reasons = {}
+    commas = list(map(str.count, lines, repeat(',')))
+    cleaned = lines
+    if min(commas) != 7 or max(commas) != 7:
+        cleaned = list(lines)
+        for i in compress(range(count), map((7).__ne__, commas)):
+            reasons[i] = f"Invalid number of sections ({commas[i] + 1})"
+            cleaned[i] = PLACEHOLDER_LINE
+    fields = ','.join(cleaned).split(',')
+    columns = [fields[i::8] for i in range(8)]
+    del fields
+
+    #Patient IDs are mostly distinct, so they are converted directly unless one of them is invalid
+    try:
+        patientIds = list(map(int, columns[0]))
+        if min(patientIds) < PATIENT_ID_MIN or max(patientIds) > PATIENT_ID_MAX:
+            raise ValueError
+        converters = [None, convertDate]
+    except ValueError:
+        patientIds = None
+        converters = [convertPatientId, convertDate]
+    converters.extend(vitalConverter(name, low, high, column > 0) for column, (name, low, high) in enumerate(VITAL_RULES))
+
+    #Every column is looked up in its table in one map, with None for the strings that broke a rule.
+    #Columns are checked in file order, so each line keeps the first rule it broke
+    converted = []
+    for texts, convert in zip(columns, converters):
+        if convert is None:
+            converted.append(patientIds)
+            continue
+        table, invalid = columnTable(texts, convert)
+        values = list(map(table.get, texts))
+        if invalid:
+            for i in noneIndexes(values):
+                reasons.setdefault(i, invalid[texts[i]])
+        converted.append(values)
+    del columns
+
+    if reasons:
+        for i in sorted(reasons):
+            report.rejected.append(RejectedRow(firstLineNumber + i, lines[i].rstrip('\r'), reasons[i], report.filename))
+        keep = bytearray(b'\x01') * count
+        for i in reasons:
+            keep[i] = 0
+        converted = [list(compress(values, keep)) for values in converted]
+    patientIds, dates, *vitals = converted
+    report.acceptedCount += len(patientIds)
+
+    return groupColumnsByPatient(patientIds, dates, *vitals)
+
+
+def groupColumnsByPatient(patientIds, dates, *vitals):
+    """
+    Turns parallel lists of visits into store columns, grouped by patient.
+
+    The sort is stable, so each patient's visits keep their order, and a batch
+    added to a PatientStore takes one row range per patient.
+    return: The patient ID, date and six vital sign columns as typed arrays.
+    """
+    if len(patientIds) > 1:
+        order = sorted(range(len(patientIds)), key=patientIds.__getitem__)
+        reorder = itemgetter(*order)
+        patientIds = reorder(patientIds)
+        dates = reorder(dates)
+        vitals = [reorder(values) for values in vitals]
+    return (array('q', patientIds), array('i', dates), array('f', vitals[0]),
+            *(array('h', values) for values in vitals[1:]))
+
+
+def loadPatientFile(patients, file, report, size=None):
+    """
+    Streams an open patients file into a PatientStore in fixed-size blocks.
+
+    Only one block of text is held at a time, cut at the last full line.
+    patients: The PatientStore to add the visits to.
+    file: The patients file, opened in binary mode at the position to read from.
+    report: The LoadReport collecting rejected lines.
+    size: The number of bytes to read, or None to read to the end of the file.
+    return: The number of bytes read.
+    """
+    consumed = 0
+    leftover = b''
+    remaining = size
+    #Seconds spent reading, parsing and storing, while instrumentation is on
+    timed = INSTRUMENTS.enabled
+    phases = [0.0, 0.0, 0.0]
+    rejectedBefore = len(report.rejected)
+    visitsBefore = patients.visitCount
+    while remaining is None or remaining > 0:
+        if timed:
+            started = time.perf_counter()
+        block = file.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if timed:
+            phases[0] += time.perf_counter() - started
+        if remaining is not None:
+            remaining -= len(block)
+        if not block:
+            break
+        block = leftover + block
+        cut = block.rfind(b'\n') + 1
+        leftover = block[cut:]
+        if cut:
+            if timed:
+                started = time.perf_counter()
+            lines = block[:cut].decode().split('\n')
+            lines.pop()
+            columns = parsePatientLines(lines, report.lineCount + 1, report)
+            if timed:
+                parsed = time.perf_counter()
+                phases[1] += parsed - started
+            patients.extend(*columns)
+            if timed:
+                phases[2] += time.perf_counter() - parsed
+            consumed += cut
+    #The last line may not end with a newline
+    if leftover:
+        patients.extend(*parsePatientLines([leftover.decode()], report.lineCount + 1, report))
+        consumed += len(leftover)
+    if timed:
+        for phase, seconds in zip(('io', 'parse', 'store'), phases):
+            INSTRUMENTS.count('load_phase_seconds', seconds, phase=phase)
+        INSTRUMENTS.count('bytes_read', consumed, operation='load')
+        INSTRUMENTS.count('rows_loaded', patients.visitCount - visitsBefore)
+        for row in report.rejected[rejectedBefore:]:
+            INSTRUMENTS.count('rows_rejected', reason=row.reason.split(' (')[0])
+    return consumed
+
+
+@instrumented()
+def readPatientsFromFile(filename):
+    """
+    Reads patient data from a plaintext file.
+
+    fileName: The name of the file to read patient data from.
+    Returns a PatientStore holding the visits of every patient. Indexing it by
+    patient ID gives the visits as Visit records, which also index like the old lists:
+    {
+        patientId (int): [
+            Visit(date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)),
+            ...
+        ],
+        ...
+    }
+    Invalid lines are not printed; they are collected in the store's loadReport.
+    """
+    #Importing data from txt file
+    patients = PatientStore()
+    patients.watcher = DataFileWatcher(filename)
+    patients.loadReport.filename = filename
+    try: 
+        file = open(filename, 'rb')
+    except FileNotFoundError:
+        print(f"The file {filename} could not be found.")
+        return patients
+    #Reading the file block by block
+    with file:
+        consumed = loadPatientFile(patients, file, patients.loadReport)
+    patients.watcher.acknowledge(consumed)
+    return patients
+
+
+def splitFileRanges(filename, parts):
+    """
+    Splits a patients file into byte ranges that start and end on line boundaries.
+
+    filename: The name of the file to split.
+    parts: The number of ranges wanted; small files get fewer.
+    return: A list of (start, stop) byte offsets covering the whole file.
+    """
+    size = os.path.getsize(filename)
+    parts = max(1, min(parts, size // CHUNK_SIZE))
+    boundaries = [0]
+    with open(filename, 'rb') as file:
+        for i in range(1, parts):
+            #Moving each cut forward to just after the next newline
+            file.seek(max(boundaries[-1], size * i // parts))
+            file.readline()
+            position = file.tell()
+            if boundaries[-1] < position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def parseFileRange(filename, start, stop):
+    """
+    Parses one byte range of a patients file; runs in a worker process.
+
+    Line numbers in the returned report count from the start of the range.
+    filename: The name of the file.
+    start: The offset of the first byte, at the start of a line.
+    stop: The offset just past the last byte, at the end of a line.
+    return: The columns of a PatientStore holding the range's visits, and the LoadReport.
+    """
+    chunk = PatientStore()
+    report = LoadReport(filename)
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        loadPatientFile(chunk, file, report, stop - start)
+    return (chunk.patientIds, chunk.dates, *chunk.vitals), report
+
+
+@instrumented()
+def readPatientsFromFiles(paths, workers=None):
+    """
+    Reads patient data from several plaintext files into one PatientStore, in parallel.
+
+    Each file, or each newline-aligned byte range of a large file, is parsed in a
+    worker process that sends back typed columns rather than lists of visits.
+    The chunks are merged in file order, so the visits and the rejected lines come
+    out the same as reading the files one after another with readPatientsFromFile.
+    paths: The names of the files to read.
+    workers: The number of worker processes; defaults to the number of CPUs.
+    Returns a PatientStore, with a loadReport covering every file.
+    """
+    workers = workers or os.cpu_count() or 1
+    patients = PatientStore()
+    tasks = []
+    totalSize = 0
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"The file {path} could not be found.")
+            continue
+        totalSize += os.path.getsize(path)
+        tasks.append(path)
+
+    #Large files are cut into ranges so every worker gets a similar share
+    shareSize = max(CHUNK_SIZE, totalSize // workers)
+    ranges = []
+    for path in tasks:
+        parts = -(-os.path.getsize(path) // shareSize)
+        ranges.extend((path, start, stop) for start, stop in splitFileRanges(path, parts))
+
+    if workers == 1 or len(ranges) <= 1:
+        chunks = [parseFileRange(*task) for task in ranges]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(parseFileRange, *zip(*ranges)))
+
+    #Merging in order, numbering each file's lines from its first range
+    report = patients.loadReport
+    linesBefore = {}
+    for (path, start, stop), (columns, chunkReport) in zip(ranges, chunks):
+        patients.extend(*columns)
+        offset = linesBefore.get(path, 0)
+        report.rejected.extend(row._replace(lineNumber=row.lineNumber + offset) for row in chunkReport.rejected)
+        report.lineCount += chunkReport.lineCount
+        report.acceptedCount += chunkReport.acceptedCount
+        linesBefore[path] = offset + chunkReport.lineCount
+    return patients
+
+
+@instrumented()
+def refreshPatients(patients):
+    """
+    Reloads patient data if the file it was read from was changed by another process.
+
+    Appended lines and log entries are parsed on their own; any other change
+    reloads the whole file and replays the log. The file is read under the
+    repository's readLock(), so it and the changes replayed on top of it belong together.
+    patients: The PatientStore returned by readPatientsFromFile.
+    return: True if anything was reloaded.
+    """
+    if patients.watcher is None:
+        return False
+    repository = patients.repository
+    with repository.readLock() if repository is not None else contextlib.nullcontext():
+        return applyOutsideChanges(patients)
+
+
+def applyOutsideChanges(patients):
+    """
+    The work of refreshPatients, for a caller already holding the repository's lock.
+    """
+    watcher = patients.watcher
+    if watcher is None:
+        return False
+    change = watcher.check()
+    if change == 'unchanged':
+        return False
+    if change == 'replaced':
+        reloaded = readPatientsFromFile(watcher.filename)
+        if patients.repository is not None:
+            patients.repository.replay(reloaded)
+        patients.adopt(reloaded)
+        watcher.acknowledge()
+        return True
+    if change == 'appended':
+        with open(watcher.filename, 'rb') as file:
+            file.seek(watcher.size)
+            consumed = loadPatientFile(patients, file, patients.loadReport)
+        watcher.acknowledge(watcher.size + consumed)
+    #Only what other processes logged since the store last read the log is replayed
+    if watcher.log is not None and watcher.log.check() == 'appended':
+        watcher.log.replayTail(patients)
+    return True
+
+
+#Snapshot header: magic, source size, source mtime, rows, index entries, tail length, tail
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'PTSNAP1' + sys.byteorder[0].upper().encode()
+SNAPSHOT_HEADER = struct.Struct('<8sqqqqq64s')
+
+
+def writePatientSnapshot(patients, filename, watcher=None):
+    """
+    Writes a binary snapshot of a PatientStore next to the patients file it was read from.
+
+    The snapshot holds a header describing the text file it was built from, an
+    index of (patient ID, start row, stop row) entries and then every column as
+    fixed-width values, widest type first so each column stays aligned.
+    It is written to a temporary file and renamed, so readers never see half of it.
+    patients: The PatientStore to save. Deleted rows are left out.
+    filename: The name of the patients file; the snapshot is saved as filename + '.snapshot'.
+    watcher: A DataFileWatcher describing the file the store was read from or written to;
+             by default the file as it is now.
+    """
+    if patients.visitCount != patients.rowCount:
+        patients = patients.liveCopy()
+    if watcher is None:
+        watcher = DataFileWatcher(filename)
+        watcher.acknowledge()
+
+    index = array('q')
+    for patientId, patientRanges in patients.ranges.items():
+        for start, stop in patientRanges:
+            index.extend((patientId, start, stop))
+
+    temporary = filename + SNAPSHOT_SUFFIX + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, watcher.size, watcher.mtime, patients.rowCount,
+                                        len(index) // 3, len(watcher.tail), watcher.tail))
+        file.write(index.tobytes())
+        for name, typecode in PatientStore.COLUMNS:
+            #Slicing copies an array, so a writer can keep growing it meanwhile
+            file.write(memoryview(getattr(patients, name)[:patients.rowCount]).cast('B'))
+    os.replace(temporary, filename + SNAPSHOT_SUFFIX)
+
+
+def openPatientSnapshot(filename):
+    """
+    Opens the binary snapshot of a patients file without copying its columns.
+
+    The snapshot is memory-mapped and the store's columns are read-only views of
+    the mapping, so opening it costs the same for any number of visits and the
+    pages are only read from disk when a query touches them.
+    filename: The name of the patients file.
+    return: The PatientStore and the file size the snapshot was built from,
+            or (None, 0) if there is no usable snapshot.
+    """
+    try:
+        with open(filename + SNAPSHOT_SUFFIX, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None, 0
+    if len(mapped) < SNAPSHOT_HEADER.size:
+        return None, 0
+    magic, sourceSize, sourceMtime, rowCount, indexCount, tailLength, tail = SNAPSHOT_HEADER.unpack_from(mapped)
+    if magic != SNAPSHOT_MAGIC:
+        return None, 0
+
+    #The snapshot can be used if the text file is unchanged, or has only grown since
+    watcher = DataFileWatcher(filename)
+    watcher.size, watcher.mtime, watcher.tail = sourceSize, sourceMtime, tail[:tailLength]
+    if watcher.check() == 'replaced':
+        return None, 0
+    watcher.inode = os.stat(filename).st_ino
+
+    view = memoryview(mapped)
+    offset = SNAPSHOT_HEADER.size
+    index = view[offset:offset + indexCount * 24].cast('q')
+    offset += indexCount * 24
+
+    patients = PatientStore()
+    for name, typecode in PatientStore.COLUMNS:
+        width = array(typecode).itemsize
+        setattr(patients, name, view[offset:offset + rowCount * width].cast(typecode))
+        offset += rowCount * width
+    patients.mapped = mapped
+    patients.alive = bytearray(b'\x01') * rowCount
+    patients.visitCount = rowCount
+    for i in range(0, len(index), 3):
+        patients._addRange(index[i], index[i + 1], index[i + 2])
+    patients.watcher = watcher
+    patients.loadReport.filename = filename
+    return patients, sourceSize
+
+
+#ID index header: magic, source size, source mtime, entries, lines, tail length, tail
+ID_INDEX_SUFFIX = '.idx'
+ID_INDEX_MAGIC = b'PTIDX1' + sys.byteorder[0].upper().encode() + b'\0'
+ID_INDEX_HEADER = struct.Struct('<8sqqqqq64s')
+
+
+def scanPatientRuns(filename, start=0, firstLineNumber=1, stop=None):
+    """
+    Finds the runs of consecutive lines of one patient in bytes [start, stop) of a patients file.
+
+    Only the patient ID in front of each line is looked at. Lines without a valid
+    ID belong to no run, as the loader rejects them anyway.
+    return: The patient ID, byte offset, byte length and first line number of every run,
+            as four arrays in file order, and the line number after the last line read.
+    """
+    ids, offsets, lengths, lineNumbers = array('q'), array('q'), array('q'), array('q')
+    position, lineNumber = start, firstLineNumber
+    current = None
+    leftover = b''
+    remaining = stop - start if stop is not None else None
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        while True:
+            block = file.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if remaining is not None:
+                remaining -= len(block)
+            if block:
+                block = leftover + block
+                cut = block.rfind(b'\n') + 1
+                leftover = block[cut:]
+                lines = block[:cut].split(b'\n')
+                lines.pop()
+            else:
+                #The last line may not end with a newline
+                lines, leftover = [leftover] if leftover else [], b''
+            for line in lines:
+                size = len(line) + 1
+                prefix = line[:line.find(b',')]
+                if prefix == current:
+                    lengths[-1] += size
+                else:
+                    try:
+                        patientId = int(prefix)
+                        current = prefix
+                    except ValueError:
+                        patientId = current = None
+                    if patientId is not None:
+                        ids.append(patientId)
+                        offsets.append(position)
+                        lengths.append(size)
+                        lineNumbers.append(lineNumber)
+                position += size
+                lineNumber += 1
+            if not block:
+                break
+    return ids, offsets, lengths, lineNumbers, lineNumber
+
+
+class PatientIdFile:
+    """
+    Persistent index of where each patient's visits are in a patients text file.
+
+    Kept next to the file as filename + '.idx': a header describing the text file
+    it was built from, then the patient ID, byte offset, byte length and first line
+    number of every run of consecutive lines of one patient, sorted by patient ID.
+    The file is memory-mapped, so opening it costs the same for any number of
+    patients, and the visits of one patient or of a range of IDs are read with a
+    binary search and one read per run, without touching anybody else's lines.
+    Open it with openPatientIdIndex, which builds or brings it up to date first.
+    """
+
+    def __init__(self, filename, ids, offsets, lengths, lineNumbers, sourceSize=0, mapped=None):
+        self.filename = filename
+        self.sourceSize = sourceSize
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = lengths
+        self.lineNumbers = lineNumbers
+        self.mapped = mapped
+
+    def runsBetween(self, low=None, high=None):
+        """
+        Returns the positions in the index of the runs of patients with IDs in [low, high]; None leaves that end open.
+        """
+        first = 0 if low is None else bisect_left(self.ids, low)
+        last = len(self.ids) if high is None else bisect_right(self.ids, high)
+        return range(first, last)
+
+    def readLines(self, low=None, high=None):
+        """
+        Yields (first line number, lines) for every run of the patients with IDs in [low, high], by patient ID.
+        """
+        with open(self.filename, 'rb') as file:
+            for k in self.runsBetween(low, high):
+                file.seek(self.offsets[k])
+                lines = file.read(self.lengths[k]).decode().split('\n')
+                if not lines[-1]:
+                    lines.pop()
+                yield self.lineNumbers[k], lines
+
+    def close(self):
+        if self.mapped is not None:
+            self.ids = self.offsets = self.lengths = self.lineNumbers = None
+            self.mapped.close()
+            self.mapped = None
+
+
+def writePatientIdIndex(filename, runs=None, start=0, firstLineNumber=1):
+    """
+    Writes the ID index of a patients file.
+
+    It is written to a temporary file and renamed, so readers never see half of it.
+    runs: The (ids, offsets, lengths, line numbers) arrays of an index of the file's
+          first start bytes, which are extended with the runs after them; None to scan it all.
+    start: Where the lines not in runs start.
+    firstLineNumber: The line number of the line at start.
+    """
+    watcher = DataFileWatcher(filename)
+    watcher.acknowledge()
+    *added, lineCount = scanPatientRuns(filename, start, firstLineNumber, watcher.size)
+    ids, offsets, lengths, lineNumbers = added if runs is None else [array('q', old) + new
+                                                                      for old, new in zip(runs, added)]
+    #A stable sort, so each patient's runs stay in file order
+    order = sorted(range(len(ids)), key=ids.__getitem__)
+    temporary = filename + ID_INDEX_SUFFIX + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(ID_INDEX_HEADER.pack(ID_INDEX_MAGIC, watcher.size, watcher.mtime, len(order),
+                                        lineCount - 1, len(watcher.tail), watcher.tail))
+        for column in (ids, offsets, lengths, lineNumbers):
+            file.write(array('q', map(column.__getitem__, order)).tobytes())
+    os.replace(temporary, filename + ID_INDEX_SUFFIX)
+
+
+def openPatientIdIndex(filename):
+    """
+    Opens the ID index of a patients file, first building it or bringing it up to date if needed.
+
+    An index of a file that has only grown since is extended with the runs of the
+    new lines; one of a file that was replaced is rebuilt.
+    filename: The name of the patients file.
+    return: A PatientIdFile.
+    """
+    try:
+        with open(filename + ID_INDEX_SUFFIX, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        mapped = None
+    if mapped is not None and len(mapped) >= ID_INDEX_HEADER.size:
+        magic, sourceSize, sourceMtime, entryCount, lineCount, tailLength, tail = ID_INDEX_HEADER.unpack_from(mapped)
+        watcher = DataFileWatcher(filename)
+        watcher.size, watcher.mtime, watcher.tail = sourceSize, sourceMtime, tail[:tailLength]
+        change = watcher.check() if magic == ID_INDEX_MAGIC else 'replaced'
+        if change != 'replaced':
+            view = memoryview(mapped)
+            columns = [view[ID_INDEX_HEADER.size + i * entryCount * 8:
+                            ID_INDEX_HEADER.size + (i + 1) * entryCount * 8].cast('q') for i in range(4)]
+            if change == 'unchanged':
+                return PatientIdFile(filename, *columns, sourceSize=sourceSize, mapped=mapped)
+            runs = [array('q', column) for column in columns]
+            del view, columns
+            mapped.close()
+            writePatientIdIndex(filename, runs, sourceSize, lineCount + 1)
+            return openPatientIdIndex(filename)
+        mapped.close()
+    writePatientIdIndex(filename)
+    return openPatientIdIndex(filename)
+
+
+@instrumented()
+def openPatients(filename):
+    """
+    Opens a patients file through its binary snapshot and replays its mutation log.
+
+    See FlatFileRepository.load.
+    filename: The name of the patients file.
+    Returns a PatientStore, like readPatientsFromFile.
+    """
+    return FlatFileRepository(filename).load()
+
+
+@instrumented()
+def rewritePatientFile(patients, filename):
+    """
+    Atomically replaces a patients file with the live visits of a PatientStore.
+
+    The visits are written to a temporary file that is flushed to disk and then
+    renamed over the old file, so a crash leaves either the old or the new file.
+    patients: The PatientStore to write out.
+    filename: The name of the file to replace.
+    """
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as file:
+        writeVisits(patients, file)
+    os.replace(temporary, filename)
+
+
+def writeVisits(patients, file):
+    """
+    Writes the live visits of a PatientStore to an open text file and flushes it to disk.
+    """
+    for patientId in patients:
+        file.writelines(formatVisitLine(patients, row) for row in patients.rowsOf(patientId))
+    file.flush()
+    os.fsync(file.fileno())
+
+
+#Suffix of the mutation log kept next to the patients file
+LOG_SUFFIX = '.log'
+
+
+class FileLock:
+    """
+    An fcntl.flock lock on a lock file, for coordinating with other processes.
+
+    Each FileLock has its own open file, so two FileLocks on the same path exclude
+    each other even inside one process.
+    path: The lock file, created if it does not exist.
+    shared: Whether to take a shared lock rather than an exclusive one.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.file = None
+
+    def acquire(self, block=True):
+        """
+        Takes the lock.
+
+        block: Whether to wait for the lock rather than give up at once.
+        return: True if the lock was taken.
+        """
+        self.file = open(self.path, 'a')
+        if fcntl is None:
+            return True
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.file.fileno(), operation if block else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        """
+        Gives the lock up.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class MutationLog:
+    """
+    Append-only log of the visits added and patients deleted since the patients file was last rewritten.
+
+    Every change is one appended line: 'A,<visit line>' for an added visit or
+    'D,<patient ID>,<size>' for a deleted patient (a tombstone). The log is replayed
+    on top of the patients file when it is opened. A tombstone only deletes the
+    visits in the first size bytes of the patients file, the part the deleting
+    process had read; lines other processes append after it are kept.
+
+    Once the log holds COMPACT_THRESHOLD entries it is compacted. The log is set
+    aside as '<log>.old' and a new log is started, then a background thread writes
+    the live visits to a temporary file and renames it over the patients file.
+    Each log starts with 'B,<inode>', the patients file it applies to, so after a
+    crash a set-aside log is replayed only if its rewrite never happened.
+
+    Other processes may open the same files. Setting the log aside, swapping in
+    the rewritten file and recovering all hold an exclusive lock on '<log>.lock',
+    and readers and appends hold it shared, so a reader always sees a patients
+    file and logs that belong together and no entry lands in a log being set
+    aside. A compaction also holds '<log>.compacting' until it is done, so
+    recovery leaves the set-aside log of a live compaction alone.
+
+    The log remembers how far the store it was replayed into has applied it, so
+    entries other processes append can be replayed on their own (replayTail),
+    and a compaction first takes them into the store it writes out.
+    """
+
+    COMPACT_THRESHOLD = 10000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = filename + LOG_SUFFIX
+        self.oldPath = self.path + '.old'
+        self.lockPath = self.path + '.lock'
+        self.compactingPath = self.path + '.compacting'
+        self.compacting = None
+        self.entryCount = 0
+        self.file = None
+        #The inode in the header of the open log: the patients file its entries apply to
+        self.fileBase = None
+        self.compactor = None
+        self.lock = threading.Lock()
+        #The inode of the log the store has applied and the offset it has applied up to, or None before replay()
+        self.applied = None
+        #(start, stop) byte ranges this process appended after the applied offset, in order
+        self.ownWrites = []
+
+    def baseInode(self):
+        """
+        Returns the inode of the patients file, or 0 if it does not exist.
+        """
+        try:
+            return os.stat(self.filename).st_ino
+        except FileNotFoundError:
+            return 0
+
+    def readLog(self, path):
+        """
+        Reads a log file at once.
+
+        return: The inode in its header, its entries, and the inode of the file with
+                the offset just past its last whole line; (None, [], (None, 0)) if it does not exist.
+        """
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+                fileInode = os.fstat(file.fileno()).st_ino
+        except FileNotFoundError:
+            return None, [], (None, 0)
+        #A last line without a newline was cut short by a crash, or is still being written
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].decode().split('\n')
+        inode = int(lines[0][2:]) if lines[0].startswith('B,') else None
+        return inode, [line for line in lines[1:-1] if line], (fileInode, end)
+
+    def readEntries(self, path):
+        """
+        Returns the inode in the header of a log file and its entries, or (None, []) if it does not exist.
+        """
+        inode, entries, position = self.readLog(path)
+        return inode, entries
+
+    def sharedLock(self):
+        """
+        Returns the lock to hold while reading the patients file and replaying the log.
+        """
+        return FileLock(self.lockPath, shared=True)
+
+    def recover(self):
+        """
+        Finishes or discards a compaction that was interrupted by a crash.
+
+        A set-aside log whose rewrite never happened is merged back in front of the
+        current log; one whose rewrite did happen is removed. A set-aside log of a
+        compaction still running, in this process or another, is left alone.
+        """
+        if not os.path.exists(self.oldPath):
+            return
+        with FileLock(self.lockPath):
+            compacting = FileLock(self.compactingPath)
+            if not compacting.acquire(block=False):
+                return
+            try:
+                inode, oldEntries = self.readEntries(self.oldPath)
+                if inode is None:
+                    return
+                if inode == self.baseInode():
+                    header, entries = self.readEntries(self.path)
+                    temporary = self.path + '.tmp'
+                    with open(temporary, 'w') as file:
+                        file.write(f"B,{inode}\n")
+                        file.writelines(entry + '\n' for entry in oldEntries + entries)
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.replace(temporary, self.path)
+                os.remove(self.oldPath)
+            finally:
+                compacting.release()
+
+    def liveEntries(self):
+        """
+        Returns the entries not yet written into the patients file, without changing any file.
+
+        While a compaction is running its set-aside log still applies, until the
+        rewritten patients file is swapped in.
+        return: The entries, how many of them are in the current log, and its position as from readLog.
+        """
+        header, entries, position = self.readLog(self.path)
+        inode, oldEntries = self.readEntries(self.oldPath)
+        if inode is not None and inode == self.baseInode():
+            return oldEntries + entries, len(entries), position
+        return entries, len(entries), position
+
+    def replay(self, patients, wanted=None, baseSize=None):
+        """
+        Applies every entry of the log to a PatientStore, in order.
+
+        Runs of added visits are parsed together as one block. Hold sharedLock()
+        across reading the patients file and replaying.
+        patients: The PatientStore read from the patients file.
+        wanted: Called with the patient ID of every entry; entries it returns False for are skipped.
+                Without it the store becomes the one replayTail() catches up.
+        baseSize: The number of bytes of the patients file the store was read from,
+                  by default the size its watcher acknowledged.
+        """
+        entries, liveCount, position = self.liveEntries()
+        self.applyEntries(patients, entries, wanted, baseSize)
+        self.entryCount = liveCount
+        if wanted is None:
+            self.applied = position
+            self.ownWrites = []
+
+    def check(self):
+        """
+        Returns 'unchanged', 'appended' or 'replaced' depending on what happened to the log since the store applied it.
+
+        'appended' means other processes added entries that replayTail() can apply;
+        'replaced' means the log was set aside by a compaction, so the store must be reloaded.
+        """
+        if self.applied is None:
+            return 'unchanged'
+        inode, size = self.applied
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 'unchanged' if inode is None else 'replaced'
+        if inode is not None and stat.st_ino != inode:
+            return 'replaced'
+        return 'appended' if stat.st_size > size else 'unchanged'
+
+    def replayTail(self, patients, baseSize=None):
+        """
+        Applies the entries other processes appended to the log since the store last applied it.
+
+        Hold sharedLock(), or the exclusive lock, while calling it.
+        return: Whether there were any.
+        """
+        inode, size = self.applied
+        try:
+            with open(self.path, 'rb') as file:
+                fileInode = os.fstat(file.fileno()).st_ino
+                if inode is not None and fileInode != inode:
+                    return False
+                file.seek(size)
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        end = size + data.rfind(b'\n') + 1
+        #This process's own entries are already in the store
+        pieces = []
+        position = size
+        for start, stop in self.ownWrites:
+            if start >= end:
+                break
+            pieces.append(data[position - size:start - size])
+            position = stop
+        pieces.append(data[position - size:end - size])
+        #A log another process just started begins with its header
+        entries = [line for line in b''.join(pieces).decode().split('\n') if line and not line.startswith('B,')]
+        self.applyEntries(patients, entries, None, baseSize)
+        self.applied = (fileInode, end)
+        self.ownWrites = [write for write in self.ownWrites if write[0] >= end]
+        self.entryCount += len(entries)
+        return bool(entries)
+
+    def applyEntries(self, patients, entries, wanted=None, baseSize=None):
+        """
+        Applies log entries to a PatientStore, in order; see replay().
+        """
+        if baseSize is None:
+            baseSize = patients.watcher.size if patients.watcher is not None else 0
+        report = LoadReport(self.path)
+        tails = {}
+        pending = []
+        for entry in entries + ['D,']:
+            if wanted is not None and entry != 'D,':
+                try:
+                    patientId = int(entry[2:].partition(',')[0])
+                except ValueError:
+                    patientId = None
+                if patientId is None or not wanted(patientId):
+                    #Skipped like a delete, so the added visits around it keep their line numbers
+                    entry = 'S,'
+            if entry.startswith('A,'):
+                pending.append(entry[2:])
+                continue
+            if pending:
+                patients.extend(*parsePatientLines(pending, report.lineCount + 2, report))
+                pending = []
+            if entry.startswith('D,') and entry[2:]:
+                patientId, _, known = entry[2:].partition(',')
+                patientId = int(patientId)
+                patients.deletePatient(patientId)
+                #The patient's lines appended to the patients file after the tombstone are theirs again
+                if known and int(known) < baseSize:
+                    if known not in tails:
+                        tails[known] = self.readBaseLines(int(known), baseSize)
+                    lines = [line for line in tails[known] if line.split(',', 1)[0].strip() == str(patientId)]
+                    if lines:
+                        patients.extend(*parsePatientLines(lines, 0, LoadReport()))
+            report.lineCount += 1
+        patients.loadReport.rejected.extend(report.rejected)
+
+    def readBaseLines(self, start, end):
+        """
+        Returns the lines of the patients file between two byte offsets.
+        """
+        with open(self.filename, 'rb') as file:
+            file.seek(start)
+            return file.read(end - start).decode().split('\n')
+
+    def append(self, entry):
+        """
+        Appends one entry to the log.
+        """
+        self.write(entry + '\n', 1)
+
+    def write(self, text, count, sync=False, knownInode=None):
+        """
+        Appends several entries to the log with one write, starting a new log file if needed.
+
+        text: The entries, each ending with a newline.
+        count: The number of entries in text.
+        sync: Whether to flush the log to disk with fsync afterwards.
+        knownInode: For a tombstone, the inode of the patients file its size was read from;
+                    if the log is not for that file, the tombstone covers all of it.
+        """
+        with self.lock, self.sharedLock():
+            self.openForAppend()
+            if self.applied is not None and self.applied[0] is None:
+                #The store was replayed before any log existed, so it has applied nothing of this one
+                self.applied = (os.fstat(self.file.fileno()).st_ino, 0)
+            if knownInode is not None and knownInode != self.fileBase:
+                text = text.rpartition(',')[0] + '\n'
+            data = text.encode()
+            if data:
+                #One unbuffered write appends the entries in one piece, even with other processes appending
+                self.file.write(data)
+                stop = self.file.tell()
+                start = stop - len(data)
+                if self.applied is not None and self.applied[0] == os.fstat(self.file.fileno()).st_ino:
+                    if start == self.applied[1]:
+                        self.applied = (self.applied[0], stop)
+                    else:
+                        self.ownWrites.append((start, stop))
+            if sync:
+                os.fsync(self.file.fileno())
+            self.entryCount += count
+
+    def openForAppend(self):
+        """
+        Opens the log for appending, again if another process set aside the one open, creating it if needed.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self.file is not None and os.fstat(self.file.fileno()).st_ino != inode:
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            if inode is None:
+                #The header goes in with the file itself, so no other process can append before it
+                temporary = f"{self.path}.{os.getpid()}.new"
+                with open(temporary, 'w') as file:
+                    file.write(f"B,{self.baseInode()}\n")
+                try:
+                    os.link(temporary, self.path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(temporary)
+            self.file = open(self.path, 'ab', buffering=0)
+            with open(self.path, 'rb') as file:
+                header = file.readline()
+            self.fileBase = int(header[2:]) if header.startswith(b'B,') else None
+
+    def recordAdd(self, line):
+        """
+        Records a visit added to the patients file, given as a line of that file.
+        """
+        self.append('A,' + line.rstrip('\n'))
+
+    def recordDelete(self, patientId, knownSize=None, knownInode=None):
+        """
+        Records that every visit of a patient was deleted.
+
+        knownSize: The number of bytes of the patients file the deleting store had
+                   read, or None for a tombstone covering the whole file.
+        knownInode: The inode of the patients file the store read knownSize bytes of.
+        """
+        if knownSize is None:
+            self.append(f"D,{patientId}")
+        else:
+            self.write(f"D,{patientId},{knownSize}\n", 1, knownInode=knownInode)
+
+    def maybeCompact(self, patients):
+        """
+        Starts a background compaction once the log has grown past COMPACT_THRESHOLD entries.
+        """
+        if self.entryCount >= self.COMPACT_THRESHOLD:
+            self.compact(patients)
+
+    def compact(self, patients, wait=False):
+        """
+        Rewrites the patients file with the live visits and starts a new, empty log.
+
+        Only setting the log aside and taking a frozen view of the store happen on
+        the calling thread; the rewrite itself runs on a background thread.
+        patients: The PatientStore the log belongs to.
+        wait: Whether to wait for the rewrite to finish.
+        """
+        with self.lock:
+            if self.compactor is not None and self.compactor.is_alive():
+                return
+            #Another process is compacting or recovering the same log; only a caller that waits waits for it
+            compacting = FileLock(self.compactingPath)
+            if not compacting.acquire(block=wait):
+                return
+            self.compacting = compacting
+            temporary = self.filename + '.compact.tmp'
+            output = open(temporary, 'w')
+            with FileLock(self.lockPath):
+                #Nobody can append now, so once the store has what other processes saved, the set-aside log holds nothing else
+                applyOutsideChanges(patients)
+                if self.file is not None:
+                    self.file.close()
+                if os.path.exists(self.path):
+                    os.replace(self.path, self.oldPath)
+                self.fileBase = os.fstat(output.fileno()).st_ino
+                header = f"B,{self.fileBase}\n"
+                with open(self.path, 'w') as file:
+                    file.write(header)
+                #Opened for appending, like in every other process, so no write lands on top of another
+                self.file = open(self.path, 'ab', buffering=0)
+                self.applied = (os.fstat(self.file.fileno()).st_ino, len(header))
+                self.ownWrites = []
+            self.entryCount = 0
+
+            frozen = patients.snapshot()
+            self.compactor = threading.Thread(target=self.finishCompaction, args=(frozen, output, temporary, patients))
+            self.compactor.start()
+        if wait:
+            self.compactor.join()
+
+    def finishCompaction(self, frozen, output, temporary, patients):
+        """
+        Background half of compact(): writes the frozen store and swaps it in as the patients file.
+        """
+        try:
+            with output:
+                writeVisits(frozen, output)
+            #Another process may rewrite the file again once it is swapped in, so it is described now
+            written = DataFileWatcher(temporary)
+            written.acknowledge()
+            written.filename = self.filename
+            with FileLock(self.lockPath):
+                os.replace(temporary, self.filename)
+                if os.path.exists(self.oldPath):
+                    os.remove(self.oldPath)
+            writePatientSnapshot(frozen, self.filename, written)
+            writePatientIdIndex(self.filename)
+            if patients.watcher is not None:
+                for name in ('size', 'mtime', 'inode', 'tail'):
+                    setattr(patients.watcher, name, getattr(written, name))
+        finally:
+            self.compacting.release()
+            self.compacting = None
+
+
+class PatientRepository:
+    """
+    Where the visits behind a PatientStore are saved.
+
+    load() returns a PatientStore that remembers its repository; addPatientData,
+    PatientWriter and deleteAllVisitsOfPatient then save changes through it.
+    FlatFileRepository keeps the patients text file, SQLiteRepository a SQLite
+    database. openRepository picks one by name.
+    path: The file the visits are kept in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Reads every visit into a new PatientStore.
+        """
+        raise NotImplementedError
+
+    def loadPatients(self, low, high):
+        """
+        Reads only the visits of the patients with IDs in [low, high] into a new PatientStore.
+
+        The store is for reading: it does not remember the repository, so nothing
+        done to it is saved. Archived visits are not included.
+        """
+        raise NotImplementedError
+
+    def readLock(self):
+        """
+        Returns the lock to hold while reading the saved visits and replaying changes.
+        """
+        return contextlib.nullcontext()
+
+    def replay(self, patients):
+        """
+        Re-applies saved changes to a store just reloaded from the patients file; hold readLock().
+        """
+
+    def addVisits(self, lines, visits, sync):
+        """
+        Saves a batch of new visits.
+
+        lines: The visits as lines of the patients file.
+        visits: The same visits as (patientId, date ordinal, temp, hr, rr, sbp, dbp, spo2) tuples.
+        sync: Whether the batch must be on disk before returning.
+        """
+        raise NotImplementedError
+
+    def deletePatient(self, patients, patientId):
+        """
+        Deletes every saved visit of a patient.
+
+        patients: The PatientStore the patient was deleted from.
+        """
+        raise NotImplementedError
+
+    def removeVisitsBefore(self, patients, cutoff):
+        """
+        Saves that every visit dated before cutoff, a day ordinal, was taken out of the store.
+        """
+        raise NotImplementedError
+
+    def afterWrite(self, patients):
+        """
+        Called once a batch of changes has been saved and applied to the store.
+        """
+
+    def sync(self):
+        """
+        Makes sure every change saved so far is on disk.
+        """
+
+    def close(self):
+        """
+        Releases whatever the repository holds open.
+        """
+
+
+class FlatFileRepository(PatientRepository):
+    """
+    Keeps visits in the patients text file, with its binary snapshot and mutation log.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.log = MutationLog(path)
+
+    def load(self):
+        """
+        Opens the patients file through its binary snapshot and replays its mutation log.
+
+        The text file stays the source of truth. If it is unchanged since the snapshot
+        was written, the snapshot is mapped as is. If lines were only appended, just
+        those lines are parsed. Otherwise the text file is read in full. In the last
+        two cases a fresh snapshot is written for the next start.
+        The visits added and patients deleted since the file was last compacted are
+        then replayed from the mutation log, and later changes are recorded in it.
+        """
+        filename = self.path
+        self.log.recover()
+        with self.log.sharedLock():
+            patients, sourceSize = openPatientSnapshot(filename)
+            stale = True
+            if patients is None:
+                patients = readPatientsFromFile(filename)
+            elif patients.watcher.check() == 'appended':
+                with open(filename, 'rb') as file:
+                    file.seek(sourceSize)
+                    consumed = loadPatientFile(patients, file, patients.loadReport)
+                patients.watcher.acknowledge(sourceSize + consumed)
+            else:
+                stale = False
+            if stale and os.path.exists(filename):
+                writePatientSnapshot(patients, filename)
+            self.log.replay(patients)
+        patients.watcher.log = self.log
+        patients.repository = self
+        patients.archive = openArchive(filename, patients)
+        return patients
+
+    def loadPatients(self, low, high):
+        """
+        Reads the patients' lines through the ID index, then replays their entries of the mutation log.
+
+        Nothing is written, so an interrupted compaction is left for load() to recover.
+        """
+        patients = PatientStore()
+        report = patients.loadReport
+        report.filename = self.path
+        with self.log.sharedLock():
+            baseSize = 0
+            if os.path.exists(self.path):
+                index = openPatientIdIndex(self.path)
+                for lineNumber, lines in index.readLines(low, high):
+                    patients.extend(*parsePatientLines(lines, lineNumber, report))
+                baseSize = index.sourceSize
+                index.close()
+            self.log.replay(patients, lambda patientId: low <= patientId <= high, baseSize)
+        return patients
+
+    def readLock(self):
+        return self.log.sharedLock()
+
+    def replay(self, patients):
+        self.log.replay(patients)
+
+    def addVisits(self, lines, visits, sync):
+        # Record the visits in the mutation log instead of touching the file
+        self.log.write(''.join('A,' + line for line in lines), len(lines), sync)
+
+    def deletePatient(self, patients, patientId):
+        #A compaction in progress swaps in a file holding only what the store knows, so its tombstones cover it all
+        watcher = patients.watcher
+        known = watcher.size if watcher is not None and self.log.compacting is None else None
+        self.log.recordDelete(patientId, known, watcher.inode if known is not None else None)
+
+    def removeVisitsBefore(self, patients, cutoff):
+        # The store no longer holds those visits, so compacting the log rewrites the file without them
+        if self.log.compactor is not None:
+            self.log.compactor.join()
+        self.log.compact(patients, wait=True)
+
+    def afterWrite(self, patients):
+        self.log.maybeCompact(patients)
+
+    def sync(self):
+        self.log.write('', 0, True)
+
+    def close(self):
+        if self.log.compactor is not None:
+            self.log.compactor.join()
+
+
+class SQLiteRepository(PatientRepository):
+    """
+    Keeps visits in a SQLite database.
+
+    The database runs in WAL mode with indexes on patient_id and visit_date, so
+    loading a range of patients, deleting a patient and removing old visits are
+    index lookups. Queries are answered from the loaded PatientStore. Batches of
+    visits are inserted with one prepared statement in one transaction.
+    """
+
+    CREATE = (
+        "CREATE TABLE IF NOT EXISTS visits ("
+        "id INTEGER PRIMARY KEY, patient_id INTEGER NOT NULL, visit_date TEXT NOT NULL, "
+        "temperature REAL NOT NULL, heart_rate INTEGER NOT NULL, respiratory_rate INTEGER NOT NULL, "
+        "systolic_blood_pressure INTEGER NOT NULL, diastolic_blood_pressure INTEGER NOT NULL, "
+        "oxygen_saturation INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS visits_patient_id ON visits (patient_id)",
+        "CREATE INDEX IF NOT EXISTS visits_visit_date ON visits (visit_date)",
+    )
+    COLUMNS = ("patient_id, visit_date, temperature, heart_rate, respiratory_rate, "
+               "systolic_blood_pressure, diastolic_blood_pressure, oxygen_saturation")
+    INSERT = f"INSERT INTO visits ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    SELECT_ALL = f"SELECT {COLUMNS} FROM visits ORDER BY patient_id, id"
+    SELECT_PATIENTS = f"SELECT {COLUMNS} FROM visits WHERE patient_id BETWEEN ? AND ? ORDER BY patient_id, id"
+    DELETE_PATIENT = "DELETE FROM visits WHERE patient_id = ?"
+    DELETE_BEFORE = "DELETE FROM visits WHERE visit_date < ?"
+
+    #Rows fetched from the database at a time while loading
+    FETCH_SIZE = 100000
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            for statement in self.CREATE:
+                self.connection.execute(statement)
+
+    def load(self):
+        """
+        Reads every visit into a new PatientStore, patient by patient.
+        """
+        patients = self.select(self.SELECT_ALL)
+        patients.repository = self
+        patients.archive = openArchive(self.path, patients)
+        return patients
+
+    def loadPatients(self, low, high):
+        """
+        Reads the patients' visits through the index on patient_id.
+        """
+        return self.select(self.SELECT_PATIENTS, (low, high))
+
+    def select(self, query, parameters=()):
+        """
+        Reads the visits a query returns into a new PatientStore.
+        """
+        patients = PatientStore()
+        patients.loadReport.filename = self.path
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                patients.extend(array('q', columns[0]), array('i', map(parseDateCached, columns[1])),
+                                array('f', columns[2]), *(array('h', column) for column in columns[3:]))
+                patients.loadReport.lineCount += len(rows)
+                patients.loadReport.acceptedCount += len(rows)
+        return patients
+
+    def addVisits(self, lines, visits, sync):
+        rows = [(patientId, ordinalToDate(visitDate), *vitals) for patientId, visitDate, *vitals in visits]
+        self.insert(rows, sync)
+
+    def insert(self, rows, sync=False):
+        """
+        Inserts rows of (patient_id, visit_date, vitals...) in one transaction.
+        """
+        with self.lock:
+            self.connection.execute("PRAGMA synchronous=FULL" if sync else "PRAGMA synchronous=NORMAL")
+            with self.connection:
+                self.connection.executemany(self.INSERT, rows)
+
+    def deletePatient(self, patients, patientId):
+        with self.lock, self.connection:
+            self.connection.execute(self.DELETE_PATIENT, (patientId,))
+
+    def removeVisitsBefore(self, patients, cutoff):
+        with self.lock, self.connection:
+            self.connection.execute(self.DELETE_BEFORE, (ordinalToDate(cutoff),))
+
+    def sync(self):
+        # Commits in WAL mode with synchronous=NORMAL are durable once checkpointed
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+#Storage backends by name, and where each keeps its data by default
+REPOSITORIES = {'flat': FlatFileRepository, 'sqlite': SQLiteRepository}
+DEFAULT_DATA_FILES = {'flat': 'patients.txt', 'sqlite': 'patients.db'}
+
+
+def openRepository(backend='flat', path=None):
+    """
+    Returns the storage backend called backend ('flat' or 'sqlite') for the given file.
+
+    path: The data file, or None for the backend's default file.
+    """
+    if backend not in REPOSITORIES:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return REPOSITORIES[backend](path or DEFAULT_DATA_FILES[backend])
+
+
+def repositoryFor(patients, fileName):
+    """
+    Returns the repository of a PatientStore if it keeps the given file, otherwise None.
+    """
+    repository = patients.repository
+    if repository is not None and os.path.abspath(repository.path) == os.path.abspath(fileName):
+        return repository
+    return None
+
+
+def migrateToSQLite(textFile, databaseFile):
+    """
+    One-shot copy of a patients text file, with its mutation log, into a SQLite database.
+
+    Visits already in the database are replaced.
+    textFile: The name of the patients text file.
+    databaseFile: The name of the SQLite database to create or fill.
+    return: The number of visits copied.
+    """
+    patients = FlatFileRepository(textFile).load()
+    repository = SQLiteRepository(databaseFile)
+    #The archived visits are copied too, so the database holds every visit
+    stores = [patients] if patients.archive is None else chain(patients.archive.stores(), [patients])
+    #Temperatures are kept as 32-bit floats, so they are rounded back to the one decimal of the file
+    rows = ((store.patientIds[row], ordinalToDate(store.dates[row]), round(store.temperature[row], 1),
+             store.heartRate[row], store.respiratoryRate[row], store.systolicBloodPressure[row],
+             store.diastolicBloodPressure[row], store.oxygenSaturation[row])
+            for store in stores for row in store.rows())
+    count = patients.visitCount + (patients.archive.visitCount if patients.archive is not None else 0)
+    with repository.lock, repository.connection:
+        repository.connection.execute("DELETE FROM visits")
+        repository.connection.executemany(repository.INSERT, rows)
+    repository.close()
+    if patients.loadReport.rejected:
+        print(patients.loadReport.summary())
+    print(f"Copied {count} visits from {textFile} to {databaseFile}.")
+    return count
+
+
+#Directory of archive segments kept next to the data file, and the segments' header:
+#magic, rows, first date, last date, patient IDs, statistics values, compressed size
+ARCHIVE_SUFFIX = '.archive'
+SEGMENT_SUFFIX = '.seg'
+SEGMENT_MAGIC = b'PTSEG1' + sys.byteorder[0].upper().encode() + b'\0'
+SEGMENT_HEADER = struct.Struct('<8sqiiqqq')
+#Written once every staged segment is on disk; holds the cutoff day ordinal
+PENDING_MARKER = 'PENDING'
+#Decompressed segments kept in memory per PatientArchive
+SEGMENT_CACHE_SIZE = 8
+#Follow-up rule sets whose archived results are kept per PatientArchive
+FOLLOW_UP_CACHE_SIZE = 32
+
+
+def gatherColumns(patients, rows):
+    """
+    Returns every column of a PatientStore at the given rows, as new arrays in PatientStore.COLUMNS order.
+    """
+    return [array(typecode, map(getattr(patients, name).__getitem__, rows)) for name, typecode in PatientStore.COLUMNS]
+
+
+class ArchiveSegment:
+    """
+    One month of archived visits, lzma-compressed, with metadata to decide whether it needs to be read.
+
+    On disk: a header with the number of visits and the first and last visit date,
+    the month's MonthlyStats and the sorted IDs of its patients, all uncompressed,
+    then the columns of its visits in date order, compressed. Opening a segment
+    reads only the metadata; load() decompresses the visits.
+    """
+
+    def __init__(self, path, month, rowCount, firstDate, lastDate, stats, patientIds, offset):
+        self.path = path
+        self.month = month
+        self.rowCount = rowCount
+        self.firstDate = firstDate
+        self.lastDate = lastDate
+        self.stats = stats
+        self.patientIds = patientIds
+        self.offset = offset
+
+    def overlaps(self, low, high):
+        """
+        Returns whether any visit may be dated in [low, high).
+        """
+        return self.firstDate < high and self.lastDate >= low
+
+    def mayContain(self, patientId):
+        i = bisect_left(self.patientIds, patientId)
+        return i < len(self.patientIds) and self.patientIds[i] == patientId
+
+    def mayBreak(self, rule):
+        """
+        Returns whether any visit may break a ThresholdRule, judging by the month's minimum and maximum.
+        """
+        return rule.isAbnormal(self.stats.minimums[rule.index]) or rule.isAbnormal(self.stats.maximums[rule.index])
+
+    def load(self):
+        """
+        Decompresses the visits into a new PatientStore, in date order.
+        """
+        with open(self.path, 'rb') as file:
+            file.seek(self.offset)
+            raw = lzma.decompress(file.read())
+        columns = []
+        offset = 0
+        for name, typecode in PatientStore.COLUMNS:
+            column = array(typecode)
+            column.frombytes(raw[offset:offset + self.rowCount * column.itemsize])
+            offset += self.rowCount * column.itemsize
+            columns.append(column)
+        patients = PatientStore()
+        patients.extend(*columns)
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('bytes_read', os.path.getsize(self.path) - self.offset, operation='archive')
+        return patients
+
+
+def writeArchiveSegment(path, columns):
+    """
+    Writes visits, given as columns in PatientStore.COLUMNS order, as a segment and flushes it to disk.
+    """
+    patientIds, dates = columns[0], columns[1]
+    order = sorted(range(len(dates)), key=dates.__getitem__)
+    columns = [array(column.typecode, map(column.__getitem__, order)) for column in columns]
+    stats = MonthlyStats()
+    stats.addValues(columns[2:])
+    values = array('d', [stats.count, *stats.sums, *stats.squares, *stats.minimums, *stats.maximums,
+                         *stats.abnormal, stats.abnormalVisits])
+    ids = array('q', sorted(set(patientIds)))
+    payload = lzma.compress(b''.join(column.tobytes() for column in columns))
+    with open(path, 'wb') as file:
+        file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(order), columns[1][0], columns[1][-1],
+                                       len(ids), len(values), len(payload)))
+        file.write(values.tobytes())
+        file.write(ids.tobytes())
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def openArchiveSegment(path):
+    """
+    Reads the metadata of a segment; returns an ArchiveSegment, or None if the file is not one.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(SEGMENT_HEADER.size)
+        if len(header) < SEGMENT_HEADER.size:
+            return None
+        magic, rowCount, firstDate, lastDate, idCount, valueCount, payloadSize = SEGMENT_HEADER.unpack(header)
+        if magic != SEGMENT_MAGIC:
+            return None
+        values = array('d')
+        values.frombytes(file.read(valueCount * 8))
+        patientIds = array('q')
+        patientIds.frombytes(file.read(idCount * 8))
+    stats = MonthlyStats()
+    stats.count = int(values[0])
+    stats.sums, stats.squares = list(values[1:7]), list(values[7:13])
+    stats.minimums, stats.maximums = list(values[13:19]), list(values[19:25])
+    stats.abnormal = [int(value) for value in values[25:-1]]
+    stats.abnormalVisits = int(values[-1])
+    month = parseMonth(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+    offset = SEGMENT_HEADER.size + valueCount * 8 + idCount * 8
+    return ArchiveSegment(path, month, rowCount, firstDate, lastDate, stats, patientIds, offset)
+
+
+class PatientArchive:
+    """
+    The cold tier: visits moved out of a PatientStore into compressed monthly segments.
+
+    Kept next to the data file as filename + '.archive', one segment per month.
+    A PatientStore's archive is answered together with the store by getStats,
+    getMonthlyStats, findVisitsByDate and evaluateFollowUp. Each segment's metadata
+    is checked first, and a segment is only decompressed when its dates, its
+    patients or its vital sign range could match. An archive never changes once
+    opened; archiving and deleting replace the store's archive with a new one, so
+    snapshots keep the archive that goes with their visits.
+    """
+
+    def __init__(self, directory, segments):
+        self.directory = directory
+        self.segments = sorted(segments, key=lambda segment: segment.month)
+        #patientId -> RunningStats of the patient's archived visits, worked out when first asked for
+        self.patientStatsCache = {}
+        self.loadSegment = functools.lru_cache(maxsize=SEGMENT_CACHE_SIZE)(self._loadSegment)
+        #The archive never changes, so its part of a follow-up evaluation is worked out once per rule set
+        self.abnormalCounts = functools.lru_cache(maxsize=FOLLOW_UP_CACHE_SIZE)(self._abnormalCounts)
+        self.recentVisits = functools.lru_cache(maxsize=FOLLOW_UP_CACHE_SIZE)(self._recentVisits)
+
+    def _loadSegment(self, segment):
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('archive_segments_read')
+        return segment.load()
+
+    def skipped(self, count):
+        if INSTRUMENTS.enabled and count:
+            INSTRUMENTS.count('archive_segments_skipped', count)
+
+    @property
+    def visitCount(self):
+        return sum(segment.rowCount for segment in self.segments)
+
+    def totals(self):
+        """
+        Returns the MonthlyStats of every archived visit, from the segments' metadata alone.
+        """
+        total = MonthlyStats()
+        for segment in self.segments:
+            total.merge(segment.stats)
+        return total
+
+    def hasPatient(self, patientId):
+        return any(segment.mayContain(patientId) for segment in self.segments)
+
+    def patientStats(self, patientId):
+        """
+        Returns the RunningStats of a patient's archived visits, or None if there are none.
+        """
+        if patientId not in self.patientStatsCache:
+            stats = RunningStats()
+            segments = [segment for segment in self.segments if segment.mayContain(patientId)]
+            self.skipped(len(self.segments) - len(segments))
+            for segment in segments:
+                patients = self.loadSegment(segment)
+                for start, stop in patients.ranges.get(patientId, ()):
+                    stats.addRows(patients, start, stop)
+            self.patientStatsCache[patientId] = stats if stats.count else None
+        return self.patientStatsCache[patientId]
+
+    def months(self, first=None, last=None, patientId=None):
+        """
+        Yields (month, MonthlyStats) for every archived month in [first, last], in order, as MonthlyRollups.months.
+        """
+        for segment in self.segments:
+            if (first is not None and segment.month < first) or (last is not None and segment.month > last):
+                continue
+            if patientId is None:
+                yield segment.month, segment.stats
+            elif segment.mayContain(patientId):
+                patients = self.loadSegment(segment)
+                stats = MonthlyStats()
+                rows = list(patients.rowsOf(patientId))
+                stats.addValues([list(map(column.__getitem__, rows)) for column in patients.vitals])
+                yield segment.month, stats
+
+    def yearRange(self):
+        """
+        Returns the first and last year with an archived visit, or None if the archive is empty.
+        """
+        if not self.segments:
+            return None
+        return self.segments[0].month // 12, self.segments[-1].month // 12
+
+    def visitsBetween(self, low, high):
+        """
+        Yields (patientId, Visit) for the archived visits dated in [low, high), in date order.
+        """
+        segments = [segment for segment in self.segments if segment.overlaps(low, high)]
+        self.skipped(len(self.segments) - len(segments))
+        for segment in segments:
+            patients = self.loadSegment(segment)
+            patientIds = patients.patientIds
+            for row in range(bisect_left(patients.dates, low), bisect_left(patients.dates, high)):
+                yield patientIds[row], patients.visit(row)
+
+    def stores(self, skip=0):
+        """
+        Yields the visits of each segment as a PatientStore, oldest month first.
+
+        skip: A number of visits returned by skippedVisits(); the segments holding them are not read.
+        """
+        for segment in self.segments:
+            if skip:
+                skip -= segment.rowCount
+                continue
+            yield self.loadSegment(segment)
+
+    def skippedVisits(self, offset):
+        """
+        Returns the number of visits in the whole segments before the offset-th archived visit.
+        """
+        skipped = 0
+        for segment in self.segments:
+            if offset - skipped < segment.rowCount:
+                break
+            skipped += segment.rowCount
+        return skipped
+
+    def patientsBetween(self, low=None, high=None):
+        """
+        Returns the IDs of the archived patients from low to high, both included, in ascending order.
+        """
+        found = set()
+        for segment in self.segments:
+            ids = segment.patientIds
+            first = 0 if low is None else bisect_left(ids, low)
+            last = len(ids) if high is None else bisect_right(ids, high)
+            found.update(ids[first:last])
+        return sorted(found)
+
+    def patientVisits(self, patientIds):
+        """
+        Returns a PatientStore of the archived visits of the given patients, each patient's in date order.
+        """
+        wanted = set(patientIds)
+        visits = PatientStore()
+        for segment in self.segments:
+            if not any(map(segment.mayContain, wanted)):
+                self.skipped(1)
+                continue
+            cold = self.loadSegment(segment)
+            rows = list(chain.from_iterable(cold.rowsOf(patientId) for patientId in wanted if patientId in cold))
+            visits.extend(*gatherColumns(cold, rows))
+        return visits
+
+    def followUp(self, rules, patients):
+        """
+        Evaluates follow-up rules over the archived visits together with the store's.
+
+        Rules that count abnormal visits over all of a patient's visits add the
+        store's abnormal visits to each patient's archived count, read once from
+        the segments with a value out of range. Rules over the most recent visits
+        are checked on each archived patient's last few archived visits, kept
+        once read, together with the patient's last few visits in the store.
+        patients: The PatientStore the archive belongs to.
+        return: The IDs of the patients that were evaluated, and {patientId: [reasons]} for the flagged ones.
+        """
+        rules = tuple(rules)
+        counting = tuple(rule for rule in rules if isinstance(rule, ThresholdRule) and rule.ofLast is None)
+        recent = tuple(rule for rule in rules if rule not in counting)
+        counts = self.abnormalCounts(counting)
+        masks = [rule.mask(patients) for rule in counting]
+        checked = set().union(*counts)
+        if recent:
+            window = max(rule.visits if isinstance(rule, TrendRule) else rule.ofLast for rule in recent)
+            cold = self.recentVisits(window)
+            checked.update(cold.ranges)
+        #Names of the rules that flag each checked patient
+        names = {}
+        for patientId in checked:
+            patientRanges = patients.ranges.get(patientId, ())
+            for rule, ruleCounts, mask in zip(counting, counts, masks):
+                found = ruleCounts.get(patientId, 0)
+                if found < rule.atLeast:
+                    found += sum(mask.count(1, start, stop) for start, stop in patientRanges)
+                if found >= rule.atLeast:
+                    names.setdefault(patientId, set()).add(rule.name)
+        if recent:
+            combined = PatientStore()
+            combined.extend(*gatherColumns(cold, list(cold.rows())))
+            hotRows = [rowsByDate(patients, patientId)[-window:] for patientId in cold.ranges if patientId in patients]
+            combined.extend(*gatherColumns(patients, list(chain.from_iterable(hotRows))))
+            for patientId, reasons in FollowUpEngine(recent).evaluate(combined).items():
+                names.setdefault(patientId, set()).update(reasons)
+        flagged = {patientId: [rule.name for rule in rules if rule.name in names[patientId]] for patientId in names}
+        return list(checked), flagged
+
+    def _abnormalCounts(self, rules):
+        """
+        Returns one {patientId: number of archived visits breaking the rule} per rule, for the patients with any.
+        """
+        counts = [{} for rule in rules]
+        for segment in self.segments:
+            breaking = [(rule, ruleCounts) for rule, ruleCounts in zip(rules, counts) if segment.mayBreak(rule)]
+            if not breaking:
+                self.skipped(1)
+                continue
+            cold = self.loadSegment(segment)
+            for rule, ruleCounts in breaking:
+                mask = rule.mask(cold)
+                for patientId, patientRanges in cold.ranges.items():
+                    found = sum(mask.count(1, start, stop) for start, stop in patientRanges)
+                    if found:
+                        ruleCounts[patientId] = ruleCounts.get(patientId, 0) + found
+        return counts
+
+    def _recentVisits(self, window):
+        """
+        Returns a PatientStore with the last window archived visits of every archived patient.
+        """
+        recent = PatientStore()
+        kept = {}
+        #Each segment holds one month, so going from the last segment back meets the latest visits first
+        for segment in reversed(self.segments):
+            cold = self.loadSegment(segment)
+            rows = []
+            for patientId in cold.ranges:
+                wanted = window - kept.get(patientId, 0)
+                if wanted > 0:
+                    patientRows = rowsByDate(cold, patientId)[-wanted:]
+                    kept[patientId] = kept.get(patientId, 0) + len(patientRows)
+                    rows.extend(patientRows)
+            recent.extend(*gatherColumns(cold, rows))
+        return recent
+
+    def segmentPath(self, month):
+        return os.path.join(self.directory, monthToText(month) + SEGMENT_SUFFIX)
+
+    def stage(self, patients, rows, cutoff):
+        """
+        Writes the given rows of a store, merged into the segments of their months, as pending segments.
+
+        Nothing changes for readers until commit().
+        cutoff: The day ordinal the visits are archived before, recorded for recovery.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        rowsByMonth = {}
+        for row in rows:
+            rowsByMonth.setdefault(ordinalToMonth(patients.dates[row]), []).append(row)
+        existing = {segment.month: segment for segment in self.segments}
+        for month, monthRows in rowsByMonth.items():
+            columns = gatherColumns(patients, monthRows)
+            if month in existing:
+                cold = existing[month].load()
+                columns = [getattr(cold, name) + column for (name, typecode), column in zip(PatientStore.COLUMNS, columns)]
+            writeArchiveSegment(self.segmentPath(month) + '.pending', columns)
+        with open(os.path.join(self.directory, PENDING_MARKER), 'w') as file:
+            file.write(str(cutoff))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def commit(self):
+        """
+        Puts the pending segments in place and returns the archive that includes them.
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX + '.pending'):
+                path = os.path.join(self.directory, name)
+                os.replace(path, path[:-len('.pending')])
+        os.remove(os.path.join(self.directory, PENDING_MARKER))
+        return openArchive(self.directory[:-len(ARCHIVE_SUFFIX)])
+
+    def withoutPatient(self, patientId):
+        """
+        Rewrites the segments holding visits of a patient without them; returns the new archive.
+        """
+        for segment in self.segments:
+            if not segment.mayContain(patientId):
+                continue
+            cold = segment.load()
+            rows = [row for row in range(cold.rowCount) if cold.patientIds[row] != patientId]
+            if rows:
+                writeArchiveSegment(segment.path + '.tmp', gatherColumns(cold, rows))
+                os.replace(segment.path + '.tmp', segment.path)
+            else:
+                os.remove(segment.path)
+        return openArchive(self.directory[:-len(ARCHIVE_SUFFIX)])
+
+
+def openArchive(filename, patients=None):
+    """
+    Opens the archive of a data file, or returns None if it has none.
+
+    An archiving interrupted by a crash is finished first if the data file was
+    already rewritten without the archived visits, which the store shows, and
+    undone otherwise.
+    filename: The data file.
+    patients: The PatientStore just loaded from the data file, needed to recover.
+    """
+    directory = filename + ARCHIVE_SUFFIX
+    if not os.path.isdir(directory):
+        return None
+    marker = os.path.join(directory, PENDING_MARKER)
+    if patients is not None and os.path.exists(marker):
+        with open(marker) as file:
+            cutoff = int(file.read() or 0)
+        removed = next(patients.getDateIndex().rowsBetween(datetime.date.min.toordinal(), cutoff), None) is None
+        if removed:
+            return PatientArchive(directory, []).commit()
+        os.remove(marker)
+    segments = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.pending') and not os.path.exists(marker):
+            #Staged by an archiving that never got as far as its marker
+            os.remove(path)
+        elif name.endswith(SEGMENT_SUFFIX):
+            segment = openArchiveSegment(path)
+            if segment is not None:
+                segments.append(segment)
+    return PatientArchive(directory, segments)
+
+
+@instrumented()
+def archiveVisits(patients, cutoff, filename=None):
+    """
+    Moves every visit dated before cutoff out of a PatientStore into its archive.
+
+    The visits are first written as pending segments, merged with the segments
+    already archived for their months. Then the store drops them and its
+    repository saves that. Only then are the pending segments put in place, so a
+    crash at any point loses no visit and archives none twice (see openArchive).
+    patients: A PatientStore loaded through a PatientRepository.
+    cutoff: The first date to keep in the store, as 'yyyy-mm-dd'.
+    filename: The data file; the store's repository's by default.
+    return: The number of visits archived.
+    Raises ValueError if the date is not a valid calendar date.
+    """
+    cutoff = dateToOrdinal(cutoff)
+    refreshPatients(patients)
+    repository = patients.repository
+    filename = filename if filename is not None else repository.path
+    rows = sorted(patients.getDateIndex().rowsBetween(datetime.date.min.toordinal(), cutoff))
+    if not rows:
+        return 0
+    archive = patients.archive or PatientArchive(filename + ARCHIVE_SUFFIX, [])
+    archive.stage(patients, rows, cutoff)
+
+    dates = patients.dates
+    kept = PatientStore()
+    for patientId in patients:
+        keep = [row for row in patients.rowsOf(patientId) if dates[row] >= cutoff]
+        if keep:
+            kept.extend(*gatherColumns(patients, keep))
+    patients.adopt(kept)
+    repository.removeVisitsBefore(patients, cutoff)
+
+    patients.archive = archive.commit()
+    patients.version += 1
+    return len(rows)
+
+
+def acknowledgeWrite(patients, fileName):
+    """
+    Tells the file watcher of a PatientStore that this program just wrote to its file.
+
+    patients: The PatientStore that was written out.
+    fileName: The name of the file that was written.
+    """
+    watcher = patients.watcher
+    if watcher is not None and os.path.abspath(watcher.filename) == os.path.abspath(fileName):
+        watcher.acknowledge()
+
+
+def formatVisitLine(patients, row):
+    """
+    Formats the visit stored at a row as a line of the patients file.
+
+    patients: The PatientStore holding the visit.
+    row: The row number of the visit.
+    """
+    return "%d,%s,%.1f,%d,%d,%d,%d,%d\n" % (patients.patientIds[row], ordinalToDate(patients.dates[row]),
+                                          patients.temperature[row], patients.heartRate[row],
+                                          patients.respiratoryRate[row], patients.systolicBloodPressure[row],
+                                          patients.diastolicBloodPressure[row], patients.oxygenSaturation[row])
+
+
+#Output formats of displayPatientData
+DISPLAY_FORMATS = ('text', 'csv', 'jsonl')
+
+#Header line of the csv format, named like the SQLite columns
+CSV_HEADER = ("patient_id,visit_date,temperature,heart_rate,respiratory_rate,"
+              "systolic_blood_pressure,diastolic_blood_pressure,oxygen_saturation\n")
+
+TEXT_VISIT = (" Visit Date: %s\n  Temperature: %.2f C\n  Heart Rate: %d bpm\n  Respiratory Rate: %d bpm\n"
+              "  Systolic Blood Pressure: %d mmHg\n  Diastolic Blood Pressure: %d mmHg\n  Oxygen Saturation: %d %%\n\n")
+
+JSON_VISIT = ('{"patientId": %d, "date": "%s", "temperature": %r, "heartRate": %d, "respiratoryRate": %d, '
+              '"systolicBloodPressure": %d, "diastolicBloodPressure": %d, "oxygenSaturation": %d}\n')
+
+#Characters gathered before each write to the output
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+
+def renderVisits(parts, format='text', headers=True):
+    """
+    Lazily formats visits straight from the stores' columns, one string per visit.
+
+    parts: (PatientStore, rows) pairs, such as the archive's and then the store's,
+           each with the rows of the visits to format, grouped by patient.
+    format: One of DISPLAY_FORMATS.
+    headers: For text, whether to start each patient's visits with a "Patient ID:" line.
+    """
+    if format not in DISPLAY_FORMATS:
+        raise ValueError(f"Unknown format {format!r}; expected one of {', '.join(DISPLAY_FORMATS)}")
+    if format == 'csv':
+        yield CSV_HEADER
+    current = None
+    for patients, rows in parts:
+        patientIds, dates, vitals = patients.patientIds, patients.dates, patients.vitals
+        temperature, heartRate, respiratoryRate, systolic, diastolic, oxygen = vitals
+        if format == 'csv':
+            for row in rows:
+                yield formatVisitLine(patients, row)
+        elif format == 'jsonl':
+            for row in rows:
+                yield JSON_VISIT % (patientIds[row], ordinalToDate(dates[row]), round(temperature[row], 2),
+                                    heartRate[row], respiratoryRate[row], systolic[row], diastolic[row], oxygen[row])
+        else:
+            for row in rows:
+                text = TEXT_VISIT % (ordinalToDate(dates[row]), temperature[row], heartRate[row], respiratoryRate[row],
+                                     systolic[row], diastolic[row], oxygen[row])
+                if headers and patientIds[row] != current:
+                    current = patientIds[row]
+                    text = f"Patient ID:{current}\n" + text
+                yield text
+
+
+def sliceParts(parts, offset=0, limit=None):
+    """
+    Keeps the visits from offset to offset + limit of (PatientStore, rows) pairs, as renderVisits takes them.
+    """
+    for patients, rows in parts:
+        if limit is not None and limit <= 0:
+            return
+        if offset:
+            rows = iter(rows)
+            offset -= sum(1 for row in islice(rows, offset))
+            if offset:
+                continue
+        if limit is not None:
+            rows = list(islice(rows, limit))
+            limit -= len(rows)
+        yield patients, rows
+
+
+def writeBuffered(chunks, out=None, bufferSize=OUTPUT_BUFFER_SIZE):
+    """
+    Writes strings to out (sys.stdout by default) in writes of about bufferSize characters.
+
+    return: The number of strings written.
+    """
+    out = out if out is not None else sys.stdout
+    pending = []
+    size = 0
+    count = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        count += 1
+        if size >= bufferSize:
+            out.write(''.join(pending))
+            pending = []
+            size = 0
+    if pending:
+        out.write(''.join(pending))
+    out.flush()
+    if INSTRUMENTS.enabled:
+        INSTRUMENTS.count('rows_returned', count, operation='displayPatientData')
+    return count
+
+
+@instrumented()
+def displayPatientData(patients, patientId=0, limit=None, offset=0, format='text', out=None, lastId=None):
+    """
+    Displays patient data for a given patient ID, or for a range of IDs.
+
+    The visits are formatted one at a time as they are read and written out in
+    large buffered writes, so nothing is copied and a limit stops the work early.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+    limit: The most visits to display, or None for all of them.
+    offset: How many visits to skip first, for showing one page at a time.
+    format: 'text' for people, or 'csv' or 'jsonl' for other tools.
+    out: The file to write to; sys.stdout by default.
+    lastId: With this, every patient with an ID from patientId to lastId, in ID order.
+    return: The number of visits displayed.
+    """
+    if isinstance(patientId, str) and patientId.isdigit():
+        patientId = int(patientId)
+
+    #Archived visits come before the store's: a month at a time for everything, first for each patient otherwise
+    archive = patients.archive if patients.archive is not None and patients.archive.segments else None
+    #Everything if inputing 0, that patient's visits if inputing anything else
+    if lastId is not None:
+        patientIds = findPatientsByIdRange(patients, patientId, lastId)
+        if archive is not None:
+            archived = archive.patientsBetween(patientId, lastId)
+            cold = archive.patientVisits(archived)
+            patientIds = sorted(set(patientIds).union(archived))
+        if not patientIds:
+            print(f"No patients found with IDs from {patientId} to {lastId}.", file=out)
+            return 0
+        stores = (cold, patients) if archive is not None else (patients,)
+        parts = ((store, store.rowsOf(id_)) for id_ in patientIds for store in stores if id_ in store)
+    elif patientId == 0:
+        parts = [(patients, patients.rows())]
+        if archive is not None:
+            skipped = archive.skippedVisits(offset)
+            parts = chain(((cold, cold.rows()) for cold in archive.stores(skipped)), parts)
+            offset -= skipped
+    elif patientId in patients or archive is not None and archive.hasPatient(patientId):
+        parts = [(patients, patients.rowsOf(patientId) if patientId in patients else ())]
+        if archive is not None:
+            cold = archive.patientVisits([patientId])
+            parts.insert(0, (cold, cold.rows()))
+    else:
+        print(f"Patient with ID {patientId} not found.", file=out)
+        return 0
+    parts = sliceParts(parts, offset, limit)
+    visits = renderVisits(parts, format, headers=patientId == 0 or lastId is not None)
+    count = writeBuffered(visits, out)
+    return count - 1 if format == 'csv' else count
+
+
+@instrumented()
+def findPatientsByIdRange(patients, low=None, high=None):
+    """
+    Returns the IDs of the patients from low to high, both included, in ascending order.
+
+    Uses the store's PatientIdIndex, so the cost depends on the number of IDs found.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    low: The lowest ID, or None for no lower limit.
+    high: The highest ID, or None for no upper limit.
+    """
+    return patients.getIdIndex().between(low, high)
+
+
+#Visits per page of option 1 in the menu
+PAGE_SIZE = 50
+
+
+def displayPatientsById(patients, text):
+    """
+    Displays the visits of the patient, or the range of patients like 1000-2000, typed in the menu.
+    """
+    try:
+        low, _, high = text.partition('-')
+        displayPatientData(patients, int(low), lastId=int(high) if high else None)
+    except ValueError:
+        print("Invalid input. Please enter a patient ID or two IDs separated by '-'.")
+
+
+def displayAllPatientsPaged(patients, pageSize=PAGE_SIZE):
+    """
+    Displays every visit a page at a time, asking before each next page.
+    """
+    offset = 0
+    total = patients.visitCount + (patients.archive.visitCount if patients.archive is not None else 0)
+    while displayPatientData(patients, 0, pageSize, offset) == pageSize:
+        offset += pageSize
+        if input(f"-- shown {offset} of {total} visits; Enter for more, q to stop -- ").strip().lower() == 'q':
+            break
+
+
+@instrumented()
+def getStats(patients, patientId=None):
+    """
+    Returns the statistics of each vital sign for one patient or for all patients.
+
+    They come from running aggregates kept up to date on every add and delete,
+    so the cost does not depend on the number of visits. Archived visits are
+    added from the archive's metadata, or for one patient from the segments
+    holding that patient's visits.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient, or None for all patients.
+    return: A PatientStats of the patient ID, the number of visits and a dictionary
+            from each vital sign's name to its VitalStatistics (average, stddev,
+            minimum, maximum), or None if there are no matching visits.
+    """
+    aggregates = patients.getAggregates()
+    stats = aggregates.overall if patientId is None else aggregates.byPatient.get(patientId)
+    #Visits moved to the archive count too
+    archive = patients.archive
+    if archive is not None:
+        cold = archive.totals() if patientId is None else archive.patientStats(patientId)
+        if cold is not None:
+            combined = RunningStats()
+            if stats is not None:
+                combined.merge(stats)
+            combined.merge(cold)
+            stats = combined
+    if stats is None or stats.count == 0:
+        return None
+    return PatientStats(patientId, stats.count, stats.summary())
+
+
+def periodStats(first, last, stats):
+    #Turns MonthlyStats over months first to last into a PeriodStats
+    abnormal = {rule.name: count for rule, count in zip(ABNORMAL_RULES, stats.abnormal)}
+    return PeriodStats(monthToText(first), monthToText(last), stats.count, stats.summary(),
+                       abnormal, stats.abnormalVisits)
+
+
+@instrumented()
+def getMonthlyStats(patients, first=None, last=None, patientId=None, combine=False):
+    """
+    Returns the statistics of each vital sign and the abnormal visits per month, for one patient or for all.
+
+    They come from monthly rollups kept up to date on every add and delete, and
+    the archive's metadata, so the cost depends on the number of months, not the
+    number of visits.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    first: The first month, as 'yyyy-mm', or None to start at the earliest visit.
+    last: The last month, as 'yyyy-mm', or None to end at the latest visit.
+    patientId: The ID of the patient, or None for all patients.
+    combine: Whether to return a single PeriodStats over the whole range instead of one per month.
+    return: A list of PeriodStats (first and last month, number of visits, a dictionary from each
+            vital sign's name to its VitalStatistics, a dictionary from each of ABNORMAL_RULES' names
+            to its number of abnormal visits, and the number of visits with any of them), one for
+            every month with visits; with combine, one PeriodStats or None if there are no visits.
+    Raises ValueError if a month is not in the format 'yyyy-mm'.
+    """
+    first = parseMonth(first) if first is not None else None
+    last = parseMonth(last) if last is not None else None
+    months = patients.getRollups().months(first, last, patientId)
+    if patients.archive is not None:
+        #Months can be partly archived, when visits were added with earlier dates after archiving
+        merged = {}
+        for month, stats in chain(months, patients.archive.months(first, last, patientId)):
+            if month in merged:
+                merged[month] = merged[month].copy()
+                merged[month].merge(stats)
+            else:
+                merged[month] = stats
+        months = sorted(merged.items(), key=itemgetter(0))
+    if not combine:
+        return [periodStats(month, month, stats) for month, stats in months]
+    total = MonthlyStats()
+    found = []
+    for month, stats in months:
+        total.merge(stats)
+        found.append(month)
+    if not found:
+        return None
+    return periodStats(found[0], found[-1], total)
+
+
+@instrumented()
+def displayStats(patients, patientId=0):
+    """
+    Prints the average of each vital sign for all patients or for the specified patient.
+
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    """
+
+    if isinstance(patientId, str) and patientId.isdigit():
+        patientId = int(patientId)
+
+    if patientId == 0:
+        stats = getStats(patients)
+        title = 'Vital signs for All Patients'
+    elif patientId in patients or (patients.archive is not None and patients.archive.hasPatient(patientId)):
+        stats = getStats(patients, patientId)
+        title = f'Vital Signs for Patient {patientId}'
+    else:
+        print(f"Patient with ID {patientId} not found.")
+        return
+
+    if stats is None:
+        print("No visits found.")
+        return
+
+    vitals = stats.vitals
+    print(title)
+    print(f"  Average temperature: {vitals['temperature'].average:.2f} C")
+    print(f"  Average heart rate: {vitals['heart rate'].average:.2f} bpm")
+    print(f"  Average respiratory rate: {vitals['respiratory rate'].average:.2f} bpm")
+    print(f"  Average systolic blood pressure: {vitals['systolic blood pressure'].average:.2f} mmHg")
+    print(f"  Average diastolic blood pressure: {vitals['diastolic blood pressure'].average:.2f} mmHg")
+    print(f"  Average oxygen saturation: {vitals['oxygen saturation'].average:.2f} %")
+
+    return
+
+
+
+def validateVisit(date, temp, hr, rr, sbp, dbp, spo2):
+    """
+    Checks the values of a new visit.
+
+    date: The date of the patient visit in the format 'yyyy-mm-dd'.
+    temp, hr, rr, sbp, dbp, spo2: The vital signs, as for addPatientData.
+    return: The date as a day ordinal and None, or None and a message saying what is wrong.
+    """
+
+    #We are going to split the dates into year. month, day
+    sections = date.split('-')
+    # Check if date format is valid
+    if len(date) != 10 or len(sections) != 3 or date[4] != '-' or date[7] != '-':
+        return None, "Invalid date format. Please enter date in the format 'yyyy-mm-dd'."
+
+    #Check if inputing proper month or day (12 months 31 days)
+    try:
+        year, month, day = map(int, sections)
+    except ValueError:
+        return None, "Invalid Date. Please enter a valid date."
+
+    if month < 1 or month > 12 or day < 1 or day > 31:
+        return None, "Invalid Date. Please enter a valid date."
+
+    # Check if the day exists in that month
+    try:
+        visitDate = parseDateCached(date)
+    except ValueError:
+        return None, "Invalid Date. Please enter a valid date."
+
+    # Check if temperature is valid
+    if not (35.0 <= temp <= 42.0):
+        return None, "Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius."
+
+    # Check if heart rate is valid
+    if not (30 <= hr <= 180):
+        return None, "Invalid heart rate. Please enter a heart rate between 30 and 180 bpm."
+
+    # Check if respiratory rate is valid
+    if not (5 <= rr <= 40):
+        return None, "Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm."
+
+    # Check if systolic blood pressure is valid
+    if not (70 <= sbp <= 200):
+        return None, "Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg."
+
+    # Check if diastolic blood pressure is valid
+    if not (40 <= dbp <= 120):
+        return None, "Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg."
+
+    # Check if oxygen saturation level is valid
+    if not (70 <= spo2 <= 100):
+        return None, "Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%."
+
+    return visitDate, None
+
+
+@instrumented()
+def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
+    """
+    Adds new patient data to the patient list.
+
+    patients: The PatientStore of patient IDs, where each patient has a list of visits, to add data to.
+    patientId: The ID of the patient to add data for.
+    date: The date of the patient visit in the format 'yyyy-mm-dd'.
+    temp: The patient's body temperature.
+    hr: The patient's heart rate.
+    rr: The patient's respiratory rate.
+    sbp: The patient's systolic blood pressure.
+    dbp: The patient's diastolic blood pressure.
+    spo2: The patient's oxygen saturation level.
+    fileName: The name of the file to append new data to.
+    """
+    with PatientWriter(patients, fileName) as writer:
+        message = writer.add(patientId, date, temp, hr, rr, sbp, dbp, spo2)
+    if message is not None:
+        print(message)
+
+
+class PatientWriter:
+    """
+    Adds visits in batches: validates them, buffers their lines and writes each batch at once.
+
+    Used as a context manager; whatever is still buffered is written on exit.
+
+        with PatientWriter(patients, 'patients.txt', fsync='batch') as writer:
+            for record in feed:
+                writer.add(*record)
+
+    The visits are saved through the store's repository when it keeps fileName,
+    and appended to fileName otherwise. A visit reaches the PatientStore once its
+    batch has been written.
+    patients: The PatientStore to add the visits to.
+    fileName: The name of the patients file.
+    fsync: 'none' leaves flushing to the operating system, 'batch' syncs every
+           written batch to disk, and a number syncs at most once per that many seconds.
+    batchSize: The number of buffered visits that triggers a write.
+    """
+
+    def __init__(self, patients, fileName, fsync='none', batchSize=10000):
+        if fsync not in ('none', 'batch') and not (isinstance(fsync, (int, float)) and fsync > 0):
+            raise ValueError(f"Invalid fsync policy: {fsync!r}")
+        self.patients = patients
+        self.fileName = fileName
+        self.fsync = fsync
+        self.batchSize = batchSize
+        self.lines = []
+        self.visits = []
+        self.file = None
+        self.lastSync = time.monotonic()
+
+        # Pick up changes made by other processes before writing
+        refreshPatients(patients)
+        self.repository = repositoryFor(patients, fileName)
+
+    def add(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        """
+        Validates and buffers one visit.
+
+        return: None if the visit was accepted, otherwise the message saying what is wrong with it.
+        """
+        visitDate, message = validateVisit(date, temp, hr, rr, sbp, dbp, spo2)
+        if message is not None:
+            if INSTRUMENTS.enabled:
+                INSTRUMENTS.count('validation_rejects', reason=message.split('.')[0])
+            return message
+        #Rounded once to what the file keeps, so the store holds exactly what a reload would read
+        visit = (patientId, visitDate, round(temp, 1), round(hr), round(rr), round(sbp), round(dbp), round(spo2))
+        self.lines.append("%s,%s,%.1f,%d,%d,%d,%d,%d\n" % ((patientId, date) + visit[2:]))
+        self.visits.append(visit)
+        if len(self.lines) >= self.batchSize:
+            self.flush()
+        return None
+
+    def shouldSync(self):
+        """
+        Returns whether the batch being written should be synced to disk.
+        """
+        if self.fsync == 'none':
+            return False
+        if self.fsync == 'batch':
+            return True
+        return time.monotonic() - self.lastSync >= self.fsync
+
+    @instrumented()
+    def flush(self):
+        """
+        Writes the buffered visits with one write, then adds them to the store.
+        """
+        if not self.lines:
+            return
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('rows_written', len(self.lines))
+            INSTRUMENTS.count('bytes_written', sum(map(len, self.lines)), operation='add')
+        sync = self.shouldSync()
+        if self.repository is not None:
+            self.repository.addVisits(self.lines, self.visits, sync)
+        else:
+            if self.file is None:
+                self.file = open(self.fileName, 'a')
+            self.file.write(''.join(self.lines))
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+            acknowledgeWrite(self.patients, self.fileName)
+        if sync:
+            self.lastSync = time.monotonic()
+
+        # Add the new data to the patients' visit histories
+        self.patients.extend(*groupColumnsByPatient(*zip(*self.visits)))
+        self.lines = []
+        self.visits = []
+
+    def discard(self, count):
+        """
+        Drops the visits buffered after the first count, before they are written.
+        """
+        del self.lines[count:]
+        del self.visits[count:]
+
+    def close(self):
+        """
+        Writes whatever is still buffered and releases the file.
+        """
+        self.flush()
+        if self.file is not None:
+            if self.fsync != 'none':
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        elif self.repository is not None and self.fsync != 'none':
+            self.repository.sync()
+        if self.repository is not None:
+            self.repository.afterWrite(self.patients)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
-            if patientId in patients:
-                patients[patientId].append (visitData)
-            else:
-                patients[patientId] = [visitData]
-        except ValueError as e:
-            print(str(e))
-        except:
-            print("An unexpected error occured while reading the file")
-    
-    #Closing file
-    file.close()
-    return patients
 
-def displayPatientData(patients, patientId=0):
+@instrumented()
+def addPatientDataBatch(patients, records, fileName, fsync='batch'):
     """
-    Displays patient data for a given patient ID.
+    Adds many visits at once, validating them in one pass and writing them in batches.
 
-    patients: A dictionary of patient dictionaries, where each patient has a list of visits.
-    patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+    patients: The PatientStore to add the visits to.
+    records: An iterable of (patientId, date, temp, hr, rr, sbp, dbp, spo2) tuples.
+    fileName: The name of the patients file.
+    fsync: The fsync policy, as for PatientWriter.
+    return: A list of (index, message) pairs for the records that were rejected.
     """
-    #Opening file and storing
-    file = open("patients.txt", 'r')
-    patients = {}
-    for line in file:
-        sections = line.strip().split(',')
-        if len(sections) != 8:
-            continue
-        patientOrder = int(sections[0])
-        
-        #Checking if it is in the txt file
-        if patientOrder not in patients:
-            patients[patientOrder] = {'visits' : []}
+    rejected = []
+    with PatientWriter(patients, fileName, fsync) as writer:
+        for index, record in enumerate(records):
+            message = writer.add(*record)
+            if message is not None:
+                rejected.append((index, message))
+    return rejected
+
         
-        #Storing it into a list
-        visitData = { 
-            "Visit Date:" : sections[1],
-            "Temperature:" : float(sections[2]) ,
-            "Heart Rate:" : float(sections[3]),
-            "Respiratory Rate:" : float(sections[4]),
-            "Systolic Blood Pressure:" : float(sections[5]),
-            "Diastolic Blood Pressure:" : float(sections[6]),
-            "Oxygen Saturation:" : float(sections[7]), # Add a % sign
-        }
-        patients[patientOrder]['visits'].append(visitData)
-    file.close()
-
-    #Printing everything if inputing 0, specific areas if inputing anything else
-    if patientId == 0:
-        for patient_Id, patients in patients.items():
-            print(f"Patient ID:{patient_Id}")
-            for visit in patients['visits']:
-                print(f" Visit Date: {visit['Visit Date:']}")
-                print(f" Temperatrue: {visit['Temperature:']:.2f} C")
-                print(f" Visit Date: {visit['Visit Date:']}")
-                print(f"  Temperature: {visit['Temperature:']:.2f} C")
-                print(f"  Heart Rate: {visit['Heart Rate:']} bpm")
-                print(f"  Respiratory Rate: {visit['Respiratory Rate:']} bpm")
-                print(f"  Systolic Blood Pressure: {visit['Systolic Blood Pressure:']} mmHg")
-                print(f"  Diastolic Blood Pressure: {visit['Diastolic Blood Pressure:']} mmHg")
-                print(f"  Oxygen Saturation: {visit['Oxygen Saturation:']} %")
-                print()
-    elif int(patientId) in patients:
-        for visit in patients[int(patientId)]["visits"]:
-            print(f" Visit Date: {visit['Visit Date:']}")
-            print(f"  Temperature: {visit['Temperature:']:.2f} C")
-            print(f"  Heart Rate: {visit['Heart Rate:']} bpm")
-            print(f"  Respiratory Rate: {visit['Respiratory Rate:']} bpm")
-            print(f"  Systolic Blood Pressure: {visit['Systolic Blood Pressure:']} mmHg")
-            print(f"  Diastolic Blood Pressure: {visit['Diastolic Blood Pressure:']} mmHg")
-            print(f"  Oxygen Saturation: {visit['Oxygen Saturation:']} %")
-            print()
+
+
+def iterVisitsByDate(patients, year=None, month=None, start=None, end=None):
+    """
+    Lazily yields the visits in a year, a month, both, or a range of dates, in date order.
+
+    Uses the store's DateIndex, so only the matching visits are read. Archived
+    visits are merged in from the segments whose dates overlap the filter.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    year: The year to filter by.
+    month: The month to filter by. Without a year, that month of every year matches.
+    start: The first date to include, as 'yyyy-mm-dd'.
+    end: The first date to leave out, as 'yyyy-mm-dd'.
+    Yields tuples containing patient ID and visit.
+    """
+    index = patients.getDateIndex()
+    archive = patients.archive
+
+    #Turning the filters into ranges of day ordinals
+    if year is not None:
+        spans = [monthBounds(year, month)]
+    elif month is not None:
+        years = [span for span in (index.yearRange(), archive and archive.yearRange()) if span]
+        years = (min(span[0] for span in years), max(span[1] for span in years)) if years else None
+        spans = [monthBounds(y, month) for y in range(years[0], years[1] + 1)] if years else []
     else:
-        print(f"Patient with ID {patientId} not found.")
+        spans = [(datetime.date.min.toordinal(), datetime.date.max.toordinal() + 1)]
+    if start is not None or end is not None:
+        low = dateToOrdinal(start) if start is not None else datetime.date.min.toordinal()
+        high = dateToOrdinal(end) if end is not None else datetime.date.max.toordinal() + 1
+        spans = [(max(first, low), min(last, high)) for first, last in spans]
 
+    patientIds = patients.patientIds
+    hot = ((patientIds[row], patients.visit(row)) for low, high in spans for row in index.rowsBetween(low, high))
+    if archive is None:
+        yield from hot
+        return
+    cold = chain.from_iterable(archive.visitsBetween(low, high) for low, high in spans)
+    yield from heapq.merge(cold, hot, key=lambda visit: visit[1].dateOrdinal)
 
 
-def displayStats(patients, patientId=0):
+@instrumented()
+def findVisitsByDate(patients, year=None, month=None, start=None, end=None, lazy=False):
     """
-    Prints the average of each vital sign for all patients or for the specified patient.
+    Find visits by year, month, or both, or by a range of dates.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
-    patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    year: The year to filter by.
+    month: The month to filter by.
+    start: The first date to include, as 'yyyy-mm-dd'.
+    end: The first date to leave out, as 'yyyy-mm-dd'.
+    lazy: Return an iterator instead of building the whole list.
+    return: A list of tuples containing patient ID and visit that match the filter, in date order.
     """
+    visits = iterVisitsByDate(patients, year, month, start, end)
+    if lazy:
+        return visits
+    visits = list(visits)
+    if INSTRUMENTS.enabled:
+        INSTRUMENTS.count('rows_returned', len(visits), operation='findVisitsByDate')
+    return visits
 
-    if patientId.isdigit():
-        patientId = int(patientId)
 
-    if patientId == 0:
-                
-                #Opening txt file
-                with open('patients.txt', 'r') as f:
-                    lines = f.readlines()
-            
-                #Creating empty list
-                totalTemperature = []
-                totalHeartRate = []
-                totalRespiratoryRate = []
-                totalSystolicBlood = []
-                totalDiastolicBlood = []
-                totalOxygenSaturation = []
-
-                #Storing data into empty list
-                for line in lines:
-                    sections  = line.strip().split(',')
-                    totalTemperature.append(float(sections[2]))
-                    totalHeartRate.append(float(sections[3]))
-                    totalRespiratoryRate.append(float(sections[4]))
-                    totalSystolicBlood.append(float(sections[5]))
-                    totalDiastolicBlood.append(float(sections[6]))
-                    totalOxygenSaturation.append(float(sections[7]))
-
-                #Calculating averages
-                averageTemperature = sum(totalTemperature) / len(totalTemperature)
-                averageHeartRate = sum(totalHeartRate) / len(totalHeartRate)
-                averageRespiratoryRate = sum(totalRespiratoryRate) / len(totalRespiratoryRate)
-                averageSystolicBlood = sum(totalSystolicBlood) / len(totalSystolicBlood)
-                averageDiastolicBlood = sum(totalDiastolicBlood) / len(totalDiastolicBlood)
-                averageOxygenSaturation = sum(totalOxygenSaturation) / len(totalOxygenSaturation)
-            
-                #Printing for all patients 
-                print('Vital signs for All Patients')
-                print(f"  Average temperature: {averageTemperature:.2f} C")
-                print(f"  Average heart rate: {averageHeartRate:.2f} bpm")
-                print(f"  Average respiratory rate: {averageRespiratoryRate:.2f} bpm")
-                print(f"  Average systolic blood pressure: {averageSystolicBlood:.2f} mmHg")
-                print(f"  Average diastolic blood pressure: {averageDiastolicBlood:.2f} mmHg")
-                print(f"  Average oxygen saturation: {averageOxygenSaturation:.2f} %")
-
-    
-    else:
-            #Creating a new variable for if anything but 0
-            patientStats = patients[patientId]
-            totalTemperature = []
-            totalHeartRate = []
-            totalRespiratoryRate = []
-            totalSystolicBlood = []
-            totalDiastolicBlood = []
-            totalOxygenSaturation = []  
-
-            #Exactly the same as above
-            for visit in patientStats:
-                totalTemperature.append(visit[1])
-                totalHeartRate.append(visit[2])
-                totalRespiratoryRate.append(visit[3])
-                totalSystolicBlood.append(visit[4])
-                totalDiastolicBlood.append(visit[5])
-                totalOxygenSaturation.append(visit[6])
 
 
-        
-            #Calculating averages
-            averageTemperature = sum(totalTemperature) / len(totalTemperature)
-            averageHeartRate = sum(totalHeartRate) / len(totalHeartRate)
-            averageRespiratoryRate = sum(totalRespiratoryRate) / len(totalRespiratoryRate)
-            averageSystolicBlood = sum(totalSystolicBlood) / len(totalSystolicBlood)
-            averageDiastolicBlood = sum(totalDiastolicBlood) / len(totalDiastolicBlood)
-            averageOxygenSaturation = sum(totalOxygenSaturation) / len(totalOxygenSaturation)
-            
-            print(f'Vital Signs for Patient {patientId}')
-            print(f"  Average temperature: {averageTemperature:.2f} C")
-            print(f"  Average heart rate: {averageHeartRate:.2f} bpm")
-            print(f"  Average respiratory rate: {averageRespiratoryRate:.2f} bpm")
-            print(f"  Average systolic blood pressure: {averageSystolicBlood:.2f} mmHg")
-            print(f" Average diastolic blood pressure: {averageDiastolicBlood:.2f} mmHg")
-            print(f"  Average oxygen saturation: {averageOxygenSaturation:.2f} mmHg")
 
 
-    return
+def vitalIndex(vital):
+    """
+    Returns the position of a vital sign, named as in VITAL_RULES, among the store's vital columns.
+    """
+    for i, (name, low, high) in enumerate(VITAL_RULES):
+        if name == vital:
+            return i
+    raise ValueError(f"Unknown vital sign: {vital}")
+
 
+def rowsByDate(patients, patientId):
+    """
+    Returns the rows of a patient's visits sorted by visit date.
+    """
+    return sorted(patients.rowsOf(patientId), key=patients.dates.__getitem__)
 
 
-def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
+class LazyMask:
     """
-    Adds new patient data to the patient list.
+    The abnormal flags of a ThresholdRule worked out row by row.
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
-    patientId: The ID of the patient to add data for.
-    date: The date of the patient visit in the format 'yyyy-mm-dd'.
-    temp: The patient's body temperature.
-    hr: The patient's heart rate.
-    rr: The patient's respiratory rate.
-    sbp: The patient's systolic blood pressure.
-    dbp: The patient's diastolic blood pressure.
-    spo2: The patient's oxygen saturation level.
-    fileName: The name of the file to append new data to.
+    Used instead of a whole-column mask when only a few patients are re-evaluated.
     """
 
-    #We are going to split the dates into year. month, day
-    year, month, day = date.split('-')
-    # Check if date format is valid
-    if len(date) != 10 or len(year) != 4 or len(month) != 2 or len(day) != 2 or date[4] != '-' or date[7] != '-':
-        print("Invalid date format. Please enter date in the format 'yyyy-mm-dd'.")
-    
-    #Check if inputing proper month or day (12 months 31 days)
-    try:
-        year = int(year)
-        month = int(month)
-        day = int(day)
-    except ValueError:
-        print("Invalid Date. Please enter a valid date.")
-        return
-    
-    if month < 1 or month > 12 or day < 1 or day > 31:
-        print("Invalid Date. Please enter a valid date.")
-        return
-    
-    # Check if temperature is valid
-    if not (35.0 <= temp <= 42.0):
-        print("Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.")
-        return
+    def __init__(self, rule, column):
+        self.rule = rule
+        self.column = column
 
-    # Check if heart rate is valid
-    if not (30 <= hr <= 180):
-        print("Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.")
-        return
+    def __getitem__(self, row):
+        return int(self.rule.isAbnormal(self.column[row]))
 
-    # Check if respiratory rate is valid
-    if not (5 <= rr <= 40):
-        print("Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.")
-        return
+    def count(self, value, start, stop):
+        return sum(1 for row in range(start, stop) if self[row] == value)
 
-    # Check if systolic blood pressure is valid
-    if not (70 <= sbp <= 200):
-        print("Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.")
-        return
 
-    # Check if diastolic blood pressure is valid
-    if not (40 <= dbp <= 120):
-        print("Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.")
-        return
+class ThresholdRule:
+    """
+    Flags a patient whose vital sign is outside [low, high] on at least atLeast of their last ofLast visits.
 
-    # Check if oxygen saturation level is valid
-    if not (70 <= spo2 <= 100):
-        print("Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.")
-        return
+    name: The reason reported for flagged patients.
+    vital: The vital sign, named as in VITAL_RULES.
+    low: Values below this are abnormal, or None for no lower limit.
+    high: Values above this are abnormal, or None for no upper limit.
+    atLeast: How many abnormal visits flag the patient.
+    ofLast: How many of the most recent visits are looked at, or None for all of them.
+    """
 
-    # Open the file in append mode
-    with open(fileName, 'a') as f:
-        # Write the new data to the file
-        f.write("%s,%s,%.1f,%d,%d,%d,%d,%d\n" % (patientId, date, temp, hr, rr, sbp, dbp, spo2))
+    def __init__(self, name, vital, low=None, high=None, atLeast=1, ofLast=None):
+        self.name = name
+        self.index = vitalIndex(vital)
+        self.low = low
+        self.high = high
+        self.atLeast = atLeast
+        self.ofLast = ofLast
+        #Abnormal flag of every value from 0 to 255, for translating a whole column at once
+        self.table = bytes(int(self.isAbnormal(value)) for value in range(256))
 
+    def isAbnormal(self, value):
+        """
+        Returns whether one value of the vital sign breaks the rule.
+        """
+        return (self.low is not None and value < self.low) or (self.high is not None and value > self.high)
 
-    # Add the new data to the patient's visit history
-    if patientId in patients:
-        patients[patientId].append([date, temp, hr, rr, sbp, dbp, spo2])
-    else:
-        patients[patientId] = [[date, temp, hr, rr, sbp, dbp, spo2]]
+    def mask(self, patients):
+        """
+        Returns one byte per row of the store, 1 where the value is abnormal.
 
-        
+        Whole-number vitals between 0 and 255 (all of them, within VITAL_RULES) are
+        mapped through a lookup table in a single bytes.translate over the column.
+        """
+        column = patients.vitals[self.index]
+        #A copy of the bytes, so a writer can keep growing the column meanwhile
+        raw = column.tobytes()
+        typecode = column.typecode if isinstance(column, array) else column.format
+        if typecode == 'h':
+            lowBytes = bytes(raw[0::2] if sys.byteorder == 'little' else raw[1::2])
+            highBytes = bytes(raw[1::2] if sys.byteorder == 'little' else raw[0::2])
+            if highBytes.count(0) == len(highBytes):
+                return lowBytes.translate(self.table)
+        return bytes(int(self.isAbnormal(value)) for value in column)
+
+    def lazyMask(self, patients):
+        return LazyMask(self, patients.vitals[self.index])
 
+    def flags(self, values):
+        """
+        Returns one byte per value of the vital sign, 1 where the value is abnormal.
 
-def findVisitsByDate(patients, year=None, month=None):
+        Whole numbers from 0 to 255 go through the lookup table, anything else
+        through one map of comparisons per limit.
+        """
+        if not (len(values) and isinstance(values[0], float)):
+            try:
+                return bytes(list(values)).translate(self.table)
+            except (TypeError, ValueError):
+                pass
+        checks = []
+        if self.low is not None:
+            checks.append(map(float(self.low).__gt__, values))
+        if self.high is not None:
+            checks.append(map(float(self.high).__lt__, values))
+        if not checks:
+            return bytes(len(values))
+        return bytes(map(or_, *checks) if len(checks) == 2 else checks[0])
+
+    def matches(self, patients, patientId, mask):
+        """
+        Returns whether the rule flags a patient, given the rule's mask.
+        """
+        if self.ofLast is None:
+            found = 0
+            for start, stop in patients.ranges[patientId]:
+                found += mask.count(1, start, stop)
+                if found >= self.atLeast:
+                    return True
+            return False
+        recent = rowsByDate(patients, patientId)[-self.ofLast:]
+        return sum(mask[row] for row in recent) >= self.atLeast
+
+
+class TrendRule:
     """
-    Find visits by year, month, or both.
+    Flags a patient whose vital sign changed by at least change over their last visits.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
-    year: The year to filter by.
-    month: The month to filter by.
-    return: A list of tuples containing patient ID and visit that match the filter.
+    name: The reason reported for flagged patients.
+    vital: The vital sign, named as in VITAL_RULES.
+    change: The change from the first to the last of those visits; negative for a drop.
+    visits: How many of the most recent visits make up the trend.
     """
 
-    #Making an empty list to store visits
-    visits = []
-    for patientId, patientVisits in patients.items():
-        for visit in patientVisits:
-            visitDate = visit[0]
-            #Seperating the date into year, month, day
-            visitYear, visitMonth, visitDay = visitDate.split('-')
-            if year is not None and int(visitYear) != year:
-                continue
-            if month is not None and int(visitMonth) != month:
-                continue
-            #Appending empty list with new information
-            visits.append((patientId, visit))
+    def __init__(self, name, vital, change, visits=3):
+        self.name = name
+        self.index = vitalIndex(vital)
+        self.change = change
+        self.visits = visits
 
-    #Returning list
-    return visits
+    def mask(self, patients):
+        return None
+
+    def lazyMask(self, patients):
+        return None
+
+    def matches(self, patients, patientId, mask):
+        """
+        Returns whether the rule flags a patient.
+        """
+        recent = rowsByDate(patients, patientId)[-self.visits:]
+        if len(recent) < self.visits:
+            return False
+        column = patients.vitals[self.index]
+        difference = column[recent[-1]] - column[recent[0]]
+        return difference >= self.change if self.change > 0 else difference <= self.change
+
+
+#The checks findPatientsWhoNeedFollowUp has always made: any single abnormal visit
+DEFAULT_FOLLOW_UP_RULES = (
+    ThresholdRule('abnormal heart rate', 'heart rate', low=60, high=100),
+    ThresholdRule('high systolic blood pressure', 'systolic blood pressure', high=140),
+    ThresholdRule('high diastolic blood pressure', 'diastolic blood pressure', high=90),
+    ThresholdRule('low oxygen saturation', 'oxygen saturation', low=90),
+)
+
+#The single-visit checks whose abnormal visits MonthlyRollups counts per month
+ABNORMAL_RULES = tuple(rule for rule in DEFAULT_FOLLOW_UP_RULES if isinstance(rule, ThresholdRule))
+
+
+class FollowUpEngine:
+    """
+    Evaluates follow-up rules over a PatientStore.
+
+    A full evaluation builds each rule's mask over all visits at once and then
+    checks every patient against it. The store reports which patients it adds to
+    or deletes from through touch(), and update() re-evaluates only those.
+    rules: The rules to check; defaults to DEFAULT_FOLLOW_UP_RULES.
+    """
+
+    def __init__(self, rules=DEFAULT_FOLLOW_UP_RULES):
+        self.rules = tuple(rules)
+        #patientId -> names of the rules that flag the patient
+        self.reasons = None
+        self.touched = set()
 
+    def touch(self, patientId):
+        """
+        Marks a patient as changed since the last evaluation.
+        """
+        self.touched.add(patientId)
 
+    def check(self, patients, patientId, masks):
+        """
+        Re-checks one patient against every rule and records the result.
+        """
+        reasons = [rule.name for rule, mask in zip(self.rules, masks) if rule.matches(patients, patientId, mask)]
+        if reasons:
+            self.reasons[patientId] = reasons
+        else:
+            self.reasons.pop(patientId, None)
 
+    def evaluate(self, patients):
+        """
+        Evaluates every rule for every patient and returns {patientId: [reasons]} for the flagged ones.
+        """
+        self.reasons = {}
+        self.touched = set()
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('rows_scanned', patients.rowCount * len(self.rules), operation='evaluateFollowUp')
+        masks = [rule.mask(patients) for rule in self.rules]
+        for patientId in patients:
+            self.check(patients, patientId, masks)
+        return self.reasons
 
+    def update(self, patients):
+        """
+        Re-evaluates only the patients touched since the last evaluation, and returns every flagged patient.
+        """
+        if self.reasons is None:
+            return self.evaluate(patients)
+        masks = [rule.lazyMask(patients) for rule in self.rules]
+        if INSTRUMENTS.enabled:
+            INSTRUMENTS.count('patients_rechecked', len(self.touched), operation='evaluateFollowUp')
+        for patientId in self.touched:
+            if patientId in patients:
+                self.check(patients, patientId, masks)
+            else:
+                self.reasons.pop(patientId, None)
+        self.touched = set()
+        return self.reasons
 
 
-def findPatientsWhoNeedFollowUp(patients):
+@instrumented()
+def findPatientsWhoNeedFollowUp(patients, rules=None):
     """
     Find patients who need follow-up visits based on abnormal vital signs.
 
-    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    rules: The follow-up rules to check, or None for DEFAULT_FOLLOW_UP_RULES.
+           With the defaults, only patients changed since the last call are re-checked.
     return: A list of patient IDs that need follow-up visits to to abnormal health stats.
     """
+    return list(evaluateFollowUp(patients, rules))
 
-    #filling in data 
-    followup_patients = []
-    patients = {}
-    file = open('patients.txt', 'r')
-    for line in file:
-            data = line.strip().split(",")
-            if len(data) != 8:
-                continue
-            patientId = int(data[0])
-            visit = {
-                "date": (data[1]),
-                "Heart Rate": float(data[2]),
-                "Systolic Blood Pressure": float(data[3]),
-                "Diastolic Blood Pressure": float(data[4]),
-                "Oxygen Saturation": float(data[5])
-            }
-            if patientId not in patients:
-                patients[patientId] = [visit]
-            else:
-                patients[patientId].append(visit)
-
-    #Checking if patient fits area needed for a follow up
-    for patientId, visits in patients.items():
-            for visit in visits:
-                heartRate = visit["Heart Rate"]
-                systolicBlood = visit["Systolic Blood Pressure"]
-                diastolicBlood = visit["Diastolic Blood Pressure"]
-                oxygenSaturation = visit["Oxygen Saturation"]
-
-                if heartRate > 100 or heartRate < 60 or systolicBlood > 140 or diastolicBlood > 90 or oxygenSaturation < 90:
-                    followup_patients.append(patientId)
-                    break
-    
 
+@instrumented()
+def evaluateFollowUp(patients, rules=None):
+    """
+    Find patients who need follow-up visits, with the reasons for each.
 
-    return followup_patients
+    Patients with archived visits are checked on those too; see PatientArchive.followUp.
+    patients: A PatientStore of patient IDs, where each patient has a list of visits.
+    rules: The follow-up rules to check, or None for DEFAULT_FOLLOW_UP_RULES.
+    return: A dictionary from each flagged patient ID to the names of the rules that flagged it.
+    """
+    if rules is None:
+        reasons = patients.getFollowUpEngine().update(patients)
+    else:
+        reasons = FollowUpEngine(rules).evaluate(patients)
+    flagged = {patientId: list(reasons[patientId]) for patientId in patients if patientId in reasons}
+    #Patients with archived visits are judged on all their visits
+    if patients.archive is not None:
+        checked, archived = patients.archive.followUp(rules or DEFAULT_FOLLOW_UP_RULES, patients)
+        for patientId in checked:
+            if patientId in archived:
+                flagged[patientId] = list(archived[patientId])
+            else:
+                flagged.pop(patientId, None)
+    if INSTRUMENTS.enabled:
+        INSTRUMENTS.count('rows_returned', len(flagged), operation='evaluateFollowUp')
+    return flagged
 
 
 
 
+@instrumented()
 def deleteAllVisitsOfPatient(patients, patientId, filename):
     """
     Delete all visits of a particular patient.
 
-    patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
+    patients: The PatientStore of patient IDs, where each patient has a list of visits, to delete data from.
     patientId: The ID of the patient to delete data for.
     filename: The name of the file to save the updated patient data.
     return: None
     """
 
-    #first check if patient exists
-    if patientId not in patients:
+    if removePatient(patients, patientId, filename):
+        print(f"Data for patient {patientId} has been deleted.")
+    else:
         print(f"No data found for patient with ID {patientId}")
-        return
+
+
+@instrumented()
+def removePatient(patients, patientId, filename):
+    """
+    Deletes all visits of a patient without printing anything.
+
+    See deleteAllVisitsOfPatient.
+    return: Whether the patient had any visits.
+    """
+
+    #Pick up changes made by other processes, then check if patient exists
+    refreshPatients(patients)
+    archived = patients.archive is not None and patients.archive.hasPatient(patientId)
+    if archived:
+        patients.archive = patients.archive.withoutPatient(patientId)
+        patients.version += 1
+    if patientId not in patients:
+        return archived
+
+    #Deletes through the store's repository when it keeps the file, otherwise rewrites the file
+    repository = repositoryFor(patients, filename)
+    if repository is not None:
+        repository.deletePatient(patients, patientId)
 
     #Deletes patient
-    del patients[patientId]
-    print(f"Data for patient {patientId} has been deleted.")
-    
-    #Opens file in writting mode to delete patient
-    with open(filename, 'w') as file:
-        for patient_id, visits in patients.items():
-            for visit in visits:
-                #Feel like I can optimize this but don't know how
-                visitData = ','.join([str(patient_id), visit[0], str(visit[1]), str(visit[2]), str(visit[3]),
-                                      str(visit[4]), str(visit[5]), str(visit[6])])
+    patients.deletePatient(patientId)
+
+    if repository is not None:
+        repository.afterWrite(patients)
+    else:
+        rewritePatientFile(patients, filename)
+        acknowledgeWrite(patients, filename)
+    return True
+
+
+class SharedPatientStore:
+    """
+    Shares a PatientStore between threads: one writer at a time, readers on immutable snapshots.
+
+    Readers call snapshot() and query the StoreSnapshot it returns like the store
+    itself, without taking any lock. A long scan keeps reading the version it
+    started with, so it never sees a half-applied change and never holds up a
+    write. Every change goes through write(), which holds the write lock while
+    the change is applied and saved, then publishes a new snapshot.
+    patients: The PatientStore to share.
+    dataFile: The data file changes are saved to, as for addPatientData.
+    """
 
-                file.write(visitData + '\n')
+    def __init__(self, patients, dataFile):
+        self.patients = patients
+        self.dataFile = dataFile
+        self.writeLock = threading.Lock()
+        #Built up front, so each snapshot gets a frozen copy instead of building its own
+        patients.getDateIndex()
+        patients.getAggregates()
+        patients.getRollups()
+        patients.getIdIndex()
+        self.current = patients.snapshot()
+
+    def snapshot(self):
+        """
+        Returns the StoreSnapshot of the last finished write.
+        """
+        return self.current
+
+    def write(self, function, *args):
+        """
+        Calls function(patients, *args) as the only writer, then publishes the new version.
+
+        return: Whatever function returns.
+        """
+        with self.writeLock:
+            try:
+                return function(self.patients, *args)
+            finally:
+                self.current = self.patients.snapshot()
+
+    def addVisits(self, records, fsync='batch'):
+        """
+        Adds (patientId, date, temp, hr, rr, sbp, dbp, spo2) records in one batch.
+
+        return: One message per record, None for every record that was added.
+        """
+        def add(patients):
+            with PatientWriter(patients, self.dataFile, fsync) as writer:
+                return [writer.add(*record) for record in records]
+        return self.write(add)
+
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient; returns whether the patient had any.
+        """
+        return self.write(removePatient, patientId, self.dataFile)
+
+    def refresh(self):
+        """
+        Picks up changes other processes made to the data file.
+        """
+        self.write(refreshPatients)
+
+
+def stressTest(backend, dataFile, seconds=5.0, readers=8, writers=4):
+    """
+    Hammers a SharedPatientStore with mixed reads and writes from many threads and checks what every read saw.
+
+    Runs on a copy of the data file in a temporary directory, so dataFile is not changed.
+    Writers add visits for new patients and delete some of them again. Readers take
+    snapshots and check that the visit count, the rows in the ranges, a full date
+    scan and the statistics all agree, that a patient reads the same before and
+    after a scan and that follow-ups only name patients in the snapshot. At the end
+    the copy is reopened from disk and compared with the store.
+    backend: The storage backend, as for openRepository.
+    dataFile: The data file to copy.
+    seconds: How long to keep the threads running.
+    readers: The number of reading threads.
+    writers: The number of writing threads.
+    return: A dictionary of read and write counts, writes finished during scans, the slowest write in seconds and the failed checks.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, os.path.basename(dataFile))
+    shutil.copyfile(dataFile, path)
+    repository = openRepository(backend, path)
+    shared = SharedPatientStore(repository.load(), path)
+    deadline = time.monotonic() + seconds
+    lock = threading.Lock()
+    results = {'reads': 0, 'writes': 0, 'writesDuringScans': 0, 'slowestWrite': 0.0, 'failures': []}
+
+    def fail(message):
+        with lock:
+            results['failures'].append(message)
+
+    def writer(number):
+        firstId = 10 ** 9 + number * 10 ** 6
+        for i in range(10 ** 6):
+            if time.monotonic() > deadline:
+                return
+            started = time.perf_counter()
+            patientId = firstId + i
+            messages = shared.addVisits([(patientId, f"2023-{month:02d}-15", 37.0, 80 + month, 16, 120, 80, 97)
+                                         for month in range(1, 4)], fsync='none')
+            if messages != [None, None, None]:
+                fail(f"Adding visits for patient {patientId} failed: {messages}")
+            if i % 2 and not shared.deletePatient(patientId - 1):
+                fail(f"Patient {patientId - 1} was missing when deleted")
+            with lock:
+                results['writes'] += 2 if i % 2 else 1
+                results['slowestWrite'] = max(results['slowestWrite'], time.perf_counter() - started)
+
+    def reader():
+        while time.monotonic() < deadline:
+            snapshot = shared.snapshot()
+            patientId = next(iter(snapshot), None)
+            before = snapshot[patientId] if patientId is not None else None
+            writesBefore = results['writes']
+            ranged = sum(stop - start for patientRanges in snapshot.ranges.values() for start, stop in patientRanges)
+            scanned = sum(1 for _ in iterVisitsByDate(snapshot))
+            stats = getStats(snapshot)
+            counted = stats.count if stats is not None else 0
+            if not snapshot.visitCount == ranged == scanned == counted:
+                fail(f"Version {snapshot.version}: {snapshot.visitCount} visits, {ranged} in ranges, "
+                     f"{scanned} scanned, {counted} in the statistics")
+            if patientId is not None and snapshot[patientId] != before:
+                fail(f"Version {snapshot.version}: patient {patientId} changed during a scan")
+            if any(flagged not in snapshot for flagged in evaluateFollowUp(snapshot)):
+                fail(f"Version {snapshot.version}: a follow-up names a patient outside the snapshot")
+            with lock:
+                results['reads'] += 1
+                results['writesDuringScans'] += results['writes'] - writesBefore
+
+    def run(function, *args):
+        try:
+            function(*args)
+        except Exception as error:
+            fail(f"{type(error).__name__}: {error}")
+
+    threads = [threading.Thread(target=run, args=(writer, number)) for number in range(writers)]
+    threads += [threading.Thread(target=run, args=(reader,)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    repository.close()
+    reopened = openRepository(backend, path)
+    if dict(reopened.load()) != dict(shared.patients):
+        fail("The data file does not hold what the store holds")
+    reopened.close()
+    shutil.rmtree(directory)
+    return results
+
+
+class LatencyRecorder:
+    """
+    Keeps the latency of the most recent requests to each endpoint, for percentiles.
+
+    size: How many recent requests are kept per endpoint.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.samples = {}
+        self.counts = Counter()
+
+    def record(self, endpoint, seconds):
+        if endpoint not in self.samples:
+            self.samples[endpoint] = deque(maxlen=self.size)
+        self.samples[endpoint].append(seconds)
+        self.counts[endpoint] += 1
+
+    def summary(self):
+        """
+        Returns {endpoint: {'count', 'p50Ms', 'p99Ms', 'maxMs'}}, plus 'all' across every endpoint.
+        """
+        result = {}
+        everything = []
+        for endpoint, samples in self.samples.items():
+            result[endpoint] = self.percentiles(sorted(samples), self.counts[endpoint])
+            everything.extend(samples)
+        if everything:
+            result['all'] = self.percentiles(sorted(everything), sum(self.counts.values()))
+        return result
+
+    @staticmethod
+    def percentiles(ordered, count):
+        def at(fraction):
+            return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+        return {'count': count, 'p50Ms': at(0.50), 'p99Ms': at(0.99), 'maxMs': round(ordered[-1] * 1000, 3)}
+
+
+class HttpError(Exception):
+    """
+    Ends a request with an HTTP error status and a JSON error message.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TextBody(str):
+    """
+    A response body sent as plain text instead of JSON.
+    """
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+#Largest request body accepted, in bytes
+MAX_BODY_SIZE = 1 << 20
+
+#The fields of a visit in POST /patients/<id>/visits, in validateVisit order
+VISIT_FIELDS = ('date', 'temperature', 'heartRate', 'respiratoryRate', 'systolicBloodPressure',
+                'diastolicBloodPressure', 'oxygenSaturation')
+
+
+def visitToJson(visit):
+    return dict(zip(VISIT_FIELDS, visit.astuple()))
+
+
+def visitFromJson(patientId, visit):
+    """
+    Turns a visit sent as JSON into a record for PatientWriter.add, or ends the request with 400 Bad Request.
+    """
+    if not isinstance(visit, dict) or not all(field in visit for field in VISIT_FIELDS):
+        raise HttpError(400, f"Expected a visit, or a list of visits, with the fields {', '.join(VISIT_FIELDS)}.")
+    date, *vitals = (visit[field] for field in VISIT_FIELDS)
+    if not isinstance(date, str):
+        raise HttpError(400, "Dates must be in the format 'yyyy-mm-dd'.")
+    for field, value in zip(VISIT_FIELDS[1:], vitals):
+        #bool is an int subclass, and JSON allows NaN and Infinity
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (isinstance(value, float) and not math.isfinite(value)):
+            raise HttpError(400, f"Expected a number for {field}, got {value!r}")
+    return (patientId, date, *vitals)
+
+
+def periodStatsToJson(stats):
+    if stats is None:
+        return None
+    return {**stats._asdict(), 'vitals': {name: vital._asdict() for name, vital in stats.vitals.items()}}
+
+
+def statsToJson(stats):
+    if stats is None:
+        return None
+    return {'patientId': stats.patientId, 'count': stats.count,
+            'vitals': {name: vital._asdict() for name, vital in stats.vitals.items()}}
+
+
+class PatientService:
+    """
+    Serves the patient queries and changes as a JSON API over HTTP, on asyncio.
+
+        GET    /patients/<id>            the patient's visits
+        GET    /stats[?patient=<id>]     getStats for all patients or one
+        GET    /visits?year=&month=&start=&end=&limit=
+                                         findVisitsByDate
+        GET    /follow-up                evaluateFollowUp
+        POST   /patients/<id>/visits     adds a visit, or a list of visits, as JSON objects
+        DELETE /patients/<id>            deletes all visits of the patient
+        GET    /metrics                  request counts and p50/p99 latency per endpoint
+
+    Every request reads the latest snapshot of a SharedPatientStore. Lookups by
+    ID and stats are answered on the event loop; date searches and follow-up
+    scans run on a thread pool so they do not hold up other connections. Adds
+    and deletes are queued to a single writer task, which applies everything
+    queued so far as one batch (one PatientWriter flush) on its own thread while
+    reads carry on against the previous snapshot.
+    patients: The PatientStore to serve.
+    dataFile: The data file changes are saved to, as for addPatientData.
+    workers: The number of threads for scans.
+    """
+
+    #Most changes the writer applies in one batch
+    WRITE_BATCH = 1000
+
+    def __init__(self, patients, dataFile, workers=4):
+        self.shared = SharedPatientStore(patients, dataFile)
+        self.dataFile = dataFile
+        self.scanPool = ThreadPoolExecutor(workers, thread_name_prefix='scan')
+        self.writePool = ThreadPoolExecutor(1, thread_name_prefix='writer')
+        self.latency = LatencyRecorder()
+        self.writes = None
+        self.writer = None
+        #The writer and task of every open connection
+        self.connections = {}
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Starts the writer task and listens for connections; returns the asyncio server.
+        """
+        self.writes = asyncio.Queue()
+        self.writer = asyncio.create_task(self.writeLoop())
+        return await asyncio.start_server(self.handleConnection, host, port)
+
+    async def stop(self):
+        """
+        Lets queued changes finish, then stops the writer and the thread pools.
+        """
+        await self.writes.join()
+        self.writer.cancel()
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        self.scanPool.shutdown()
+        self.writePool.shutdown()
+
+    async def read(self, function, *args, offload=False):
+        """
+        Runs a read on the event loop or, with offload, on the scan pool.
+        """
+        if offload:
+            return await asyncio.get_running_loop().run_in_executor(self.scanPool, function, *args)
+        return function(*args)
+
+    async def write(self, kind, argument):
+        """
+        Queues a change for the writer task and waits for its result.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.writes.put((kind, argument, future))
+        return await future
+
+    async def writeLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.writes.get()]
+            while len(batch) < self.WRITE_BATCH and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.writePool, self.shared.write, self.applyWrites, batch)
+                for (kind, argument, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as error:
+                for kind, argument, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            finally:
+                for _ in batch:
+                    self.writes.task_done()
+
+    def applyWrites(self, patients, batch):
+        """
+        Applies a batch of queued changes in order, on the writer thread; returns one result per change.
+
+        Runs of adds go through a single PatientWriter, so they are saved together.
+        A change that fails gets its exception as its result and the others go
+        ahead; if saving a run of adds fails, every add in that run gets the error.
+        """
+        results = []
+        writer = None
+        #Indexes into results of the adds buffered in writer
+        buffered = []
+        for kind, argument, future in batch:
+            if kind == 'add':
+                if writer is None:
+                    #Nothing is written before close, so a failed add can be taken back out of the buffer
+                    writer = PatientWriter(patients, self.dataFile, batchSize=sys.maxsize)
+                mark = len(writer.lines)
+                try:
+                    results.append([writer.add(*record) for record in argument])
+                    buffered.append(len(results) - 1)
+                except Exception as error:
+                    writer.discard(mark)
+                    results.append(error)
+            else:
+                if writer is not None:
+                    self.closeWriter(writer, results, buffered)
+                    writer = None
+                try:
+                    results.append(removePatient(patients, argument, self.dataFile))
+                except Exception as error:
+                    results.append(error)
+        if writer is not None:
+            self.closeWriter(writer, results, buffered)
+        return results
+
+    @staticmethod
+    def closeWriter(writer, results, buffered):
+        """
+        Saves a run of adds; if that fails, replaces the results of its adds with the error.
+        """
+        try:
+            writer.close()
+        except Exception as error:
+            for index in buffered:
+                results[index] = error
+        buffered.clear()
+
+    async def route(self, method, path, query, body):
+        """
+        Answers one request; returns the JSON-serializable response body.
+        """
+        parts = [part for part in path.split('/') if part]
+        if parts == ['metrics']:
+            return self.latency.summary()
+        if parts == ['metrics', 'prometheus']:
+            return TextBody(INSTRUMENTS.prometheus())
+        if parts == ['stats', 'monthly'] and method == 'GET':
+            patientId = parsePatientId(query['patient']) if 'patient' in query else None
+            combine = query.get('combine', '') not in ('', '0', 'false')
+            try:
+                result = await self.read(getMonthlyStats, self.shared.snapshot(), query.get('from'), query.get('to'),
+                                         patientId, combine)
+            except ValueError as error:
+                raise HttpError(400, str(error))
+            return periodStatsToJson(result) if combine else [periodStatsToJson(stats) for stats in result]
+        if parts == ['stats'] and method == 'GET':
+            patientId = parsePatientId(query['patient']) if 'patient' in query else None
+            return statsToJson(await self.read(getStats, self.shared.snapshot(), patientId))
+        if parts == ['visits'] and method == 'GET':
+            year = parseId(query['year']) if 'year' in query else None
+            month = parseId(query['month']) if 'month' in query else None
+            limit = parseId(query['limit']) if 'limit' in query else None
+            if limit is not None and limit < 0:
+                raise HttpError(400, f"The limit cannot be negative, got {limit}")
+            if year is not None and not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+                raise HttpError(400, f"The year must be from {datetime.MINYEAR} to {datetime.MAXYEAR}, got {year}")
+            if month is not None and not 1 <= month <= 12:
+                raise HttpError(400, f"The month must be from 1 to 12, got {month}")
+            try:
+                if query.get('start') is not None:
+                    dateToOrdinal(query['start'])
+                if query.get('end') is not None:
+                    dateToOrdinal(query['end'])
+            except ValueError:
+                raise HttpError(400, "Dates must be in the format 'yyyy-mm-dd'.")
+            def search(snapshot):
+                visits = iterVisitsByDate(snapshot, year, month, query.get('start'), query.get('end'))
+                return [{'patientId': patientId, **visitToJson(visit)}
+                        for patientId, visit in islice(visits, limit)]
+            return await self.read(search, self.shared.snapshot(), offload=True)
+        if parts == ['follow-up'] and method == 'GET':
+            return [{'patientId': patientId, 'reasons': reasons}
+                    for patientId, reasons in (await self.read(evaluateFollowUp, self.shared.snapshot(), offload=True)).items()]
+        if parts == ['patients'] and method == 'GET':
+            low = parseId(query['from']) if 'from' in query else None
+            high = parseId(query['to']) if 'to' in query else None
+            return {'patientIds': await self.read(findPatientsByIdRange, self.shared.snapshot(), low, high)}
+        if len(parts) == 2 and parts[0] == 'patients':
+            patientId = parsePatientId(parts[1])
+            if method == 'GET':
+                visits = await self.read(self.shared.snapshot().get, patientId)
+                if visits is None:
+                    raise HttpError(404, f"No data found for patient with ID {patientId}")
+                return {'patientId': patientId, 'visits': [visitToJson(visit) for visit in visits]}
+            if method == 'DELETE':
+                if not await self.write('delete', patientId):
+                    raise HttpError(404, f"No data found for patient with ID {patientId}")
+                return {'patientId': patientId, 'deleted': True}
+        if len(parts) == 3 and parts[0] == 'patients' and parts[2] == 'visits' and method == 'POST':
+            patientId = parsePatientId(parts[1])
+            try:
+                visits = json.loads(body or b'null')
+            except ValueError:
+                visits = None
+            if isinstance(visits, dict):
+                visits = [visits]
+            if not isinstance(visits, list):
+                raise HttpError(400, f"Expected a visit, or a list of visits, with the fields {', '.join(VISIT_FIELDS)}.")
+            records = [visitFromJson(patientId, visit) for visit in visits]
+            messages = await self.write('add', records)
+            return {'patientId': patientId, 'added': messages.count(None),
+                    'rejected': [{'index': index, 'message': message}
+                                 for index, message in enumerate(messages) if message is not None]}
+        if parts and parts[0] in ('patients', 'stats', 'visits', 'follow-up'):
+            raise HttpError(405, f"{method} is not supported on {path}")
+        raise HttpError(404, f"No such endpoint: {path}")
+
+    async def handleConnection(self, reader, writer):
+        """
+        Serves the requests of one HTTP/1.1 connection, keeping it open between requests.
+        """
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                started = time.perf_counter()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = requestLine.decode('latin-1').split()
+                except ValueError:
+                    break
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    #Without a usable length the rest of the connection cannot be framed
+                    status, result, endpoint = 400, {'error': "Invalid Content-Length header."}, 'error'
+                    keepAlive = False
+                elif length > MAX_BODY_SIZE:
+                    status, result, endpoint = 413, {'error': "Request body is too large."}, 'error'
+                    keepAlive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    url = urlsplit(target)
+                    endpoint = method + ' /' + url.path.strip('/').split('/')[0]
+                    try:
+                        result = await self.route(method, url.path, dict(parse_qsl(url.query)), body)
+                        status = 200
+                    except HttpError as error:
+                        status, result = error.status, {'error': str(error)}
+                    except Exception as error:
+                        status, result = 500, {'error': str(error)}
+                    keepAlive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if isinstance(result, TextBody):
+                    payload, contentType = result.encode(), 'text/plain; version=0.0.4'
+                else:
+                    payload, contentType = json.dumps(result).encode(), 'application/json'
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                             f"Content-Type: {contentType}\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n".encode() + payload)
+                await writer.drain()
+                self.latency.record(endpoint, time.perf_counter() - started)
+                if INSTRUMENTS.enabled:
+                    INSTRUMENTS.observe('http ' + endpoint, time.perf_counter() - started, status >= 500)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+
+def parseId(value):
+    """
+    Parses a whole number from a request, or ends the request with 400 Bad Request.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        raise HttpError(400, f"Expected a whole number, got {value!r}")
+
+
+def parsePatientId(value):
+    """
+    Parses a patient ID from a request, or ends the request with 400 Bad Request if it is not a whole number in the int64 range.
+    """
+    patientId = parseId(value)
+    if not PATIENT_ID_MIN <= patientId <= PATIENT_ID_MAX:
+        raise HttpError(400, f"Patient IDs must fit in 64 bits, got {patientId}")
+    return patientId
+
+
+def servePatients(patients, dataFile, host='127.0.0.1', port=8080, workers=4):
+    """
+    Runs a PatientService until interrupted, then prints the request latency summary.
+    """
+    async def run():
+        service = PatientService(patients, dataFile, workers)
+        server = await service.start(host, port)
+        print(f"Serving patient data on http://{host}:{port}/")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await service.stop()
+            for endpoint, summary in sorted(service.latency.summary().items()):
+                print(f"{endpoint}: {summary['count']} requests, p50 {summary['p50Ms']} ms, "
+                      f"p99 {summary['p99Ms']} ms, max {summary['maxMs']} ms")
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def toggleProfiling(rate=0.01, out=sys.stderr):
+    """
+    Starts the sampling profiler, or stops it and writes its report to out.
+
+    Turning profiling on also turns instrumentation on, since only instrumented
+    calls are sampled. Bound to SIGUSR1 where the platform has it; a signal that
+    interrupts a profiled call gets the report once that call returns.
+    """
+    profiler = INSTRUMENTS.profiler
+    if profiler.rate:
+        profiler.stop()
+        profiler.reportTo(out)
+    else:
+        INSTRUMENTS.enabled = True
+        profiler.start(rate)
+        print(f"Profiling {rate:.1%} of the instrumented calls.", file=out)
+
+
+def instrumentationMenu():
+    """
+    Shows the recorded instrumentation and lets the user switch it and the profiler on and off.
+    """
+    print("\n" + INSTRUMENTS.summary())
+    print(f"\nInstrumentation is {'on' if INSTRUMENTS.enabled else 'off'}, "
+          f"profiling is {'on' if INSTRUMENTS.profiler.rate else 'off'}.")
+    print("1. Toggle instrumentation")
+    print("2. Toggle profiling")
+    print("3. Show the profile")
+    print("4. Export in the Prometheus format")
+    print("5. Reset")
+    print("6. Back\n")
+    choice = input("Enter your choice (1-6): ")
+    if choice == '1':
+        INSTRUMENTS.enabled = not INSTRUMENTS.enabled
+        if not INSTRUMENTS.enabled:
+            INSTRUMENTS.profiler.stop()
+    elif choice == '2':
+        rate = 0.01
+        if not INSTRUMENTS.profiler.rate:
+            try:
+                rate = float(input("Share of calls to profile (0-1, default 0.01): ") or rate)
+            except ValueError:
+                print("Invalid input. Please enter a number.")
+                return
+        toggleProfiling(rate, sys.stdout)
+    elif choice == '3':
+        print(INSTRUMENTS.profiler.report())
+    elif choice == '4':
+        path = input("File to write to (empty for the screen): ")
+        if path:
+            with open(path, 'w') as file:
+                file.write(INSTRUMENTS.prometheus())
+        else:
+            print(INSTRUMENTS.prometheus())
+    elif choice == '5':
+        INSTRUMENTS.reset()
+
+
+def parseArguments(argv=None):
+    """
+    Reads the command line: which storage backend to use, or a migration to run.
+
+    The backend and data file can also be set with the PATIENTS_BACKEND and
+    PATIENTS_DATA environment variables.
+    """
+    parser = argparse.ArgumentParser(description="Health Information System")
+    parser.add_argument('--backend', choices=sorted(REPOSITORIES), default=os.environ.get('PATIENTS_BACKEND', 'flat'),
+                        help="where visits are stored (default: flat)")
+    parser.add_argument('--data', default=os.environ.get('PATIENTS_DATA'),
+                        help="the data file (default: patients.txt, or patients.db for sqlite)")
+    parser.add_argument('--migrate', nargs=2, metavar=('TEXT_FILE', 'DATABASE'),
+                        help="copy a patients text file into a SQLite database and exit")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="serve the patient data as a JSON API over HTTP instead of the menu")
+    parser.add_argument('--host', default='127.0.0.1', help="the address to serve on (default: 127.0.0.1)")
+    parser.add_argument('--export', choices=DISPLAY_FORMATS, metavar='FORMAT',
+                        help="write the visits to stdout as text, csv or jsonl and exit")
+    parser.add_argument('--patient', type=int, default=0,
+                        help="with --export or --stats, only this patient's visits, read through the ID index")
+    parser.add_argument('--last-patient', type=int, dest='lastPatient',
+                        help="with --export or --stats, every patient from --patient to this ID")
+    parser.add_argument('--stats', action='store_true', help="print the statistics of the vitals as JSON and exit")
+    parser.add_argument('--archive-before', dest='archiveBefore', metavar='YYYY-MM-DD',
+                        help="first move the visits dated before this day into the compressed archive")
+    parser.add_argument('--limit', type=int, help="with --export, the most visits to write")
+    parser.add_argument('--offset', type=int, default=0, help="with --export, how many visits to skip first")
+    parser.add_argument('--stress', type=float, metavar='SECONDS',
+                        help="run concurrent reads and writes against a copy of the data file and report")
+    parser.add_argument('--instrument', action='store_true', default=bool(os.environ.get('PATIENTS_INSTRUMENT')),
+                        help="count operations, rows and bytes and time the calls (menu option 9, /metrics/prometheus)")
+    parser.add_argument('--profile', type=float, metavar='RATE',
+                        help="profile this share of the instrumented calls (0-1); SIGUSR1 toggles it")
+    return parser.parse_args(argv)
+
+
+def openSession(argv=None):
+    """
+    Acts on the command line before the menu starts.
+
+    Migrations, stress tests, exports, statistics and the HTTP service run to the
+    end here; the visits for the menu are loaded through the chosen backend.
+    return: The PatientStore for the menu, or None if there is nothing left to do.
+    """
+    options = parseArguments(argv)
+    INSTRUMENTS.enabled = options.instrument
+    if options.profile:
+        toggleProfiling(options.profile)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: toggleProfiling(options.profile or 0.01))
+    if options.migrate:
+        migrateToSQLite(*options.migrate)
+        return None
+    repository = openRepository(options.backend, options.data)
+    dataFile = repository.path
+    if options.stress is not None:
+        repository.close()
+        print(json.dumps(stressTest(options.backend, dataFile, options.stress), indent=2))
+        if INSTRUMENTS.enabled:
+            print(INSTRUMENTS.summary(), file=sys.stderr)
+        return None
+    #Only the asked-for patients' lines are read when exporting or summarizing some of them
+    single = options.lastPatient is None and options.patient != 0
+    if (options.export is not None or options.stats) and (single or options.lastPatient is not None):
+        patients = repository.loadPatients(options.patient, options.patient if single else options.lastPatient)
+    else:
+        patients = repository.load()
+    if options.archiveBefore is not None:
+        try:
+            count = archiveVisits(patients, options.archiveBefore)
+        except ValueError:
+            sys.exit("--archive-before takes a date in the format 'yyyy-mm-dd'.")
+        print(f"Archived {count} visits dated before {options.archiveBefore}.", file=sys.stderr)
+    if options.export is not None or options.stats:
+        if patients.loadReport.rejected:
+            print(patients.loadReport.summary(), file=sys.stderr)
+        if options.stats:
+            print(json.dumps(statsToJson(getStats(patients, options.patient if single else None)), indent=2))
+        else:
+            displayPatientData(patients, options.patient, options.limit, options.offset, options.export,
+                               lastId=options.lastPatient)
+        repository.close()
+        if INSTRUMENTS.enabled:
+            print(INSTRUMENTS.summary(), file=sys.stderr)
+        return None
+    if patients.loadReport.rejected:
+        print(patients.loadReport.summary())
+    if options.serve is not None:
+        servePatients(patients, dataFile, options.host, options.serve)
+        repository.close()
+        return None
+    return patients
 
 
 
@@ -448,7 +5356,10 @@ def deleteAllVisitsOfPatient(patients, patientId, filename):
 ###########################################################################
 
 def main():
-    patients = readPatientsFromFile('patients.txt')
+    patients = openSession()
+    if patients is None:
+        return
+    dataFile = patients.repository.path
     while True:
         print("\n\nWelcome to the Health Information System\n\n")
         print("1. Display all patient data")
@@ -458,14 +5369,16 @@ def main():
         print("5. Find visits by year, month, or both")
         print("6. Find patients who need follow-up")
         print("7. Delete all visits of a particular patient")
-        print("8. Quit\n")
+        print("8. Quit")
+        print("9. Instrumentation\n")
 
-        choice = input("Enter your choice (1-8): ")
+        choice = input("Enter your choice (1-9): ")
+        refreshPatients(patients)
         if choice == '1':
-            displayPatientData(patients)
+            displayAllPatientsPaged(patients)
         elif choice == '2':
-            patientID = int(input("Enter patient ID: "))
-            displayPatientData(patients, patientID)
+            patientID = input("Enter patient ID (or a range of IDs, like 1000-2000): ")
+            displayPatientsById(patients, patientID)
         elif choice == '3':
             patientID = int(input("Enter patient ID: "))
             date = input("Enter date (YYYY-MM-DD): ")
@@ -476,7 +5389,7 @@ def main():
                 sbp = int(input("Enter systolic blood pressure (mmHg): "))
                 dbp = int(input("Enter diastolic blood pressure (mmHg): "))
                 spo2 = int(input("Enter oxygen saturation (%): "))
-                addPatientData(patients, patientID, date, temp, hr, rr, sbp, dbp, spo2, 'patients.txt')
+                addPatientData(patients, patientID, date, temp, hr, rr, sbp, dbp, spo2, dataFile)
             except ValueError:
                 print("Invalid input. Please enter valid data.")
         elif choice == '4':
@@ -509,10 +5422,13 @@ def main():
                 print("No patients found who need follow-up visits.")
         elif choice == '7':
             patientID = input("Enter patient ID: ")
-            deleteAllVisitsOfPatient(patients, int(patientID), "patients.txt")
+            deleteAllVisitsOfPatient(patients, int(patientID), dataFile)
         elif choice == '8':
             print("Goodbye!")
+            patients.repository.close()
             break
+        elif choice == '9':
+            instrumentationMenu()
         else:
             print("Invalid choice. Please try again.\n")
 
@@ -0,0 +1,552 @@
+"""
+Tests for the Health Information System in main.py.
+
+    python -m pytest -q
+"""
+import asyncio
+import io
+import json
+import os
+
+import pytest
+
+import main
+from benchmark import generatePatientFile
+
+
+#Two valid lines around one line for each rule the loader checks, in column order
+LOADER_LINES = [
+    "1,2020-01-01,37.0,80,16,120,80,97",
+    "2,2020-01-01,nan,80,16,120,80,97",
+    "3,2020-01-01,37.0,inf,16,120,80,97",
+    "9223372036854775808,2020-01-01,37.0,80,16,120,80,97",
+    "4,2020-01-01,37.0,80,16,120,80",
+    "5,2020-02-30,37.0,80,16,120,80,97",
+    "6,2020-01-01,37.0,250,16,120,80,97",
+    "7,2020-01-01,37.0,80,16,120,80,1e999",
+    "8,2020-01-01,36.6,81,17,121,81,98",
+]
+
+
+@pytest.fixture
+def dataFile(tmp_path):
+    path = str(tmp_path / 'patients.txt')
+    generatePatientFile(path, 2000, seed=1, invalidShare=0)
+    return path
+
+
+def readAll(path):
+    repository = main.openRepository('flat', path)
+    try:
+        return dict(repository.load())
+    finally:
+        repository.close()
+
+
+def testLoaderRejectsEveryBrokenRule(tmp_path):
+    path = tmp_path / 'patients.txt'
+    path.write_text('\n'.join(LOADER_LINES) + '\n')
+    patients = main.readPatientsFromFile(str(path))
+    report = patients.loadReport
+    assert sorted(patients) == [1, 8]
+    assert (report.lineCount, report.acceptedCount) == (9, 2)
+    assert [(row.lineNumber, row.reason) for row in report.rejected] == [
+        (2, "Invalid temperature value (nan)"),
+        (3, "Invalid heart rate value (inf)"),
+        (4, "Invalid patient ID (9223372036854775808)"),
+        (5, "Invalid number of sections (7)"),
+        (6, "Invalid date value (2020-02-30)"),
+        (7, "Invalid heart rate value (250)"),
+        (8, "Invalid oxygen saturation value (1e999)"),
+    ]
+    assert patients[8][0].astuple() == ('2020-01-01', 36.6, 81, 17, 121, 81, 98)
+
+
+def testLoaderKeepsEveryValidLine(dataFile):
+    patients = main.readPatientsFromFile(dataFile)
+    with open(dataFile) as file:
+        lineCount = sum(1 for _ in file)
+    assert patients.loadReport.rejected == []
+    assert patients.visitCount == lineCount == 2000
+
+
+def testLogReplaysAddsAndDeletes(dataFile):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    victim = next(iter(patients))
+    main.addPatientData(patients, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, dataFile)
+    assert main.removePatient(patients, victim, dataFile)
+    expected = dict(patients)
+    repository.close()
+    assert os.path.exists(dataFile + main.LOG_SUFFIX)
+    reopened = readAll(dataFile)
+    assert reopened == expected
+    assert 424242 in reopened and victim not in reopened
+
+
+def testCompactionRewritesThePatientsFile(dataFile):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    main.addPatientData(patients, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, dataFile)
+    main.removePatient(patients, next(iter(patients)), dataFile)
+    repository.log.compact(patients, wait=True)
+    expected = dict(patients)
+    repository.close()
+    assert repository.log.readEntries(repository.log.path)[1] == []
+    assert not os.path.exists(repository.log.oldPath)
+    assert dict(main.readPatientsFromFile(dataFile)) == expected
+    assert readAll(dataFile) == expected
+
+
+def testRecoverReplaysASetAsideLogWhoseRewriteNeverHappened(dataFile):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    main.addPatientData(patients, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, dataFile)
+    expected = dict(patients)
+    repository.close()
+    #As if a crash came right after the log was set aside
+    os.replace(repository.log.path, repository.log.oldPath)
+    assert readAll(dataFile) == expected
+    assert not os.path.exists(repository.log.oldPath)
+
+
+def testRecoverDiscardsASetAsideLogWhoseRewriteHappened(dataFile):
+    log = main.MutationLog(dataFile)
+    with open(log.oldPath, 'w') as file:
+        file.write(f"B,{log.baseInode() + 1}\nA,424242,2023-05-05,37.2,75,15,118,76,98\n")
+    assert 424242 not in readAll(dataFile)
+    assert not os.path.exists(log.oldPath)
+
+
+def testCompactionKeepsWhatAnotherRepositorySaved(dataFile):
+    first = main.openRepository('flat', dataFile)
+    second = main.openRepository('flat', dataFile)
+    mine, theirs = first.load(), second.load()
+    victim = next(iter(theirs))
+    main.addPatientData(theirs, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, dataFile)
+    main.removePatient(theirs, victim, dataFile)
+    main.addPatientData(mine, 434343, '2023-05-06', 36.8, 70, 14, 115, 75, 99, dataFile)
+    first.log.compact(mine, wait=True)
+    #The second repository still has the log the compaction set aside open
+    main.addPatientData(theirs, 444444, '2023-05-07', 37.0, 72, 16, 120, 80, 97, dataFile)
+    first.close()
+    second.close()
+    reopened = readAll(dataFile)
+    assert {424242, 434343, 444444} <= set(reopened)
+    assert victim not in reopened
+
+
+def testRefreshReplaysOnlyWhatAnotherRepositoryLogged(dataFile):
+    first = main.openRepository('flat', dataFile)
+    second = main.openRepository('flat', dataFile)
+    mine, theirs = first.load(), second.load()
+    victim = next(iter(mine))
+    main.addPatientData(mine, 434343, '2023-05-06', 36.8, 70, 14, 115, 75, 99, dataFile)
+    main.addPatientData(theirs, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, dataFile)
+    main.removePatient(theirs, victim, dataFile)
+    assert main.refreshPatients(mine)
+    assert not main.refreshPatients(mine)
+    assert 424242 in mine and victim not in mine
+    #The store's own visit is not replayed a second time
+    assert len(mine[434343]) == 1
+    first.close()
+    second.close()
+    assert readAll(dataFile) == dict(mine)
+
+
+@pytest.mark.skipif(main.fcntl is None, reason="file locks need fcntl")
+def testRecoverLeavesALiveCompactionAlone(dataFile):
+    log = main.MutationLog(dataFile)
+    with open(log.oldPath, 'w') as file:
+        file.write(f"B,{log.baseInode()}\nA,424242,2023-05-05,37.2,75,15,118,76,98\n")
+    with main.FileLock(log.compactingPath):
+        log.recover()
+        assert os.path.exists(log.oldPath)
+    log.recover()
+    assert not os.path.exists(log.oldPath)
+    assert 424242 in readAll(dataFile)
+
+
+def testSnapshotKeepsItsVersionWhileTheStoreChanges(dataFile):
+    patients = main.readPatientsFromFile(dataFile)
+    shared = main.SharedPatientStore(patients, dataFile)
+    snapshot = shared.snapshot()
+    patientId = next(iter(snapshot))
+    before = (dict(snapshot), main.getStats(snapshot), main.getStats(snapshot, patientId),
+              main.getMonthlyStats(snapshot, patientId=patientId), main.findVisitsByDate(snapshot, 2021))
+    shared.addVisits([(patientId, '2021-03-03', 39.5, 150, 30, 190, 110, 80)], fsync='none')
+    shared.deletePatient(next(id_ for id_ in snapshot if id_ != patientId))
+    after = (dict(snapshot), main.getStats(snapshot), main.getStats(snapshot, patientId),
+             main.getMonthlyStats(snapshot, patientId=patientId), main.findVisitsByDate(snapshot, 2021))
+    assert after == before
+    assert len(shared.snapshot()[patientId]) == len(snapshot[patientId]) + 1
+
+
+def testCopyOnWriteCopiesSharedContainersOnce():
+    sharing = main.CopyOnWrite()
+    data = {1: [1], 2: [2]}
+    assert sharing.writable(data) is data
+    assert sharing.writableValue(data, 1, list) is data[1]
+    sharing.freeze()
+    writable = sharing.writable(data)
+    assert writable is not data and writable == data
+    assert sharing.writable(writable) is writable
+    value = sharing.writableValue(writable, 1, list)
+    assert value is not data[1] and value == data[1]
+    assert sharing.writableValue(writable, 1, list) is value
+    assert sharing.writableValue(writable, 3, list) is None
+
+
+@pytest.mark.parametrize('backend', ['flat', 'sqlite'])
+def testStressRunFindsNoInconsistentReads(dataFile, tmp_path, backend):
+    if backend == 'sqlite':
+        database = str(tmp_path / 'patients.db')
+        main.migrateToSQLite(dataFile, database)
+        dataFile = database
+    results = main.stressTest(backend, dataFile, seconds=1.0, readers=4, writers=2)
+    assert results['failures'] == []
+    assert results['reads'] > 0 and results['writes'] > 0
+
+
+@pytest.mark.parametrize('year, month', [(2021, None), (None, 3), (2021, 3), (2021, 12)])
+def testFindVisitsByDateMatchesEveryVisitInThePeriod(dataFile, year, month):
+    patients = main.readPatientsFromFile(dataFile)
+    expected = sorted((patientId, visit.astuple()) for patientId in patients for visit in patients[patientId]
+                      if (year is None or visit.date.startswith(f"{year}-"))
+                      and (month is None or visit.date[5:7] == f"{month:02d}"))
+    found = main.findVisitsByDate(patients, year, month)
+    assert expected
+    assert sorted((patientId, visit.astuple()) for patientId, visit in found) == expected
+    assert [visit.date for patientId, visit in found] == sorted(visit.date for patientId, visit in found)
+
+
+@pytest.mark.parametrize('year, month', [(2021, 13), (None, 13), (2021, 0), (10000, None), (0, 1), (9999, 12)])
+def testFindVisitsByDateOutsideTheCalendarMatchesNothing(dataFile, year, month):
+    assert main.findVisitsByDate(main.readPatientsFromFile(dataFile), year, month) == []
+
+
+def testWriterStoresWhatTheFileKeeps(dataFile):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    with main.PatientWriter(patients, dataFile) as writer:
+        assert writer.add(424242, '2023-05-05', 37.25, 72.6, 16.5, 118.4, 76, 98) is None
+        assert writer.add(424242, '2023-05-06', 38.06, 80, 17, 121, 79.5, 97.5) is None
+        assert writer.add(424242, '2023-02-30', 37.0, 80, 17, 121, 80, 97) is not None
+        assert writer.add(424242, '2023-05-07', 42.5, 80, 17, 121, 80, 97) is not None
+    stored = [visit.astuple() for visit in patients[424242]]
+    repository.close()
+    assert [visit.astuple() for visit in readAll(dataFile)[424242]] == stored
+    assert [visit[1:] for visit in stored] == [(37.2, 73, 16, 118, 76, 98), (38.1, 80, 17, 121, 80, 98)]
+
+
+def displayed(patients, *args, **kwargs):
+    out = io.StringIO()
+    count = main.displayPatientData(patients, *args, format='csv', out=out, **kwargs)
+    lines = out.getvalue().splitlines()[1:]
+    assert count == len(lines)
+    return lines
+
+
+def testArchivedVisitsAreStillQueriedDisplayedAndMigrated(dataFile, tmp_path):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    patientId = next(iter(patients))
+    before = (main.getStats(patients).count, main.getStats(patients, patientId).count,
+              main.findVisitsByDate(patients, 2016), main.evaluateFollowUp(patients))
+    everything, ofOne = sorted(displayed(patients)), sorted(displayed(patients, patientId))
+    ofRange = displayed(patients, 0, lastId=patientId)
+    assert main.archiveVisits(patients, '2020-01-01') > 0
+    assert patients.archive.segments and patients.visitCount < len(everything)
+    after = (main.getStats(patients).count, main.getStats(patients, patientId).count,
+             main.findVisitsByDate(patients, 2016), main.evaluateFollowUp(patients))
+    assert after == before
+    assert sorted(displayed(patients)) == everything
+    assert sorted(displayed(patients, patientId)) == ofOne
+    assert sorted(displayed(patients, 0, lastId=patientId)) == sorted(ofRange)
+    pages = [displayed(patients, 0, 333, offset) for offset in range(0, len(everything) + 333, 333)]
+    assert sum(pages, []) == displayed(patients)
+    repository.close()
+    database = str(tmp_path / 'patients.db')
+    assert main.migrateToSQLite(dataFile, database) == len(everything)
+    assert sorted(displayed(main.openRepository('sqlite', database).load())) == everything
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'' if body is None else json.dumps(body).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nConnection: close\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+                 + data)
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(content)
+
+
+def testServiceAnswersQueriesAndRejectsBadRequests(dataFile):
+    patients = main.openPatients(dataFile)
+    patientId = next(iter(patients))
+    visit = {'date': '2023-05-05', 'temperature': 37.2, 'heartRate': 75, 'respiratoryRate': 15,
+             'systolicBloodPressure': 118, 'diastolicBloodPressure': 76, 'oxygenSaturation': 98}
+
+    async def run():
+        service = main.PatientService(patients, dataFile)
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, stats = await request(port, 'GET', '/stats')
+            assert (status, stats['count']) == (200, patients.visitCount)
+            status, visits = await request(port, 'GET', '/visits?year=2016&month=3&limit=5')
+            assert status == 200 and len(visits) == 5
+            assert all(found['date'].startswith('2016-03') for found in visits)
+            for query in ('month=13', 'month=0', 'year=99999', 'year=0', 'limit=-1', 'year=x', 'start=2023-02-30'):
+                assert (await request(port, 'GET', '/visits?' + query))[0] == 400, query
+            visits = [visit, {**visit, 'heartRate': 500}]
+            status, added = await request(port, 'POST', f'/patients/{patientId}/visits', visits)
+            assert status == 200 and added['added'] == 1 and added['rejected'][0]['index'] == 1
+            assert (await request(port, 'POST', f'/patients/{patientId}/visits', 7))[0] == 400
+            status, found = await request(port, 'GET', f'/patients/{patientId}')
+            assert status == 200 and found['visits'][-1]['date'] == '2023-05-05'
+            assert (await request(port, 'GET', '/nowhere'))[0] == 404
+        finally:
+            server.close()
+            await service.stop()
+
+    asyncio.run(run())
+    patients.repository.close()
+    assert readAll(dataFile)[patientId][-1].date == '2023-05-05'
+
+
+def testMigrationCopiesTheFilesTemperatures(dataFile, tmp_path):
+    database = str(tmp_path / 'patients.db')
+    main.migrateToSQLite(dataFile, database)
+    with open(dataFile) as file:
+        expected = sorted(float(line.split(',')[2]) for line in file)
+    connection = main.sqlite3.connect(database)
+    assert sorted(row[0] for row in connection.execute("SELECT temperature FROM visits")) == expected
+    connection.close()
+
+
+def testSessionExportsOrOpensTheStoreForTheMenu(dataFile, capsys):
+    patients = main.readPatientsFromFile(dataFile)
+    patientId = next(iter(patients))
+    assert main.openSession(['--data', dataFile, '--export', 'jsonl', '--patient', str(patientId)]) is None
+    exported = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(visit['patientId'], visit['date']) for visit in exported] == [
+        (patientId, visit.date) for visit in patients[patientId]]
+    opened = main.openSession(['--data', dataFile])
+    assert opened.repository.path == dataFile and dict(opened) == dict(patients)
+    opened.repository.close()
+
+
+def testProfilingStoppedDuringAProfiledCallReportsAfterIt(dataFile):
+    patients = main.readPatientsFromFile(dataFile)
+    out = io.StringIO()
+    profiler = main.INSTRUMENTS.profiler
+    main.toggleProfiling(1.0, out)
+    assert profiler.rate == 1.0
+
+    def signalled():
+        #As if SIGUSR1 arrived while this profiled call was running
+        main.toggleProfiling(1.0, out)
+        assert "sampled calls" not in out.getvalue()
+        return main.findVisitsByDate(patients, 2016)
+
+    try:
+        assert main.INSTRUMENTS.call('signalled', signalled, (), {}) == main.findVisitsByDate(patients, 2016)
+        assert profiler.rate == 0 and profiler.pendingReport is None
+        assert "1 sampled calls" in out.getvalue()
+    finally:
+        profiler.stop()
+        main.INSTRUMENTS.enabled = False
+        main.INSTRUMENTS.reset()
+
+
+def fileVitals(path, patientId=None):
+    with open(path) as file:
+        rows = [line.strip().split(',') for line in file]
+    return list(zip(*(map(float, row[2:]) for row in rows if patientId is None or int(row[0]) == patientId)))
+
+
+def testStatsShowTheFilesPrecision(dataFile):
+    patients = main.readPatientsFromFile(dataFile)
+    patientId = next(iter(patients))
+    for wanted, stats in ((None, main.getStats(patients)), (patientId, main.getStats(patients, patientId))):
+        columns = fileVitals(dataFile, wanted)
+        assert stats.count == len(columns[0])
+        for (name, low, high), decimals, values in zip(main.VITAL_RULES, main.VITAL_DECIMALS, columns):
+            vital = stats.vitals[name]
+            assert (vital.minimum, vital.maximum) == (min(values), max(values))
+            assert vital.average == pytest.approx(sum(values) / len(values), abs=1e-3)
+            assert vital.average == round(vital.average, decimals + main.EXTRA_DECIMALS)
+
+
+def testMonthlyStatsShowTheFilesPrecisionAfterChanges(dataFile):
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    main.getMonthlyStats(patients)
+    main.addPatientData(patients, 424242, '2016-03-05', 37.3, 75, 15, 118, 76, 98, dataFile)
+    main.removePatient(patients, next(iter(patients)), dataFile)
+    byMonth = {}
+    for patientId in patients:
+        for visit in patients[patientId]:
+            byMonth.setdefault(visit.date[:7], []).append(visit.astuple()[1:])
+    months = main.getMonthlyStats(patients)
+    assert [period.first for period in months] == sorted(byMonth)
+    for period in months:
+        columns = list(zip(*byMonth[period.first]))
+        assert period.count == len(columns[0])
+        for (name, low, high), decimals, values in zip(main.VITAL_RULES, main.VITAL_DECIMALS, columns):
+            vital = period.vitals[name]
+            assert (vital.minimum, vital.maximum) == (min(values), max(values))
+            assert vital.average == pytest.approx(sum(values) / len(values), abs=1e-3)
+            assert vital.stddev == round(vital.stddev, decimals + main.EXTRA_DECIMALS)
+    repository.close()
+
+
+def testParallelIngestMatchesReadingTheFilesInTurn(tmp_path, monkeypatch):
+    paths = [str(tmp_path / f'shard{i}.txt') for i in range(2)]
+    for i, path in enumerate(paths):
+        generatePatientFile(path, 3000, seed=i, invalidShare=0.05)
+    #Small chunks, so each file is cut into several ranges
+    monkeypatch.setattr(main, 'CHUNK_SIZE', 16384)
+    patients = main.readPatientsFromFiles(paths, workers=3)
+    assert main.splitFileRanges(paths[0], 3) != [(0, os.path.getsize(paths[0]))]
+    expected = {}
+    rejected = []
+    for path in paths:
+        shard = main.readPatientsFromFile(path)
+        for patientId in shard:
+            expected.setdefault(patientId, []).extend(shard[patientId])
+        rejected.extend(shard.loadReport.rejected)
+    assert dict(patients) == expected
+    assert patients.loadReport.rejected == rejected
+    assert patients.loadReport.lineCount == 6000
+
+
+def testSnapshotIsMappedWhileTheFileIsUnchangedOrOnlyGrew(dataFile):
+    expected = dict(main.readPatientsFromFile(dataFile))
+    assert readAll(dataFile) == expected
+    assert os.path.exists(dataFile + main.SNAPSHOT_SUFFIX)
+    patients, sourceSize = main.openPatientSnapshot(dataFile)
+    assert sourceSize == os.path.getsize(dataFile) and dict(patients) == expected
+    assert isinstance(patients.dates, memoryview)
+    #A mapped store copies its columns before the first change
+    patients.extend(*main.gatherColumns(patients, [0]))
+    assert patients.visitCount == sum(map(len, expected.values())) + 1
+    with open(dataFile, 'a') as file:
+        file.write("424242,2023-05-05,37.2,75,15,118,76,98\n")
+    assert main.openPatientSnapshot(dataFile)[1] == sourceSize
+    assert readAll(dataFile) == dict(main.readPatientsFromFile(dataFile))
+    with open(dataFile, 'r+') as file:
+        file.write("1")
+    assert main.openPatientSnapshot(dataFile) == (None, 0)
+    assert readAll(dataFile) == dict(main.readPatientsFromFile(dataFile))
+
+
+def flaggedByScan(patients, rules):
+    flagged = {}
+    for patientId in patients:
+        visits = sorted(patients[patientId], key=lambda visit: visit.date)
+        for rule in rules:
+            values = [visit.astuple()[1 + rule.index] for visit in visits]
+            if isinstance(rule, main.TrendRule):
+                recent = values[-rule.visits:]
+                difference = recent[-1] - recent[0]
+                matched = len(recent) == rule.visits and (difference >= rule.change if rule.change > 0
+                                                          else difference <= rule.change)
+            else:
+                recent = values[-rule.ofLast:] if rule.ofLast is not None else values
+                matched = sum(map(rule.isAbnormal, recent)) >= rule.atLeast
+            if matched:
+                flagged.setdefault(patientId, []).append(rule.name)
+    return flagged
+
+
+def testFollowUpRulesMatchAScanOfEveryVisit(dataFile):
+    rules = (
+        main.ThresholdRule('fever', 'temperature', high=37.5, atLeast=2, ofLast=3),
+        main.ThresholdRule('fast breathing', 'respiratory rate', high=18, atLeast=2),
+        main.TrendRule('falling oxygen', 'oxygen saturation', -3),
+        main.TrendRule('rising pressure', 'systolic blood pressure', 15, visits=4),
+    )
+    repository = main.openRepository('flat', dataFile)
+    patients = repository.load()
+    assert main.evaluateFollowUp(patients) == flaggedByScan(patients, main.DEFAULT_FOLLOW_UP_RULES)
+    custom = main.evaluateFollowUp(patients, rules)
+    assert custom == flaggedByScan(patients, rules)
+    assert {name for reasons in custom.values() for name in reasons} == {rule.name for rule in rules}
+    #Only the changed patients are re-checked, with the same outcome as a full evaluation
+    healthy = next(patientId for patientId in patients if patientId not in main.evaluateFollowUp(patients))
+    flagged = next(iter(main.evaluateFollowUp(patients)))
+    main.addPatientData(patients, healthy, '2030-01-01', 36.8, 130, 15, 118, 76, 98, dataFile)
+    main.removePatient(patients, flagged, dataFile)
+    reasons = main.evaluateFollowUp(patients)
+    assert reasons == flaggedByScan(patients, main.DEFAULT_FOLLOW_UP_RULES)
+    assert reasons[healthy] == ['abnormal heart rate'] and flagged not in reasons
+    assert main.findPatientsWhoNeedFollowUp(patients) == list(reasons)
+    repository.close()
+
+
+def testDisplayFormatsShowEveryVisitAndPagesAddUpToThem(dataFile):
+    patients = main.readPatientsFromFile(dataFile)
+    byPatient = {}
+    with open(dataFile) as file:
+        for line in file.read().splitlines():
+            byPatient.setdefault(int(line.split(',')[0]), []).append(line)
+    #Each patient's visits in turn, in the order they were read
+    lines = [line for patientId in patients for line in byPatient[patientId]]
+    assert displayed(patients) == lines
+    out = io.StringIO()
+    assert main.displayPatientData(patients, format='jsonl', out=out) == len(lines)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [list(record.values()) for record in records] == \
+        [[int(values[0]), values[1], float(values[2])] + list(map(int, values[3:]))
+         for values in (line.split(',') for line in lines)]
+    out = io.StringIO()
+    assert main.displayPatientData(patients, format='text', out=out) == len(lines)
+    text = out.getvalue()
+    assert text.count(" Visit Date: ") == len(lines)
+    assert [int(line[len("Patient ID:"):]) for line in text.splitlines() if line.startswith("Patient ID:")] == \
+        list(patients)
+    #Pages of every format add up to the whole output
+    for format in ('csv', 'jsonl'):
+        whole = io.StringIO()
+        main.displayPatientData(patients, format=format, out=whole)
+        pages = []
+        for offset in range(0, len(lines), 300):
+            page = io.StringIO()
+            assert main.displayPatientData(patients, limit=300, offset=offset, format=format, out=page) == \
+                min(300, len(lines) - offset)
+            pages.extend(page.getvalue().splitlines()[format == 'csv':])
+        assert pages == whole.getvalue().splitlines()[format == 'csv':]
+    patientId = next(iter(patients))
+    assert displayed(patients, patientId) == byPatient[patientId]
+    assert displayed(patients, patientId, limit=2, offset=1) == byPatient[patientId][1:3]
+    with pytest.raises(ValueError):
+        main.displayPatientData(patients, format='xml', out=io.StringIO())
+
+
+@pytest.mark.parametrize('backend', ['flat', 'sqlite'])
+def testIdRangesMatchAScanAfterAddsAndDeletes(dataFile, tmp_path, backend):
+    path = dataFile
+    if backend == 'sqlite':
+        path = str(tmp_path / 'patients.db')
+        main.migrateToSQLite(dataFile, path)
+    repository = main.openRepository(backend, path)
+    patients = repository.load()
+    main.addPatientData(patients, 424242, '2023-05-05', 37.2, 75, 15, 118, 76, 98, path)
+    main.addPatientData(patients, 50, '2023-05-05', 37.2, 75, 15, 118, 76, 98, path)
+    main.removePatient(patients, min(patients), path)
+    main.removePatient(patients, 10, path)
+    ids = sorted(patients)
+    for low, high in ((None, None), (5, 40), (10, 10), (60, 424242), (None, 25), (200, None), (40, 5)):
+        expected = [patientId for patientId in ids if (low is None or patientId >= low) and
+                    (high is None or patientId <= high)]
+        assert main.findPatientsByIdRange(patients, low, high) == expected
+    #A fresh repository reads the same patients straight from what was saved
+    other = main.openRepository(backend, path)
+    ranged = other.loadPatients(5, 60)
+    assert dict(ranged) == {patientId: patients[patientId] for patientId in ids if 5 <= patientId <= 60}
+    assert list(other.loadPatients(424242, 424242)) == [424242]
+    other.close()
+    repository.close()